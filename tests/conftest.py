@@ -0,0 +1,73 @@
+"""Test setup: point the app at a scratch download directory and offline tool stubs
+
+The configuration is read when youtubedl is imported, so the environment is
+set here, before any test module imports it.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(TESTS_DIR, 'stubs')
+SCRATCH_DIR = tempfile.mkdtemp(prefix='youtubedl-tests-')
+
+os.environ.update({
+    'YOUTUBEDL_DOWNLOAD_DIR': os.path.join(SCRATCH_DIR, 'downloads'),
+    'YOUTUBEDL_LOG_FILE': os.path.join(SCRATCH_DIR, 'youtubedl.log'),
+    'YOUTUBEDL_LOG_FORMAT': 'text',
+    'YOUTUBEDL_YT_DLP_PATH': os.path.join(STUBS_DIR, 'yt-dlp'),
+    # ffmpeg and ffprobe are found on PATH
+    'PATH': STUBS_DIR + os.pathsep + os.environ.get('PATH', ''),
+    'YOUTUBEDL_ENGINE': 'subprocess',
+    'YOUTUBEDL_THUMB_PREGENERATE': '0',
+    'YOUTUBEDL_RECOVER_JOBS': '0',
+    # Every test client shares one address; admission tests build their own limiter
+    'YOUTUBEDL_ADMISSION_MAX_IN_FLIGHT': '0'
+})
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import youtubedl  # noqa: E402
+
+@pytest.fixture(scope='session')
+def app():
+    return youtubedl.create_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def wait_until(condition, timeout=5):
+    """Poll until condition() is true, failing the test after timeout seconds"""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+class StubPipeline:
+    """Stands in for run_download_pipeline: counts fetches and blocks until released"""
+    
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+    
+    def __call__(self, job, download_slots, transcode_slots):
+        self.calls.append((job.video_id, job.quality))
+        with job.stage('download'):
+            assert self.release.wait(10), "stub pipeline was never released"
+        output_file = os.path.join(youtubedl.DOWNLOAD_DIR, f"Stub [{job.video_id}]-{job.quality}.mp4")
+        with open(output_file, 'wb') as f:
+            f.write(job.id.encode() * 1000)
+        job.output_file = output_file
+        job.download_name = f"Stub-{job.quality}.mp4"
+        return output_file
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    stub = StubPipeline()
+    monkeypatch.setitem(youtubedl.OUTPUT_PIPELINES, 'video', stub)
+    yield stub
+    stub.release.set()
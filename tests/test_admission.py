@@ -0,0 +1,125 @@
+"""Per-client admission control on every endpoint that starts work"""
+import os
+import threading
+
+import pytest
+
+import youtubedl
+
+from conftest import wait_until
+from test_stream import StubStream
+
+@pytest.fixture
+def admission(monkeypatch):
+    # Three requests per client, then one every 100 s; one request in flight at a time
+    admission = youtubedl.AdmissionControl(rate=0.01, burst=3, max_in_flight=1, queue_size=4,
+                                           client_queue_size=2, queue_timeout=0.5)
+    monkeypatch.setattr(youtubedl, '_ADMISSION', admission)
+    return admission
+
+def post_job(client, video_id, address='10.0.0.1'):
+    return client.post('/api/jobs', json={'id': video_id, 'quality': '720p'},
+                       environ_base={'REMOTE_ADDR': address})
+
+def test_burst_from_one_client_is_rate_limited(client, admission, pipeline):
+    statuses = [post_job(client, f"AdmBurst{i:03d}").status_code for i in range(3)]
+    assert statuses == [202, 202, 202]
+    response = post_job(client, 'AdmBurst003')
+    assert response.status_code == 429
+    assert response.get_json()['reason'] == 'rate_limited'
+    assert int(response.headers['Retry-After']) >= 1
+    # The refused request queued no job
+    assert youtubedl._JOBS._active.get(('AdmBurst003', '720p')) is None
+    # Other clients keep their own budget
+    assert post_job(client, 'AdmBurst004', address='10.0.0.2').status_code == 202
+    assert admission.stats()['rejected'] == {'rate_limited': 1}
+
+def test_requests_wait_for_a_free_slot(client, admission, pipeline):
+    held = admission.acquire('10.9.9.9', 'test')
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(post_job(client, 'AdmQueued01')))
+    thread.start()
+    wait_until(lambda: admission.stats()['queued'] == 1)
+    admission.release(held)
+    thread.join(5)
+    assert responses[0].status_code == 202
+    assert admission.stats()['in_flight'] == 0
+
+def test_queue_timeout_is_refused_with_503(client, admission, pipeline):
+    held = admission.acquire('10.9.9.9', 'test')
+    try:
+        responses = [post_job(client, f"AdmTimeout{i}") for i in range(3)]
+    finally:
+        admission.release(held)
+    assert [response.status_code for response in responses] == [503, 503, 503]
+    assert responses[0].get_json()['reason'] == 'queue_timeout'
+    assert responses[0].headers['Retry-After']
+    # Requests that timed out in the queue give their tokens back
+    assert post_job(client, 'AdmTimeout3').status_code == 202
+
+def test_download_wait_holds_no_admission_slot(client, admission, pipeline):
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(
+        client.get('/api/download?id=AdmWaiting1&quality=720p', environ_base={'REMOTE_ADDR': '10.0.0.3'})))
+    thread.start()
+    wait_until(lambda: pipeline.calls)
+    assert admission.stats()['in_flight'] == 0
+    # The only slot is free for other requests while the download runs
+    assert post_job(client, 'AdmWaiting2').status_code == 202
+    pipeline.release.set()
+    thread.join(5)
+    assert responses[0].status_code == 200
+
+def test_stream_holds_its_slot_until_closed(client, admission, monkeypatch):
+    monkeypatch.setattr(StubStream, 'started', [])
+    monkeypatch.setattr(youtubedl, 'StreamPipeline', StubStream)
+    response = client.get('/api/stream?id=Cinema21x9A&quality=480p', buffered=False,
+                          environ_base={'REMOTE_ADDR': '10.0.0.4'})
+    assert response.status_code == 200
+    next(iter(response.response))
+    assert admission.stats()['in_flight'] == 1
+    response.close()
+    assert admission.stats()['in_flight'] == 0
+
+def test_cached_outputs_skip_admission(client, admission, pipeline, monkeypatch):
+    monkeypatch.setattr(youtubedl, 'output_cached', lambda video_id, quality: True)
+    for i in range(5):
+        assert post_job(client, f"AdmCached{i:02d}").status_code != 429
+    assert admission.stats()['admitted'] == 0
+
+@pytest.mark.parametrize('method, path, body', [
+    ('get', '/api/info?id=AdmEndpnt01', None),
+    ('get', '/api/download?id=AdmEndpnt01&quality=720p', None),
+    ('get', '/api/stream?id=AdmEndpnt01&quality=720p', None),
+    ('post', '/api/jobs', {'id': 'AdmEndpnt01', 'quality': '720p'}),
+    ('post', '/api/jobs/batch', {'id': 'AdmEndpnt01', 'qualities': ['360p', '720p']}),
+    ('post', '/api/playlists', {'list': 'PLadmission'}),
+    ('get', '/api/thumb/AdmEndpnt01?format=jpeg', None)
+])
+def test_every_work_endpoint_is_admission_controlled(client, admission, method, path, body):
+    # Use up the client's tokens, then every endpoint refuses it
+    for _ in range(3):
+        admission.release(admission.acquire('10.0.0.7', 'test'))
+    response = getattr(client, method)(path, json=body, environ_base={'REMOTE_ADDR': '10.0.0.7'})
+    if path.startswith('/api/thumb'):
+        # Images fall back to YouTube's thumbnail instead of breaking
+        assert response.status_code == 302 and 'i.ytimg.com' in response.headers['Location']
+        assert admission.stats()['rejected'] == {'rate_limited': 1}
+    else:
+        assert response.status_code == 429
+
+def test_cached_thumbnails_skip_admission(client, admission):
+    relative = 'AdmThumbs01/480.jpg'
+    path = os.path.join(youtubedl._THUMBS.directory, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8stub')
+    youtubedl._THUMBS._record('AdmThumbs01', [relative])
+    for _ in range(5):
+        assert client.get('/api/thumb/AdmThumbs01?format=jpeg').status_code == 200
+    assert admission.stats()['admitted'] == 0
+
+def test_invalid_requests_are_not_charged(client, admission):
+    for _ in range(5):
+        assert post_job(client, 'bad id').status_code == 400
+    assert admission.stats()['admitted'] == 0
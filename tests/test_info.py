@@ -0,0 +1,70 @@
+"""/api/info quality ladder built from a recorded yt-dlp -j probe"""
+import json
+import os
+
+import youtubedl
+
+from conftest import TESTS_DIR
+
+def load_fixture(video_id):
+    with open(os.path.join(TESTS_DIR, 'fixtures', f"{video_id}.json")) as f:
+        return json.load(f)
+
+def video_entries(formats):
+    return {fmt['quality']: fmt for fmt in formats if fmt['kind'] == 'video'}
+
+def test_info_lists_ladder_from_probe(client):
+    response = client.get('/api/info?id=dQw4w9WgXcQ')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['title'] == 'Widescreen sample'
+    assert body['duration'] == 212
+    videos = video_entries(body['available_formats'])
+    assert list(videos) == ['360p', '480p', '720p', '1080p']
+    assert (videos['1080p']['width'], videos['1080p']['height']) == (1920, 1080)
+    # The separate audio stream is added to the size of video-only streams
+    assert videos['720p']['filesize'] == 36500000 + 3550000
+    assert videos['720p']['acodec'] == 'opus'
+
+def test_info_lists_audio_and_subtitles(client):
+    body = client.get('/api/info?id=dQw4w9WgXcQ').get_json()
+    audio = {fmt['quality']: fmt for fmt in body['available_formats'] if fmt['kind'] == 'audio'}
+    assert audio['audio.m4a']['stream_copy'] and audio['audio.opus']['stream_copy']
+    assert not audio['audio.mp3']['stream_copy']
+    subtitles = [fmt for fmt in body['available_formats'] if fmt['kind'] == 'subtitles']
+    assert {(fmt['language'], fmt['automatic']) for fmt in subtitles} == {('en', False)}
+
+def test_info_answers_second_request_from_cache(client, monkeypatch):
+    client.get('/api/info?id=dQw4w9WgXcQ')
+    probes = []
+    monkeypatch.setattr(youtubedl, 'get_video_info_with_yt_dlp', probes.append)
+    assert client.get('/api/info?id=dQw4w9WgXcQ').status_code == 200
+    assert probes == []
+
+def test_info_falls_back_to_standard_ladder(client):
+    body = client.get('/api/info?id=MissingVid1').get_json()
+    assert body['title'] == 'YouTube Video'
+    assert list(video_entries(body['available_formats'])) == ['360p', '480p', '720p', '1080p']
+
+def test_ultrawide_formats_are_bucketed_below_their_height():
+    videos = video_entries(youtubedl.get_available_formats(load_fixture('Cinema21x9A')))
+    assert list(videos) == ['360p', '480p', '720p']
+    assert (videos['720p']['width'], videos['720p']['height']) == (1920, 800)
+
+def test_vertical_formats_are_bucketed_by_their_short_side():
+    videos = video_entries(youtubedl.get_available_formats(load_fixture('Vertical916')))
+    assert list(videos) == ['360p', '480p', '720p', '1080p']
+    assert (videos['1080p']['width'], videos['1080p']['height']) == (1080, 1920)
+    assert (videos['720p']['width'], videos['720p']['height']) == (720, 1280)
+
+def test_formats_above_the_ladder_are_not_offered_as_its_top_rung():
+    videos = video_entries(youtubedl.get_available_formats(load_fixture('dQw4w9WgXcQ')))
+    assert videos['1080p']['height'] == 1080
+    assert 1440 not in {fmt['height'] for fmt in videos.values()}
+
+def test_format_rung():
+    assert youtubedl.format_rung({'width': 256, 'height': 144}) is None
+    assert youtubedl.format_rung({'width': 854, 'height': 480}) == 480
+    assert youtubedl.format_rung({'width': 1920, 'height': 800}) == 720
+    assert youtubedl.format_rung({'width': 608, 'height': 1080}) == 480
+    assert youtubedl.format_rung({'width': 3840, 'height': 2160}) is None
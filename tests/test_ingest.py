@@ -0,0 +1,148 @@
+"""Playlist ingestion with a fake extractor and job queue, and the per-host rate limiter"""
+import threading
+import time
+
+import pytest
+
+import youtubedl
+
+from conftest import wait_until
+
+class FakeJob:
+    def __init__(self, video_id, error=None):
+        self.id = f"job-{video_id}"
+        self.video_id = video_id
+        self.error = error
+    
+    def wait(self, timeout=None):
+        return True
+
+class FakeQueue:
+    """Stands in for JobManager.submit; fails each id the given number of times"""
+    
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.submitted = []
+        self.lock = threading.Lock()
+    
+    def __call__(self, video_id, quality):
+        with self.lock:
+            self.submitted.append((video_id, quality))
+            remaining = self.failures.get(video_id, 0)
+            self.failures[video_id] = remaining - 1
+        return FakeJob(video_id, 'HTTP Error 429: Too Many Requests' if remaining > 0 else None)
+
+def entry(video_id, ie_key='Youtube'):
+    return {'id': video_id, 'title': f"Entry {video_id}", 'ie_key': ie_key,
+            'url': f"https://www.youtube.com/watch?v={video_id}"}
+
+PLAYLIST = [entry('IngestVid01'), entry('IngestVid02'), entry('IngestVid03'),
+            entry('CachedVid01'), entry('12345', ie_key='Vimeo'), entry('IngestVid04')]
+
+def fake_extractor(url, max_entries):
+    return 'Test playlist', list(PLAYLIST)
+
+@pytest.fixture
+def limiter():
+    return youtubedl.HostRateLimiter(rate=1000, burst=10, backoff=0.01, max_backoff=0.05)
+
+@pytest.fixture(autouse=True)
+def cached_entries(monkeypatch):
+    monkeypatch.setattr(youtubedl, 'output_cached', lambda video_id, quality: video_id == 'CachedVid01')
+
+def run_ingest(limiter, queue, attempts=3, max_entries=100, extractor=fake_extractor):
+    ingest = youtubedl.PlaylistIngest('https://www.youtube.com/playlist?list=PLtest', '720p', 2, attempts, max_entries)
+    ingest.run(extractor, queue, limiter)
+    return ingest
+
+def states(ingest):
+    return {entry['video_id']: entry['state'] for entry in ingest.to_dict()['entries']}
+
+def test_ingest_skips_cached_and_unsupported_entries(limiter):
+    queue = FakeQueue()
+    ingest = run_ingest(limiter, queue)
+    assert ingest.state == 'done' and ingest.title == 'Test playlist'
+    assert states(ingest) == {'IngestVid01': 'done', 'IngestVid02': 'done', 'IngestVid03': 'done',
+                              'CachedVid01': 'cached', '12345': 'unsupported', 'IngestVid04': 'done'}
+    assert sorted(queue.submitted) == [(f"IngestVid0{i}", '720p') for i in range(1, 5)]
+    assert ingest.to_dict()['percent'] == 100.0
+
+def test_ingest_retries_failed_entries_with_backoff(limiter):
+    queue = FakeQueue({'IngestVid02': 1, 'IngestVid03': 5})
+    ingest = run_ingest(limiter, queue, attempts=3)
+    entries = {entry['video_id']: entry for entry in ingest.to_dict()['entries']}
+    assert entries['IngestVid02']['state'] == 'done' and entries['IngestVid02']['attempts'] == 2
+    assert entries['IngestVid02']['error'] is None
+    assert entries['IngestVid03']['state'] == 'failed' and entries['IngestVid03']['attempts'] == 3
+    assert '429' in entries['IngestVid03']['error']
+    assert queue.submitted.count(('IngestVid03', '720p')) == 3
+    assert ingest.to_dict()['counts'] == {'done': 3, 'failed': 1, 'cached': 1, 'unsupported': 1}
+
+def test_ingest_takes_at_most_max_entries(limiter):
+    ingest = run_ingest(limiter, FakeQueue(), max_entries=2)
+    assert list(states(ingest)) == ['IngestVid01', 'IngestVid02']
+
+def test_ingest_reports_extraction_failure(limiter):
+    ingest = run_ingest(limiter, FakeQueue(), extractor=lambda url, max_entries: None)
+    assert ingest.state == 'error'
+    assert ingest.error == 'Could not retrieve the playlist'
+
+def test_cancelled_ingest_starts_no_more_entries():
+    # One token and a long refill: after the first start the rest wait on the limiter
+    limiter = youtubedl.HostRateLimiter(rate=0.01, burst=1, backoff=1, max_backoff=1)
+    queue = FakeQueue()
+    ingest = youtubedl.PlaylistIngest('https://www.youtube.com/playlist?list=PLtest', '720p', 2, 3, 100)
+    thread = threading.Thread(target=ingest.run, args=(fake_extractor, queue, limiter))
+    thread.start()
+    wait_until(lambda: queue.submitted)
+    ingest.cancelled = True
+    thread.join(5)
+    assert ingest.state == 'cancelled'
+    assert len(queue.submitted) == 1
+    assert list(states(ingest).values()).count('cancelled') == 3
+
+def test_rate_limiter_allows_a_burst_then_paces():
+    limiter = youtubedl.HostRateLimiter(rate=20, burst=3, backoff=1, max_backoff=1)
+    began = time.monotonic()
+    for _ in range(3):
+        assert limiter.acquire('www.youtube.com')
+    assert time.monotonic() - began < 0.05
+    assert limiter.acquire('www.youtube.com')
+    assert time.monotonic() - began >= 0.04
+    # Hosts have separate buckets
+    began = time.monotonic()
+    assert limiter.acquire('example.com')
+    assert time.monotonic() - began < 0.05
+
+def test_rate_limiter_backoff_doubles_up_to_the_cap():
+    limiter = youtubedl.HostRateLimiter(rate=1000, burst=1, backoff=10, max_backoff=35)
+    delays = [limiter.failure('www.youtube.com') for _ in range(4)]
+    for delay, expected in zip(delays, [10, 20, 35, 35]):
+        assert expected * 0.8 <= delay <= expected * 1.2
+    assert limiter.stats()['www.youtube.com']['failures'] == 4
+    limiter.success('www.youtube.com')
+    assert limiter.stats()['www.youtube.com']['failures'] == 0
+
+def test_rate_limiter_acquire_gives_up_when_cancelled():
+    limiter = youtubedl.HostRateLimiter(rate=1000, burst=1, backoff=30, max_backoff=30)
+    limiter.failure('www.youtube.com')
+    assert limiter.acquire('www.youtube.com', cancelled=lambda: True) is False
+
+def test_playlist_endpoint_runs_ingest(client, monkeypatch, limiter):
+    queue = FakeQueue()
+    monkeypatch.setattr(youtubedl._INGESTS, 'extractor', fake_extractor)
+    monkeypatch.setattr(youtubedl._INGESTS, 'submit', queue)
+    monkeypatch.setattr(youtubedl._INGESTS, 'limiter', limiter)
+    response = client.post('/api/playlists', json={'list': 'PLtest', 'quality': '480p'})
+    assert response.status_code == 202
+    status_url = response.get_json()['status_url']
+    wait_until(lambda: client.get(status_url).get_json()['state'] == 'done')
+    body = client.get(status_url).get_json()
+    assert body['url'] == 'https://www.youtube.com/playlist?list=PLtest'
+    assert body['counts'] == {'done': 4, 'cached': 1, 'unsupported': 1}
+    assert {quality for _, quality in queue.submitted} == {'480p'}
+
+@pytest.mark.parametrize('params', [{}, {'url': 'ftp://example.com/list'}, {'list': 'PLtest', 'quality': 'foo'},
+                                    {'list': 'PLtest', 'max_entries': 'many'}])
+def test_playlist_endpoint_rejects_bad_requests(client, params):
+    assert client.post('/api/playlists', json=params).status_code == 400
@@ -0,0 +1,121 @@
+"""Single-flight job sharing, exercised with a stub pipeline instead of yt-dlp/ffmpeg"""
+import threading
+
+import pytest
+
+import youtubedl
+
+from conftest import wait_until
+
+@pytest.fixture
+def manager(app, tmp_path):
+    manager = youtubedl.JobManager(4, 2, 2, 3600, youtubedl.JobStore(str(tmp_path / 'jobs.sqlite3')))
+    yield manager
+    manager.shutdown(5)
+
+def test_concurrent_submits_share_one_fetch(manager, pipeline):
+    requests = 8
+    barrier = threading.Barrier(requests)
+    jobs = []
+    
+    def submit():
+        barrier.wait()
+        jobs.append(manager.submit('SingleFlt01', '720p'))
+    
+    threads = [threading.Thread(target=submit) for _ in range(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pipeline.release.set()
+    assert all(job.wait(5) for job in jobs)
+    
+    assert pipeline.calls == [('SingleFlt01', '720p')]
+    assert len({job.id for job in jobs}) == 1
+    assert len({job.output_file for job in jobs}) == 1 and not jobs[0].error
+    assert jobs[0].attached == requests - 1
+    assert manager.deduplicated == requests - 1
+
+def test_different_keys_are_fetched_separately(manager, pipeline):
+    pipeline.release.set()
+    jobs = [manager.submit('SingleFlt02', '720p'), manager.submit('SingleFlt02', '480p'),
+            manager.submit('SingleFlt03', '720p')]
+    assert all(job.wait(5) for job in jobs)
+    assert sorted(pipeline.calls) == [('SingleFlt02', '480p'), ('SingleFlt02', '720p'), ('SingleFlt03', '720p')]
+
+def test_finished_job_is_not_reused(manager, pipeline):
+    pipeline.release.set()
+    first = manager.submit('SingleFlt04', '720p')
+    assert first.wait(5)
+    wait_until(lambda: ('SingleFlt04', '720p') not in manager._active)
+    second = manager.submit('SingleFlt04', '720p')
+    assert second.wait(5)
+    assert second.id != first.id and len(pipeline.calls) == 2
+
+def test_concurrent_downloads_get_the_same_file(app, pipeline):
+    requests = 6
+    responses = []
+    
+    def download():
+        response = app.test_client().get('/api/download?id=SingleFlt05&quality=480p')
+        responses.append((response.status_code, response.get_data()))
+    
+    deduplicated = youtubedl._JOBS.deduplicated
+    threads = [threading.Thread(target=download) for _ in range(requests)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: youtubedl._JOBS.deduplicated - deduplicated == requests - 1)
+    pipeline.release.set()
+    for thread in threads:
+        thread.join(10)
+    
+    assert pipeline.calls == [('SingleFlt05', '480p')]
+    assert [status for status, _ in responses] == [200] * requests
+    assert len({body for _, body in responses}) == 1
+
+def test_download_wait_is_bounded(app, pipeline, monkeypatch):
+    monkeypatch.setattr(youtubedl, 'DOWNLOAD_WAIT_TIMEOUT', 0.2)
+    client = app.test_client()
+    response = client.get('/api/download?id=SingleFlt06&quality=720p')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    job_id = response.get_json()['job_id']
+    
+    # The retry attaches to the job that is still running
+    monkeypatch.setattr(youtubedl, 'DOWNLOAD_WAIT_TIMEOUT', 10)
+    deduplicated = youtubedl._JOBS.deduplicated
+    
+    def release_when_attached():
+        wait_until(lambda: youtubedl._JOBS.deduplicated > deduplicated)
+        pipeline.release.set()
+    
+    threading.Thread(target=release_when_attached).start()
+    response = client.get('/api/download?id=SingleFlt06&quality=720p')
+    assert response.status_code == 200
+    assert pipeline.calls == [('SingleFlt06', '720p')]
+    assert youtubedl._JOBS.get(job_id).is_finished
+
+def submit_throttled(manager, video_id, quality, limit):
+    token = youtubedl._RATE_LIMIT.set(limit)
+    try:
+        return manager.submit(video_id, quality)
+    finally:
+        youtubedl._RATE_LIMIT.reset(token)
+
+def test_user_request_lifts_a_prefetch_rate_limit(manager, pipeline):
+    job = submit_throttled(manager, 'Throttle001', '720p', 100000)
+    assert job.throttle.limit == 100000
+    # Another throttled submitter keeps the limit; a user request drops it
+    assert submit_throttled(manager, 'Throttle001', '720p', 100000) is job
+    assert job.throttle.limit == 100000 and not job.throttle.lifted.is_set()
+    assert manager.submit('Throttle001', '720p') is job
+    assert job.throttle.limit == 0 and job.throttle.lifted.is_set()
+    pipeline.release.set()
+    assert job.wait(5)
+
+def test_prefetch_attaching_to_a_user_job_adds_no_limit(manager, pipeline):
+    job = manager.submit('Throttle002', '720p')
+    assert submit_throttled(manager, 'Throttle002', '720p', 100000) is job
+    assert job.throttle.limit == 0
+    pipeline.release.set()
+    assert job.wait(5)
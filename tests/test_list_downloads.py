@@ -0,0 +1,37 @@
+"""/api/list-downloads ETags, which every server worker must agree on"""
+import os
+
+import youtubedl
+
+def make_file(directory, name, size=100, mtime=1700000000):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    os.utime(path, (mtime, mtime))
+
+def test_indexes_of_the_same_files_share_a_digest(tmp_path):
+    make_file(tmp_path, 'Clip [AbCdEfGhIjK]-720p.mp4')
+    first = youtubedl.DownloadsIndex(str(tmp_path))
+    second = youtubedl.DownloadsIndex(str(tmp_path))
+    assert first.refresh() == second.refresh()
+
+def test_index_scanned_earlier_has_another_digest(tmp_path):
+    make_file(tmp_path, 'Clip [AbCdEfGhIjK]-720p.mp4')
+    stale = youtubedl.DownloadsIndex(str(tmp_path), rescan_interval=3600)
+    stale_digest = stale.refresh()
+    # The file changes without touching the directory's mtime, so the old
+    # index keeps its listing; a worker that scans now must not match it
+    make_file(tmp_path, 'Clip [AbCdEfGhIjK]-720p.mp4', size=200)
+    fresh = youtubedl.DownloadsIndex(str(tmp_path))
+    assert stale.refresh() == stale_digest
+    assert fresh.refresh() != stale_digest
+
+def test_etag_is_the_same_across_workers(client, monkeypatch):
+    monkeypatch.setattr(youtubedl, '_DOWNLOADS_INDEX', youtubedl.DownloadsIndex(youtubedl.DOWNLOAD_DIR))
+    first = client.get('/api/list-downloads?sort=title')
+    # Another worker with its own index of the same directory
+    monkeypatch.setattr(youtubedl, '_DOWNLOADS_INDEX', youtubedl.DownloadsIndex(youtubedl.DOWNLOAD_DIR))
+    again = client.get('/api/list-downloads?sort=title', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    other_query = client.get('/api/list-downloads?sort=size', headers={'If-None-Match': first.headers['ETag']})
+    assert other_query.status_code == 200
@@ -0,0 +1,68 @@
+"""Audio-only and subtitle outputs, produced by the stub yt-dlp, ffprobe and ffmpeg"""
+import pytest
+
+import youtubedl
+
+def run_job(client, quality, video_id='dQw4w9WgXcQ'):
+    response = client.post('/api/jobs', json={'id': video_id, 'quality': quality})
+    assert response.status_code == 202
+    job = youtubedl._JOBS.get(response.get_json()['job_id'])
+    assert job.wait(10)
+    return job
+
+def stub_codec(path):
+    with open(path, 'rb') as f:
+        return f.readline().decode().split('audio=')[1].strip()
+
+@pytest.mark.parametrize('quality, encode_path, codec', [
+    ('audio.m4a', 'audio_copy', 'aac'),
+    ('audio.opus', 'audio_copy', 'opus'),
+    ('audio.mp3', 'audio_encode', 'mp3')
+])
+def test_audio_output(client, quality, encode_path, codec):
+    job = run_job(client, quality)
+    assert job.error is None
+    assert job.encode_path == encode_path
+    ext = quality.split('.')[1]
+    assert job.output_file.endswith(f"Widescreen sample [dQw4w9WgXcQ]-audio.{ext}")
+    assert stub_codec(job.output_file) == codec
+    assert job.progress['transcode_percent'] == 100.0
+    
+    response = client.get(f"/api/jobs/{job.id}/file")
+    assert response.status_code == 200
+    assert response.mimetype == youtubedl.OUTPUT_MIMETYPES[ext]
+    assert response.headers['Content-Disposition'] == f'attachment; filename="Widescreen sample-audio.{ext}"'
+
+def test_audio_output_is_served_from_cache(client):
+    first = run_job(client, 'audio.opus')
+    again = run_job(client, 'audio.opus')
+    assert again.id != first.id
+    assert again.progress.get('cached') and again.output_file == first.output_file
+
+def test_audio_download_endpoint(client):
+    response = client.get('/api/download?id=dQw4w9WgXcQ&quality=audio.m4a')
+    assert response.status_code == 200
+    assert response.get_data().startswith(b'STUBMEDIA audio=aac')
+
+def test_subtitles_srt_are_converted(client):
+    job = run_job(client, 'subtitles.en.srt')
+    assert job.error is None and job.encode_path == 'subtitles_convert'
+    with open(job.output_file) as f:
+        srt = f.read()
+    assert srt.startswith('1\n00:00:01,000 --> 00:00:03,500\nFirst line of dQw4w9WgXcQ')
+    assert '\n2\n00:00:04,000 --> 00:00:06,250\n' in srt
+
+def test_subtitles_vtt_are_copied(client):
+    job = run_job(client, 'subtitles.en.vtt')
+    assert job.error is None and job.encode_path == 'subtitles_copy'
+    assert job.output_file.endswith('-subtitles.en.vtt')
+    with open(job.output_file) as f:
+        assert f.read().startswith('WEBVTT')
+
+def test_missing_subtitle_language_fails_the_job(client):
+    job = run_job(client, 'subtitles.ja.srt')
+    assert job.error == "No subtitles are available in language 'ja'."
+
+def test_unknown_video_fails_the_job(client):
+    job = run_job(client, 'audio.m4a', video_id='NoSuchVid01')
+    assert job.error == 'Could not retrieve video information'
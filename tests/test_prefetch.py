@@ -0,0 +1,78 @@
+"""Off-peak prefetching: rate limits and per-job waits, without running yt-dlp"""
+import threading
+
+import pytest
+
+import youtubedl
+
+def test_lifted_throttle_resumes_the_download_unlimited(app, monkeypatch):
+    throttle = youtubedl.Throttle(100000)
+    commands = []
+    
+    def run_tool(cmd, timeout, on_line=None, tail_lines=50, cancel=None):
+        commands.append(cmd)
+        if len(commands) == 1:
+            # A user request attaches mid-download; the throttled run is killed
+            throttle.lift()
+            assert cancel.is_set()
+            return -9, ''
+        return 0, ''
+    
+    monkeypatch.setattr(youtubedl, 'run_tool', run_tool)
+    with youtubedl.throttle_scope(throttle):
+        success, _ = youtubedl.run_yt_dlp_download('best', 'out.%(ext)s', 'https://example.com/v')
+    assert success
+    assert commands[0][commands[0].index('--limit-rate') + 1] == '100000'
+    assert '--limit-rate' not in commands[1] and commands[1][-1] == 'https://example.com/v'
+
+def test_cancelled_throttled_download_is_not_restarted(app, monkeypatch):
+    throttle = youtubedl.Throttle(100000)
+    cancelled = threading.Event()
+    calls = []
+    
+    def run_tool(cmd, timeout, on_line=None, tail_lines=50, cancel=None):
+        calls.append(cmd)
+        cancelled.set()
+        throttle.lift()
+        return -9, ''
+    
+    monkeypatch.setattr(youtubedl, 'run_tool', run_tool)
+    with youtubedl.cancel_scope(cancelled), youtubedl.throttle_scope(throttle):
+        success, _ = youtubedl.run_yt_dlp_download('best', 'out.%(ext)s', 'https://example.com/v')
+    assert not success and len(calls) == 1
+
+@pytest.fixture
+def prefetcher(app, monkeypatch):
+    jobs = []
+    
+    def submit(video_id, quality):
+        # A job that never finishes
+        jobs.append(youtubedl.DownloadJob(video_id, quality))
+        return jobs[-1]
+    
+    prefetcher = youtubedl.Prefetcher('00:00-23:59', job_timeout=0.1, submit=submit)
+    prefetcher.jobs = jobs
+    monkeypatch.setattr(prefetcher, 'candidates', lambda: {'PrefetchA01': ['720p'], 'PrefetchB01': ['720p']})
+    monkeypatch.setattr(prefetcher, '_wait_for_cpu', lambda: True)
+    monkeypatch.setattr(prefetcher, '_fits', lambda *args: True)
+    monkeypatch.setattr(youtubedl, 'refresh_video_info', lambda video_id: {'id': video_id})
+    monkeypatch.setattr(youtubedl, 'output_cached', lambda video_id, quality: False)
+    return prefetcher
+
+def test_stuck_job_does_not_stall_the_pass(prefetcher):
+    prefetcher.run_pass()
+    assert [job.video_id for job in prefetcher.jobs] == ['PrefetchA01', 'PrefetchB01']
+    assert prefetcher.stats()['download_timeout'] == 2
+    assert all(job.cancelled.is_set() for job in prefetcher.jobs)
+
+def test_timed_out_job_with_waiting_users_keeps_running(prefetcher):
+    submit = prefetcher.submit
+    
+    def submit_attached(video_id, quality):
+        job = submit(video_id, quality)
+        job.attached = 1
+        return job
+    
+    prefetcher.submit = submit_attached
+    prefetcher.run_pass()
+    assert not any(job.cancelled.is_set() for job in prefetcher.jobs)
@@ -0,0 +1,88 @@
+"""/api/stream shares the single-flight key of download jobs"""
+import threading
+
+import pytest
+
+import youtubedl
+
+from conftest import wait_until
+
+class StubStream:
+    """Stands in for StreamPipeline: the first chunk at once, the rest when released"""
+    
+    started = []
+    
+    def __init__(self, format_selector, url):
+        self.release = threading.Event()
+        self.closed = False
+        self.chunks = [b'x' * 8192 for _ in range(4)]
+        StubStream.started.append(self)
+    
+    def read(self):
+        if len(self.chunks) < 4:
+            self.release.wait(10)
+        return b'' if self.closed or not self.chunks else self.chunks.pop()
+    
+    def wait(self):
+        return not self.closed
+    
+    def close(self):
+        self.closed = True
+        self.release.set()
+
+@pytest.fixture
+def streams(monkeypatch):
+    StubStream.started = []
+    monkeypatch.setattr(youtubedl, 'StreamPipeline', StubStream)
+    yield StubStream.started
+    for stream in StubStream.started:
+        stream.close()
+
+def test_stream_redirects_while_a_download_is_running(client, pipeline, streams):
+    job = youtubedl._JOBS.submit('dQw4w9WgXcQ', '360p')
+    response = client.get('/api/stream?id=dQw4w9WgXcQ&quality=360p')
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/api/download?id=dQw4w9WgXcQ&quality=360p'
+    assert streams == []
+    pipeline.release.set()
+    assert job.wait(5)
+
+def test_download_during_a_stream_attaches_to_it(client, pipeline, streams):
+    response = client.get('/api/stream?id=dQw4w9WgXcQ&quality=480p', buffered=False)
+    assert response.status_code == 200
+    body = iter(response.response)
+    first_chunk = next(body)
+    
+    queued = client.post('/api/jobs', json={'id': 'dQw4w9WgXcQ', 'quality': '480p'}).get_json()
+    job = youtubedl._JOBS.get(queued['job_id'])
+    assert job.state == 'streaming' and job.attached == 1
+    
+    streams[0].release.set()
+    streamed = first_chunk + b''.join(body)
+    response.close()
+    assert job.wait(5) and not job.error
+    assert pipeline.calls == []
+    with open(job.output_file, 'rb') as f:
+        assert f.read() == streamed
+    assert client.get(f"/api/jobs/{job.id}/file").status_code == 200
+
+def test_aborted_stream_hands_attached_downloads_to_the_queue(client, pipeline, streams):
+    response = client.get('/api/stream?id=dQw4w9WgXcQ&quality=720p', buffered=False)
+    next(iter(response.response))
+    queued = client.post('/api/jobs', json={'id': 'dQw4w9WgXcQ', 'quality': '720p'}).get_json()
+    job = youtubedl._JOBS.get(queued['job_id'])
+    
+    # The client goes away mid-stream; the attached job is downloaded normally
+    response.close()
+    wait_until(lambda: pipeline.calls)
+    pipeline.release.set()
+    assert job.wait(5) and not job.error
+    assert pipeline.calls == [('dQw4w9WgXcQ', '720p')]
+    assert job.encode_path is None and job.output_file.endswith('-720p.mp4')
+
+def test_aborted_stream_without_waiters_frees_the_key(client, pipeline, streams):
+    response = client.get('/api/stream?id=dQw4w9WgXcQ&quality=1080p', buffered=False)
+    next(iter(response.response))
+    response.close()
+    assert ('dQw4w9WgXcQ', '1080p') not in youtubedl._JOBS._active
+    assert pipeline.calls == []
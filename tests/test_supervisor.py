@@ -0,0 +1,184 @@
+"""ToolSupervisor limits, timeouts and cancellation, with stub tool scripts"""
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import youtubedl
+
+from conftest import wait_until
+
+# Starts a grandchild that would outlive it, writes the grandchild's pid, then sleeps
+SLEEPER = '''#!{python}
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+open(sys.argv[1], "w").write(str(child.pid))
+time.sleep(float(sys.argv[2]))
+'''
+
+# Reports the niceness and rlimits it was started with
+PROBE = '''#!{python}
+import os, resource
+print(os.nice(0))
+for name in ("RLIMIT_AS", "RLIMIT_CPU", "RLIMIT_FSIZE"):
+    print(name, *resource.getrlimit(getattr(resource, name)))
+'''
+
+# Exits at once, leaving a grandchild that holds its output open
+ORPHANER = '''#!{python}
+import subprocess, sys
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+open(sys.argv[1], "w").write(str(child.pid))
+'''
+
+def make_tool(directory, name, script):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(script.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A killed but unreaped grandchild is a zombie, which no longer runs
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split(')')[-1].split()[0] != 'Z'
+
+def read_pid(path):
+    wait_until(lambda: os.path.exists(path) and os.path.getsize(path))
+    with open(path) as f:
+        return int(f.read())
+
+@pytest.fixture
+def supervisor():
+    supervisor = youtubedl.ToolSupervisor({'yt-dlp': 2, 'ffmpeg': 1}, {'yt-dlp': 5, 'ffmpeg': 10}, 30)
+    # The sleepers leave a grandchild holding their output; don't wait long for it
+    supervisor.ORPHAN_GRACE = 0.2
+    yield supervisor
+    supervisor.kill_all()
+
+def test_timeout_kills_the_process_group(supervisor, tmp_path):
+    sleeper = make_tool(tmp_path, 'yt-dlp', SLEEPER)
+    pid_file = str(tmp_path / 'grandchild.pid')
+    began = time.monotonic()
+    result = supervisor.run([sleeper, pid_file, '600'], timeout=0.5)
+    assert result.timed_out and not result.cancelled
+    assert time.monotonic() - began < 3
+    wait_until(lambda: not pid_alive(read_pid(pid_file)))
+    assert supervisor.counts['timed_out'] == 1
+    assert supervisor.stats()['running'] == {'yt-dlp': 0, 'ffmpeg': 0}
+
+def test_cancel_scope_kills_the_process_group(supervisor, tmp_path):
+    sleeper = make_tool(tmp_path, 'yt-dlp', SLEEPER)
+    pid_file = str(tmp_path / 'grandchild.pid')
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    with youtubedl.cancel_scope(cancel):
+        result = supervisor.run([sleeper, pid_file, '600'], timeout=60)
+    assert result.cancelled and not result.timed_out
+    wait_until(lambda: not pid_alive(read_pid(pid_file)))
+
+def test_cancelled_call_does_not_start(supervisor, tmp_path):
+    sleeper = make_tool(tmp_path, 'yt-dlp', SLEEPER)
+    cancel = threading.Event()
+    cancel.set()
+    result = supervisor.run([sleeper, str(tmp_path / 'never.pid'), '600'], timeout=60, cancel=cancel)
+    assert result.cancelled and result.returncode is None
+    assert supervisor.counts['started'] == 0
+
+def test_orphaned_output_is_killed(supervisor, tmp_path):
+    orphaner = make_tool(tmp_path, 'ffmpeg', ORPHANER)
+    pid_file = str(tmp_path / 'grandchild.pid')
+    result = supervisor.run([orphaner, pid_file], timeout=60)
+    assert result.returncode == 0
+    assert supervisor.counts['orphaned'] == 1
+    wait_until(lambda: not pid_alive(read_pid(pid_file)))
+
+def test_concurrency_limit(supervisor, tmp_path):
+    sleeper = make_tool(tmp_path, 'yt-dlp', SLEEPER)
+    peak = [0]
+    sampling = threading.Event()
+    
+    def sample():
+        while not sampling.is_set():
+            peak[0] = max(peak[0], supervisor.stats()['running']['yt-dlp'])
+            time.sleep(0.005)
+    
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    threads = [threading.Thread(target=supervisor.run, args=([sleeper, str(tmp_path / f"{i}.pid"), '0.2'], 30))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sampling.set()
+    sampler.join()
+    assert peak[0] == 2
+    assert supervisor.counts['started'] == 6
+
+def test_busy_tool_raises_after_queue_timeout(supervisor, tmp_path):
+    sleeper = make_tool(tmp_path, 'ffmpeg', SLEEPER)
+    holder = threading.Thread(target=supervisor.run, args=([sleeper, str(tmp_path / 'held.pid'), '0.5'], 30))
+    holder.start()
+    wait_until(lambda: supervisor.stats()['running']['ffmpeg'] == 1)
+    with pytest.raises(youtubedl.ToolBusy):
+        supervisor.run([sleeper, str(tmp_path / 'busy.pid'), '0'], 30, queue_timeout=0.2)
+    assert supervisor.counts['busy'] == 1
+    holder.join()
+
+def test_capture_separates_output_and_stderr_tail(supervisor, tmp_path):
+    script = make_tool(tmp_path, 'ffprobe', '#!{python}\nimport sys\nprint("{{}}")\nprint("warning", file=sys.stderr)\n')
+    result = supervisor.run([script], 10, capture=True)
+    assert result.returncode == 0
+    assert result.output.strip() == '{}'
+    assert result.tail == 'warning'
+
+def test_children_are_started_without_preexec_fn(supervisor, tmp_path, monkeypatch):
+    calls = []
+    popen = subprocess.Popen
+    
+    def record(args, **kwargs):
+        calls.append((args, kwargs))
+        return popen(args, **kwargs)
+    
+    monkeypatch.setattr(subprocess, 'Popen', record)
+    probe = make_tool(tmp_path, 'ffmpeg', PROBE)
+    result = supervisor.run([probe], 10, capture=True)
+    assert result.returncode == 0
+    (args, kwargs), = calls
+    assert 'preexec_fn' not in kwargs and kwargs['start_new_session']
+    assert args[-1] == probe
+
+@pytest.mark.skipif(not shutil.which('nice'), reason="nice is not installed")
+def test_children_run_niced(supervisor, tmp_path):
+    probe = make_tool(tmp_path, 'ffmpeg', PROBE)
+    result = supervisor.run([probe], 10, capture=True)
+    assert int(result.output.splitlines()[0]) == min(19, os.nice(0) + 10)
+
+@pytest.mark.skipif(not shutil.which('prlimit'), reason="prlimit is not installed")
+def test_children_get_rlimits(supervisor, tmp_path, monkeypatch):
+    monkeypatch.setattr(youtubedl, 'TOOL_MEMORY_LIMIT', 2 * 1024 ** 3)
+    monkeypatch.setattr(youtubedl, 'TOOL_CPU_LIMIT', 120)
+    monkeypatch.setattr(youtubedl, 'TOOL_FILE_SIZE_LIMIT', 10 * 1024 ** 2)
+    probe = make_tool(tmp_path, 'ffmpeg', PROBE)
+    result = supervisor.run([probe], 10, capture=True)
+    limits = dict(line.split(' ', 1) for line in result.output.splitlines()[1:])
+    assert limits == {'RLIMIT_AS': f"{2 * 1024 ** 3} {2 * 1024 ** 3}", 'RLIMIT_CPU': '120 120',
+                      'RLIMIT_FSIZE': f"{10 * 1024 ** 2} {10 * 1024 ** 2}"}
+
+def test_file_size_limit_stops_a_runaway_write(supervisor, tmp_path, monkeypatch):
+    if not shutil.which('prlimit'):
+        pytest.skip("prlimit is not installed")
+    monkeypatch.setattr(youtubedl, 'TOOL_FILE_SIZE_LIMIT', 64 * 1024)
+    writer = make_tool(tmp_path, 'ffmpeg', '#!{python}\nimport sys\nopen(sys.argv[1], "wb").write(b"x" * 1024 * 1024)\n')
+    result = supervisor.run([writer, str(tmp_path / 'big.bin')], 10)
+    assert result.returncode != 0
+    assert os.path.getsize(tmp_path / 'big.bin') <= 64 * 1024
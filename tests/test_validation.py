@@ -0,0 +1,51 @@
+"""Video ids and quality labels are checked before any work is started"""
+import pytest
+
+import youtubedl
+
+@pytest.mark.parametrize('quality, expected', [
+    ('720p', ('video', '720p', 'mp4')),
+    ('audio.opus', ('audio', 'audio', 'opus')),
+    ('subtitles.en.srt', ('subtitles', 'subtitles.en', 'srt')),
+    ('subtitles.pt-BR.vtt', ('subtitles', 'subtitles.pt-BR', 'vtt'))
+])
+def test_parse_quality(quality, expected):
+    assert youtubedl.parse_quality(quality) == expected
+
+@pytest.mark.parametrize('quality', ['foo', '720P', '721p', '2160p', 'p', '', 'audio.wav', 'subtitles.en.txt'])
+def test_parse_quality_rejects_unknown_labels(quality):
+    with pytest.raises(ValueError):
+        youtubedl.parse_quality(quality)
+
+BAD_IDS = ['short', 'dQw4w9WgXcQx', '../../etc/pa', 'dQw4w9WgXc!']
+
+@pytest.mark.parametrize('video_id', BAD_IDS)
+@pytest.mark.parametrize('endpoint', ['/api/info', '/api/download', '/api/stream'])
+def test_get_endpoints_reject_invalid_ids(client, endpoint, video_id):
+    response = client.get(endpoint, query_string={'id': video_id})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid video ID'
+
+@pytest.mark.parametrize('video_id', BAD_IDS)
+def test_job_endpoints_reject_invalid_ids(client, video_id):
+    assert client.post('/api/jobs', json={'id': video_id}).status_code == 400
+    assert client.post('/api/jobs/batch', json={'id': video_id, 'qualities': ['720p']}).status_code == 400
+
+@pytest.mark.parametrize('quality', ['foo', '720P', '2160p'])
+def test_endpoints_reject_unknown_qualities(client, quality):
+    params = {'id': 'dQw4w9WgXcQ', 'quality': quality}
+    assert client.get('/api/download', query_string=params).status_code == 400
+    assert client.get('/api/stream', query_string=params).status_code == 400
+    assert client.post('/api/jobs', json=params).status_code == 400
+    assert client.post('/api/jobs/batch', json={'id': 'dQw4w9WgXcQ', 'qualities': ['720p', quality]}).status_code == 400
+
+def test_rejected_requests_start_no_jobs(client):
+    before = youtubedl._JOBS.stats()
+    client.post('/api/jobs', json={'id': 'bad id', 'quality': '720p'})
+    client.post('/api/jobs', json={'id': 'dQw4w9WgXcQ', 'quality': 'foo'})
+    assert youtubedl._JOBS.stats() == before
+
+def test_stream_redirects_audio_to_download(client):
+    response = client.get('/api/stream', query_string={'id': 'dQw4w9WgXcQ', 'quality': 'audio.m4a'})
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith('/api/download?')
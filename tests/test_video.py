@@ -0,0 +1,70 @@
+"""Remux or transcode decisions for video outputs, with the stub yt-dlp, ffprobe and ffmpeg"""
+import pytest
+
+import youtubedl
+
+def stub_media(path):
+    with open(path, 'rb') as f:
+        fields = f.readline().decode().split()[1:]
+    return dict(field.split('=') for field in fields)
+
+def run_batch(client, video_id, qualities):
+    response = client.post('/api/jobs/batch', json={'id': video_id, 'qualities': qualities})
+    assert response.status_code == 202
+    jobs = [youtubedl._JOBS.get(job['job_id']) for job in response.get_json()['jobs']]
+    assert all(job.wait(20) for job in jobs)
+    return {job.quality: job for job in jobs}
+
+@pytest.mark.parametrize('video_id, quality, size', [
+    # Vertical 1080p is 1080 wide
+    ('Vertical916', '1080p', ('1080', '1920')),
+    # 1920x800 is offered as 720p
+    ('Cinema21x9A', '720p', ('1920', '800'))
+])
+def test_h264_source_at_its_rung_is_remuxed(client, video_id, quality, size):
+    response = client.post('/api/jobs', json={'id': video_id, 'quality': quality})
+    job = youtubedl._JOBS.get(response.get_json()['job_id'])
+    assert job.wait(20)
+    assert job.error is None and job.encode_path == 'remux'
+    media = stub_media(job.output_file)
+    assert (media['width'], media['height']) == size and media['video'] == 'h264'
+
+def test_renditions_scale_the_short_side(client):
+    jobs = run_batch(client, 'Vertical916', ['360p', '480p', '720p'])
+    assert {quality: job.encode_path for quality, job in jobs.items()} == {
+        '360p': 'transcode', '480p': 'transcode', '720p': 'remux'}
+    sizes = {quality: (stub_media(job.output_file)['width'], stub_media(job.output_file)['height'])
+             for quality, job in jobs.items()}
+    assert sizes == {'360p': ('360', '640'), '480p': ('480', '854'), '720p': ('720', '1280')}
+    for job in jobs.values():
+        fmt = {key: int(value) for key, value in stub_media(job.output_file).items() if key in ('width', 'height')}
+        assert f"{youtubedl.format_rung(fmt)}p" == job.quality
+
+@pytest.mark.parametrize('width, height, target, size', [
+    (1080, 1920, '480', (480, 854)),
+    (1920, 800, '480', (1152, 480)),
+    (2560, 1440, '1080', (1920, 1080)),
+    # Never upscaled
+    (640, 360, '720', (640, 360))
+])
+def test_transcode_scales_the_short_side(tmp_path, width, height, target, size):
+    source = tmp_path / 'source.webm'
+    source.write_bytes(f"STUBMEDIA video=vp9 width={width} height={height} audio=opus\n".encode().ljust(40000, b'\0'))
+    media = youtubedl.probe_media(str(source))
+    assert youtubedl.choose_encode_path(media, target) == 'transcode'
+    output = tmp_path / 'output.mp4'
+    assert youtubedl.convert_to_mp4(str(source), str(output), target)
+    media = youtubedl.probe_media(str(output))
+    assert (media['width'], media['height']) == size and media['video_codec'] == 'h264'
+
+@pytest.mark.parametrize('width, height, target, path', [
+    (1080, 1920, '1080', 'remux'),
+    (1920, 800, '720', 'remux'),
+    (1920, 800, '480', 'transcode'),
+    (1920, 1080, '720', 'transcode'),
+    (2560, 1440, '1080', 'transcode'),
+    (256, 144, '360', 'remux')
+])
+def test_encode_path_compares_the_short_side(width, height, target, path):
+    media = {'video_codec': 'h264', 'audio_codec': 'aac', 'width': width, 'height': height}
+    assert youtubedl.choose_encode_path(media, target) == path
@@ -1,45 +1,641 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, send_file, jsonify, redirect
+from flask import Flask, request, send_file, jsonify, redirect, Response, stream_with_context, g, make_response
+from werkzeug.security import safe_join
 import os
 import logging
+import logging.handlers
 import sys
 import subprocess
 import time
 import json
 import urllib.request
+import urllib.parse
 import re
 import signal
 import shutil
 import tempfile
+import threading
+import queue
+import hashlib
+import sqlite3
+import uuid
+import random
+import atexit
+import contextvars
+import importlib
+import functools
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, filename='/var/log/youtubedl.log', filemode='a')
+# Imported on first use by load_yt_dlp(): the module takes a few hundred
+# milliseconds to import and only the in-process engine needs it
+yt_dlp = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# When module setup began, and how long until create_app() had the app ready
+_STARTUP = {'began': time.monotonic()}
+
+# Logging: records are queued by the calling thread and written by a
+# background listener, as one JSON object per line ("json") or plain text
+LOG_FILE = os.environ.get('YOUTUBEDL_LOG_FILE', '/var/log/youtubedl.log')
+LOG_FORMAT = os.environ.get('YOUTUBEDL_LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('YOUTUBEDL_LOG_LEVEL', 'INFO').upper()
+# Rotate the log file at this size, keeping LOG_BACKUPS old files
+LOG_MAX_BYTES = int(os.environ.get('YOUTUBEDL_LOG_MAX_BYTES', str(20 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get('YOUTUBEDL_LOG_BACKUPS', '5'))
+# Records waiting for the writer; further records are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.environ.get('YOUTUBEDL_LOG_QUEUE_SIZE', '10000'))
+# Characters of child-process stderr kept in a log record (the end of it)
+LOG_STDERR_TAIL = int(os.environ.get('YOUTUBEDL_LOG_STDERR_TAIL', '2000'))
+# Requests slower than this (seconds) are logged at INFO, the rest at DEBUG
+LOG_SLOW_REQUEST = float(os.environ.get('YOUTUBEDL_LOG_SLOW_REQUEST', '1.0'))
+
+# Request and job ids attached to every record logged under them
+_LOG_CONTEXT = contextvars.ContextVar('youtubedl_log_context', default={})
+
+@contextmanager
+def log_context(**fields):
+    """Attach fields (request_id, job_id, ...) to records logged inside the block"""
+    token = _LOG_CONTEXT.set({**_LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _LOG_CONTEXT.reset(token)
+
+def stderr_tail(text, limit=None):
+    """The end of a child process's output, short enough for one log record"""
+    limit = LOG_STDERR_TAIL if limit is None else limit
+    text = (text or '').strip()
+    if len(text) <= limit:
+        return text
+    return f"[{len(text) - limit} chars truncated] ..." + text[-limit:]
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with its context and extra= fields"""
+    
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class ContextLogFormatter(logging.Formatter):
+    """Plain-text records with the request/job ids appended"""
+    
+    def format(self, record):
+        line = super().format(record)
+        context = ' '.join(f"{key}={getattr(record, key)}" for key in ('request_id', 'job_id')
+                           if hasattr(record, key))
+        return f"{line} [{context}]" if context else line
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without ever blocking the caller
+
+    The record is stamped with the current log context here, in the
+    calling thread, because the listener thread does not share it.
+    """
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        for key, value in _LOG_CONTEXT.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return super().prepare(record)
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Size-rotated log file that several worker processes can append to
+
+    Rotation is done under an flock on a sidecar lock file, and a process
+    whose file was rotated away by another one reopens the new file.
+    """
+    
+    def shouldRollover(self, record):
+        if self.stream is not None:
+            try:
+                if os.fstat(self.stream.fileno()).st_ino != os.stat(self.baseFilename).st_ino:
+                    self.stream.close()
+                    self.stream = self._open()
+            except OSError:
+                self.stream.close()
+                self.stream = self._open()
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        if fcntl is None:
+            return super().doRollover()
+        with open(self.baseFilename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another worker may have rotated while this one waited
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) < self.maxBytes:
+                if self.stream:
+                    self.stream.close()
+                self.stream = self._open()
+                return
+            super().doRollover()
+
+class LogPipeline:
+    """The queue handler on the root logger and the thread writing its records"""
+    
+    def __init__(self):
+        self.handler = None
+        self.target = None
+        self.listener = None
+        self.pid = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Install the handlers, or restart the writer thread after a fork"""
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            if self.handler is None:
+                try:
+                    target = SharedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                                       backupCount=LOG_BACKUPS, delay=True)
+                except OSError:
+                    target = logging.StreamHandler()
+                target.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else
+                                    ContextLogFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+                self.handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+                self.target = target
+                root = logging.getLogger()
+                root.addHandler(self.handler)
+                root.setLevel(LOG_LEVEL)
+            else:
+                # Threads do not survive fork, and the inherited queue may
+                # hold the parent's records or a lock taken mid-put
+                self.handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self.listener = logging.handlers.QueueListener(self.handler.queue, self.target,
+                                                          respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+    
+    def stop(self):
+        """Write out queued records and stop the writer thread"""
+        with self._lock:
+            if self.listener and self.pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+            self.pid = None
+    
+    def stats(self):
+        return {
+            'file': LOG_FILE,
+            'format': LOG_FORMAT,
+            'queued': self.handler.queue.qsize() if self.handler else 0,
+            'dropped': self.handler.dropped if self.handler else 0
+        }
+
+_LOGGING = LogPipeline()
+atexit.register(_LOGGING.stop)
 logger = logging.getLogger('youtubedl')
 
 # Set the port
-PORT = 6776
+PORT = int(os.environ.get('YOUTUBEDL_PORT', '6776'))
+
+# Server mode: "gunicorn" (threaded production workers) or "dev" (Flask
+# development server); gunicorn falls back to dev if it is not installed
+SERVER = os.environ.get('YOUTUBEDL_SERVER', 'gunicorn')
+SERVER_WORKERS = int(os.environ.get('YOUTUBEDL_SERVER_WORKERS', '1'))
+SERVER_THREADS = int(os.environ.get('YOUTUBEDL_SERVER_THREADS', '16'))
+# Seconds a stopping worker waits for in-flight downloads to finish
+DRAIN_TIMEOUT = int(os.environ.get('YOUTUBEDL_DRAIN_TIMEOUT', '900'))
+# Extra seconds gunicorn gives a stopping worker on top of DRAIN_TIMEOUT, so
+# the drain and the rest of its shutdown finish before it is killed
+DRAIN_MARGIN = 30
+# File the server's (gunicorn master's) PID is written to, for service scripts
+PID_FILE = os.environ.get('YOUTUBEDL_PID_FILE', '')
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 HOME_DIR = os.path.expanduser("~")
 FFMPEG_PATH = os.path.join(HOME_DIR, "ffmpeg")
-YT_DLP_PATH = os.path.join(BASE_DIR, "venv/bin/yt-dlp")
+# Directories searched for ffmpeg when it is not on PATH
+FFMPEG_SEARCH_PATH = os.environ.get('YOUTUBEDL_FFMPEG_SEARCH_PATH', os.pathsep.join([
+    FFMPEG_PATH, "/usr/bin", "/usr/local/bin", "/var/services/homes/user/.local/bin"]))
+# Dev server only: kill whatever holds PORT before binding it
+FREE_PORT = os.environ.get('YOUTUBEDL_FREE_PORT', '0') == '1'
+YT_DLP_PATH = os.environ.get('YOUTUBEDL_YT_DLP_PATH', os.path.join(BASE_DIR, "venv/bin/yt-dlp"))
+
+# Extraction engine: "subprocess" runs the yt-dlp executable for every call,
+# "inprocess" reuses warm yt_dlp.YoutubeDL objects from a bounded pool
+ENGINE = os.environ.get('YOUTUBEDL_ENGINE', 'subprocess')
+YDL_POOL_SIZE = int(os.environ.get('YOUTUBEDL_POOL_SIZE', '4'))
+
+# Video metadata cache shared by /api/info and /api/download
+METADATA_CACHE_SIZE = int(os.environ.get('YOUTUBEDL_METADATA_CACHE_SIZE', '256'))
+METADATA_CACHE_TTL = int(os.environ.get('YOUTUBEDL_METADATA_CACHE_TTL', '3600'))
+# Optional JSON file that lets the metadata cache survive restarts
+METADATA_CACHE_FILE = os.environ.get('YOUTUBEDL_METADATA_CACHE_FILE', '')
+
+# Download job queue: total worker threads, plus separate limits for the
+# network download and CPU transcode stages inside those workers
+JOB_WORKERS = int(os.environ.get('YOUTUBEDL_JOB_WORKERS', '4'))
+JOB_DOWNLOAD_CONCURRENCY = int(os.environ.get('YOUTUBEDL_DOWNLOAD_CONCURRENCY', '2'))
+JOB_TRANSCODE_CONCURRENCY = int(os.environ.get('YOUTUBEDL_TRANSCODE_CONCURRENCY',
+                                               str(max(1, (os.cpu_count() or 2) // 2))))
+# Playlist/channel ingestion: entries downloaded at once per ingest, job
+# starts per second (and burst) allowed per host, attempts per entry,
+# backoff after failures, and the most entries taken from one playlist
+INGEST_CONCURRENCY = int(os.environ.get('YOUTUBEDL_INGEST_CONCURRENCY', '2'))
+INGEST_RATE = float(os.environ.get('YOUTUBEDL_INGEST_RATE', '0.5'))
+INGEST_BURST = int(os.environ.get('YOUTUBEDL_INGEST_BURST', '2'))
+INGEST_ATTEMPTS = int(os.environ.get('YOUTUBEDL_INGEST_ATTEMPTS', '3'))
+INGEST_BACKOFF = float(os.environ.get('YOUTUBEDL_INGEST_BACKOFF', '10'))
+INGEST_BACKOFF_MAX = float(os.environ.get('YOUTUBEDL_INGEST_BACKOFF_MAX', '600'))
+INGEST_MAX_ENTRIES = int(os.environ.get('YOUTUBEDL_INGEST_MAX_ENTRIES', '500'))
+# Encode profile used for transcodes (see ENCODE_PROFILES), an optional JSON
+# file with extra or overriding profiles, and the number of CPU threads all
+# concurrent transcodes may use together
+ENCODE_PROFILE = os.environ.get('YOUTUBEDL_ENCODE_PROFILE', 'balanced')
+ENCODE_PROFILES_FILE = os.environ.get('YOUTUBEDL_ENCODE_PROFILES_FILE', '')
+ENCODE_CPU_BUDGET = int(os.environ.get('YOUTUBEDL_ENCODE_CPU_BUDGET', str(os.cpu_count() or 2)))
+# Seconds a finished job (and its status) stays queryable
+JOB_RETENTION = int(os.environ.get('YOUTUBEDL_JOB_RETENTION', '3600'))
+# Seconds /api/download waits for its job before telling the client to
+# retry (a retry attaches to the same job, so no work is lost)
+DOWNLOAD_WAIT_TIMEOUT = int(os.environ.get('YOUTUBEDL_DOWNLOAD_WAIT_TIMEOUT', '1800'))
+# Seconds between keep-alive comments on idle progress event streams
+SSE_KEEPALIVE = 15
+
+# Pipe-mode streams (/api/stream) running at once, and how long one may
+# take to produce its first byte
+STREAM_CONCURRENCY = int(os.environ.get('YOUTUBEDL_STREAM_CONCURRENCY', '4'))
+STREAM_FIRST_BYTE_TIMEOUT = int(os.environ.get('YOUTUBEDL_STREAM_FIRST_BYTE_TIMEOUT', '60'))
+# Child processes allowed to run at once per tool, over every request, job
+# and stream; a call waits up to TOOL_QUEUE_TIMEOUT seconds for a slot
+TOOL_CONCURRENCY = {
+    'yt-dlp': int(os.environ.get('YOUTUBEDL_MAX_YT_DLP', '8')),
+    'ffmpeg': int(os.environ.get('YOUTUBEDL_MAX_FFMPEG', str(max(4, os.cpu_count() or 2)))),
+    'ffprobe': int(os.environ.get('YOUTUBEDL_MAX_FFPROBE', '8'))
+}
+TOOL_QUEUE_TIMEOUT = int(os.environ.get('YOUTUBEDL_TOOL_QUEUE_TIMEOUT', '600'))
+# Scheduling priority of the children (nice 0-19), an optional ionice class
+# ("idle" or "best-effort"), and rlimits in bytes/seconds (0 means none)
+TOOL_NICE = {
+    'yt-dlp': int(os.environ.get('YOUTUBEDL_YT_DLP_NICE', '5')),
+    'ffmpeg': int(os.environ.get('YOUTUBEDL_FFMPEG_NICE', '10')),
+    'ffprobe': 0
+}
+TOOL_IONICE = os.environ.get('YOUTUBEDL_TOOL_IONICE', '')
+TOOL_MEMORY_LIMIT = int(os.environ.get('YOUTUBEDL_TOOL_MEMORY_LIMIT', '0'))
+TOOL_CPU_LIMIT = int(os.environ.get('YOUTUBEDL_TOOL_CPU_LIMIT', '0'))
+TOOL_FILE_SIZE_LIMIT = int(os.environ.get('YOUTUBEDL_TOOL_FILE_SIZE_LIMIT', '0'))
+
+# Admission control for requests that start yt-dlp/ffmpeg work (/api/info,
+# /api/download, /api/stream, /api/jobs, /api/jobs/batch, /api/playlists
+# and /api/thumb): each client gets ADMISSION_RATE requests per second
+# (bursts of ADMISSION_BURST), at most ADMISSION_MAX_IN_FLIGHT run at once
+# (0 turns admission control off), and the rest wait in per-client queues
+# served round-robin, at most ADMISSION_QUEUE_SIZE in all and
+# ADMISSION_CLIENT_QUEUE_SIZE per client, for up to ADMISSION_QUEUE_TIMEOUT
+# seconds. Clients are told apart by address, or by the first address in
+# ADMISSION_CLIENT_HEADER (e.g. X-Forwarded-For) behind a trusted proxy
+ADMISSION_RATE = float(os.environ.get('YOUTUBEDL_ADMISSION_RATE', '1'))
+ADMISSION_BURST = int(os.environ.get('YOUTUBEDL_ADMISSION_BURST', '10'))
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('YOUTUBEDL_ADMISSION_MAX_IN_FLIGHT', '8'))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('YOUTUBEDL_ADMISSION_QUEUE_SIZE', '32'))
+ADMISSION_CLIENT_QUEUE_SIZE = int(os.environ.get('YOUTUBEDL_ADMISSION_CLIENT_QUEUE_SIZE', '4'))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('YOUTUBEDL_ADMISSION_QUEUE_TIMEOUT', '10'))
+ADMISSION_CLIENT_HEADER = os.environ.get('YOUTUBEDL_ADMISSION_CLIENT_HEADER', '')
 
 # Explicitly set HTML_FILE path to the current directory
 HTML_FILE = os.path.join(BASE_DIR, "youtubedl.html")
 
-# Create directory for downloads
-DOWNLOAD_DIR = os.path.join(BASE_DIR, "downloads")
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+# Directory for downloads, created by create_app()
+DOWNLOAD_DIR = os.environ.get('YOUTUBEDL_DOWNLOAD_DIR', os.path.join(BASE_DIR, "downloads"))
 TEMP_DIR = os.path.join(DOWNLOAD_DIR, "temp")
-os.makedirs(TEMP_DIR, exist_ok=True)
 
-logger.info(f"Starting with BASE_DIR: {BASE_DIR}")
-logger.info(f"HTML file path set to: {HTML_FILE}")
-logger.info(f"Download directory: {DOWNLOAD_DIR}")
-logger.info(f"yt-dlp path: {YT_DLP_PATH}")
+# Work directories of failed or interrupted downloads are kept so a retry can
+# resume them; at startup ones older than WORK_DIR_MAX_AGE seconds are
+# deleted, then the oldest until they fit in WORK_DIR_MAX_BYTES (0 means
+# unlimited), and the rest are queued again if RECOVER_JOBS is on
+WORK_DIR_MAX_AGE = int(os.environ.get('YOUTUBEDL_WORK_DIR_MAX_AGE', '86400'))
+WORK_DIR_MAX_BYTES = int(os.environ.get('YOUTUBEDL_WORK_DIR_MAX_BYTES', '0'))
+RECOVER_JOBS = os.environ.get('YOUTUBEDL_RECOVER_JOBS', '1') == '1'
+
+# Per-process metric snapshots are merged here when several server workers run
+METRICS_DIR = os.environ.get('YOUTUBEDL_METRICS_DIR', os.path.join(DOWNLOAD_DIR, ".metrics"))
+METRICS_FLUSH_INTERVAL = 5
+
+# Download cache index (SQLite) and its size quota in bytes; 0 means unlimited
+CACHE_INDEX_FILE = os.environ.get('YOUTUBEDL_CACHE_INDEX', '')
+CACHE_MAX_BYTES = int(os.environ.get('YOUTUBEDL_CACHE_MAX_BYTES', '0'))
+
+# Thumbnail cache behind /api/thumb: directory, size quota in bytes, the
+# widths variants are made in (and the default one), and the Cache-Control
+# max-age sent to browsers. Thumbnails of downloaded files are made from a
+# video frame at startup when THUMB_PREGENERATE is on
+THUMB_DIR = os.environ.get('YOUTUBEDL_THUMB_DIR', os.path.join(DOWNLOAD_DIR, '.thumbs'))
+THUMB_MAX_BYTES = int(os.environ.get('YOUTUBEDL_THUMB_MAX_BYTES', str(200 * 1024 * 1024)))
+THUMB_WIDTHS = tuple(sorted(int(w) for w in os.environ.get('YOUTUBEDL_THUMB_WIDTHS', '160,320,480').split(',')))
+THUMB_DEFAULT_WIDTH = int(os.environ.get('YOUTUBEDL_THUMB_DEFAULT_WIDTH', '480'))
+THUMB_MAX_AGE = int(os.environ.get('YOUTUBEDL_THUMB_MAX_AGE', str(7 * 86400)))
+THUMB_PREGENERATE = os.environ.get('YOUTUBEDL_THUMB_PREGENERATE', '1') == '1'
+
+# Background prefetch into the caches during an off-peak window such as
+# "01:00-06:00" (local time; empty turns it off). Candidates are the
+# entries of PREFETCH_WATCHLIST ("<video id or URL> [quality ...]" per line)
+# and the PREFETCH_TOP most requested videos and qualities whose request
+# count, halving every PREFETCH_HISTORY_HALF_LIFE seconds, is at least
+# PREFETCH_MIN_REQUESTS. A pass runs every PREFETCH_INTERVAL seconds in the
+# window and refreshes metadata expiring within PREFETCH_REFRESH_AHEAD
+# seconds. Downloads run one at a time, wait while the load average per CPU
+# is over PREFETCH_CPU_BUDGET, are limited to PREFETCH_RATE_LIMIT bytes per
+# second and PREFETCH_MAX_BYTES per pass (0 means unlimited), and may fill
+# the download cache to PREFETCH_CACHE_SHARE of its quota. A pass waits up to
+# PREFETCH_JOB_TIMEOUT seconds for each download before moving on
+PREFETCH_WINDOW = os.environ.get('YOUTUBEDL_PREFETCH_WINDOW', '')
+PREFETCH_WATCHLIST = os.environ.get('YOUTUBEDL_PREFETCH_WATCHLIST', '')
+PREFETCH_TOP = int(os.environ.get('YOUTUBEDL_PREFETCH_TOP', '20'))
+PREFETCH_MIN_REQUESTS = float(os.environ.get('YOUTUBEDL_PREFETCH_MIN_REQUESTS', '2'))
+PREFETCH_HISTORY_HALF_LIFE = int(os.environ.get('YOUTUBEDL_PREFETCH_HISTORY_HALF_LIFE', str(3 * 86400)))
+PREFETCH_INTERVAL = int(os.environ.get('YOUTUBEDL_PREFETCH_INTERVAL', '1800'))
+PREFETCH_REFRESH_AHEAD = int(os.environ.get('YOUTUBEDL_PREFETCH_REFRESH_AHEAD', '900'))
+PREFETCH_CPU_BUDGET = float(os.environ.get('YOUTUBEDL_PREFETCH_CPU_BUDGET', '0.5'))
+PREFETCH_RATE_LIMIT = int(os.environ.get('YOUTUBEDL_PREFETCH_RATE_LIMIT', '0'))
+PREFETCH_MAX_BYTES = int(os.environ.get('YOUTUBEDL_PREFETCH_MAX_BYTES', '0'))
+PREFETCH_CACHE_SHARE = float(os.environ.get('YOUTUBEDL_PREFETCH_CACHE_SHARE', '0.9'))
+PREFETCH_JOB_TIMEOUT = int(os.environ.get('YOUTUBEDL_PREFETCH_JOB_TIMEOUT', '3600'))
+
+# Job records shared by all server worker processes (SQLite)
+JOB_STORE_FILE = os.environ.get('YOUTUBEDL_JOB_STORE', '')
+
+# Hand file delivery to a fronting web server: "" (serve from Python),
+# "x-sendfile" (Apache/lighttpd) or "x-accel-redirect" (nginx)
+FILE_OFFLOAD = os.environ.get('YOUTUBEDL_FILE_OFFLOAD', '').lower()
+# nginx "internal" location that maps onto DOWNLOAD_DIR
+ACCEL_REDIRECT_PREFIX = os.environ.get('YOUTUBEDL_ACCEL_REDIRECT_PREFIX', '/protected-downloads/')
 
 app = Flask(__name__)
+app.config['USE_X_SENDFILE'] = FILE_OFFLOAD in ('x-sendfile', 'x-accel-redirect')
+
+# Client-supplied ids are kept so logs can be matched with a proxy's
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+@app.before_request
+def start_request_log():
+    request_id = request.headers.get('X-Request-ID', '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    g.request_id = request_id
+    g.request_started = time.perf_counter()
+    g.log_token = _LOG_CONTEXT.set({**_LOG_CONTEXT.get(), 'request_id': request_id})
+
+@app.after_request
+def finish_request_log(response):
+    request_id = g.get('request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+        duration = time.perf_counter() - g.request_started
+        level = logging.INFO if duration >= LOG_SLOW_REQUEST or response.status_code >= 500 else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(level, f"{request.method} {request.path} {response.status_code} in {duration * 1000:.1f} ms",
+                       extra={'method': request.method, 'path': request.path, 'status': response.status_code,
+                              'durations': {'handler': round(duration, 4)}})
+    return response
+
+@app.teardown_request
+def end_request_log(exc):
+    token = g.pop('log_token', None)
+    if token is not None:
+        try:
+            _LOG_CONTEXT.reset(token)
+        except ValueError:
+            # Streamed responses finish in a different context
+            _LOG_CONTEXT.set({})
+
+class Overloaded(Exception):
+    """A request refused by admission control, with its HTTP status and Retry-After seconds"""
+    
+    def __init__(self, message, status, retry_after, reason):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+class AdmissionControl:
+    """Per-client token buckets and a fair-share queue in front of heavy requests
+
+    A client without a token is refused at once with 429. Otherwise the
+    request runs if fewer than max_in_flight admitted requests are running,
+    or waits in its client's queue. A finishing request hands its slot to
+    the next client in round-robin order, so a client with many queued
+    requests gets the same share as one with a single request. Requests
+    that find the queues full, or wait longer than queue_timeout, get 503.
+    State is per process: each server worker applies the limits on its own.
+    """
+    
+    # Estimated seconds per slot hand-over start out at this, then follow the
+    # measured hold times
+    INITIAL_HOLD = 1.0
+    MAX_RETRY_AFTER = 60
+    IDLE_CLIENT_SECONDS = 600
+    
+    def __init__(self, rate, burst, max_in_flight, queue_size, client_queue_size, queue_timeout):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.client_queue_size = client_queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = {}
+        self._hold = self.INITIAL_HOLD
+        self._buckets = {}
+        # client -> deque of waiting events; the order is the round-robin order
+        self._waiting = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.max_in_flight > 0
+    
+    def _take_token(self, client, now):
+        # Called with the lock held; returns the seconds until a token if there is none
+        tokens, updated = self._buckets.get(client, (float(self.burst), now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate if self.rate > 0 else self.MAX_RETRY_AFTER
+        self._buckets[client] = (tokens - 1, now)
+        if len(self._buckets) > 10000:
+            # Forget clients whose buckets have long been full again
+            for key in [key for key, (_, at) in self._buckets.items() if now - at > self.IDLE_CLIENT_SECONDS]:
+                del self._buckets[key]
+        return 0
+    
+    def _refund_token(self, client):
+        # Called with the lock held
+        tokens, updated = self._buckets[client]
+        self._buckets[client] = (min(self.burst, tokens + 1), updated)
+    
+    def _retry_after(self, ahead):
+        # Called with the lock held: rough time until `ahead` queued requests have run
+        seconds = self._hold * (ahead + 1) / max(1, self.max_in_flight)
+        return max(1, min(self.MAX_RETRY_AFTER, math.ceil(seconds)))
+    
+    def _reject(self, endpoint, reason, status, retry_after, message):
+        # Called with the lock held
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        _METRICS.inc('youtubedl_admission_rejections_total', endpoint=endpoint, reason=reason)
+        return Overloaded(message, status, retry_after, reason)
+    
+    def acquire(self, client, endpoint):
+        """Wait for a slot for client; raises Overloaded if the request is refused"""
+        start = time.time()
+        with self._lock:
+            wait = self._take_token(client, start)
+            if wait:
+                raise self._reject(endpoint, 'rate_limited', 429, max(1, math.ceil(wait)),
+                                   'Too many requests from this client, slow down')
+            if self.in_flight < self.max_in_flight and not self._waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                _METRICS.observe('youtubedl_admission_wait_seconds', 0, endpoint=endpoint)
+                return start
+            waiters = self._waiting.get(client)
+            if self.queued >= self.queue_size or (waiters and len(waiters) >= self.client_queue_size):
+                self._refund_token(client)
+                raise self._reject(endpoint, 'queue_full', 503, self._retry_after(self.queued),
+                                   'The server is busy, try again later')
+            event = threading.Event()
+            if waiters is None:
+                waiters = self._waiting[client] = deque()
+            waiters.append(event)
+            self.queued += 1
+        
+        granted = event.wait(self.queue_timeout)
+        with self._lock:
+            if not granted and not event.is_set():
+                waiters.remove(event)
+                if not waiters and self._waiting.get(client) is waiters:
+                    del self._waiting[client]
+                self.queued -= 1
+                self._refund_token(client)
+                raise self._reject(endpoint, 'queue_timeout', 503, self._retry_after(self.queued),
+                                   'The server is busy, try again later')
+            self.admitted += 1
+        admitted = time.time()
+        _METRICS.observe('youtubedl_admission_wait_seconds', admitted - start, endpoint=endpoint)
+        return admitted
+    
+    def release(self, admitted):
+        """Hand the slot taken at time admitted to the next waiting client, or free it"""
+        with self._lock:
+            self._hold = 0.8 * self._hold + 0.2 * (time.time() - admitted)
+            if not self._waiting:
+                self.in_flight -= 1
+                return
+            client, waiters = next(iter(self._waiting.items()))
+            event = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(client)
+            else:
+                del self._waiting[client]
+            self.queued -= 1
+            event.set()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'rate': self.rate,
+                'burst': self.burst,
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'queued_clients': len(self._waiting),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'hold_seconds': round(self._hold, 3)
+            }
+
+_ADMISSION = AdmissionControl(ADMISSION_RATE, ADMISSION_BURST, ADMISSION_MAX_IN_FLIGHT, ADMISSION_QUEUE_SIZE,
+                              ADMISSION_CLIENT_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+def client_address():
+    """The address admission control keys the current request's client by"""
+    if ADMISSION_CLIENT_HEADER:
+        forwarded = request.headers.get(ADMISSION_CLIENT_HEADER, '').split(',')[0].strip()
+        if forwarded:
+            return forwarded
+    return request.remote_addr or 'unknown'
+
+def release_admission():
+    """Give back the current request's admission slot before the view returns
+
+    For views that hand their work to the job queue, whose own slots then
+    bound it, and only wait for the result.
+    """
+    admitted = g.pop('admitted', None)
+    if admitted is not None:
+        _ADMISSION.release(admitted)
+
+def admission_controlled(endpoint, is_cheap, refused=None):
+    """Run a view under admission control unless is_cheap() says it needs no tool work
+
+    The slot is held until the view returns, or until a streamed response
+    is closed, since its work runs while the body is sent. A refused request
+    gets a JSON error, or what refused(error) returns.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _ADMISSION.enabled or is_cheap():
+                return view(*args, **kwargs)
+            try:
+                g.admitted = _ADMISSION.acquire(client_address(), endpoint)
+            except Overloaded as e:
+                if refused:
+                    return refused(e)
+                return jsonify({'error': str(e), 'reason': e.reason}), e.status, {'Retry-After': str(e.retry_after)}
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                release_admission()
+                raise
+            admitted = g.pop('admitted', None)
+            if admitted is not None:
+                if response.is_streamed:
+                    response.call_on_close(lambda: _ADMISSION.release(admitted))
+                else:
+                    _ADMISSION.release(admitted)
+            return response
+        return wrapper
+    return decorator
 
 @app.route('/')
 def index():
@@ -62,415 +658,4610 @@ def index():
         logger.error(f"Failed to serve HTML: {str(e)}")
         return f"Error: {str(e)}", 500
 
-def get_available_formats(video_id):
-    """Get available video formats using yt-dlp"""
+# Standard quality ladder offered in the UI (heights in pixels)
+STANDARD_HEIGHTS = [360, 480, 720, 1080]
+VIDEO_QUALITIES = [f"{height}p" for height in STANDARD_HEIGHTS]
+
+# YouTube video ids: 11 characters of the URL-safe base64 alphabet
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+# Audio-only outputs by extension: the yt-dlp selector, the codec that is
+# stream-copied when the source already has it (ffprobe name, yt-dlp
+# acodec prefix), and the encoder settings used otherwise
+AUDIO_OUTPUTS = {
+    'm4a': {'selector': "bestaudio[ext=m4a]/bestaudio/best", 'codec': 'aac', 'acodec': 'mp4a',
+            'encode': ["-c:a", "aac", "-b:a", "192k"], 'bitrate': 192},
+    'opus': {'selector': "bestaudio[acodec=opus]/bestaudio/best", 'codec': 'opus', 'acodec': 'opus',
+             'encode': ["-c:a", "libopus", "-b:a", "128k"], 'bitrate': 128},
+    'mp3': {'selector': "bestaudio/best", 'codec': 'mp3', 'acodec': 'mp3',
+            'encode': ["-c:a", "libmp3lame", "-q:a", "2"], 'bitrate': 190}
+}
+SUBTITLE_FORMATS = ('vtt', 'srt')
+SUBTITLE_LANG_RE = re.compile(r'^[A-Za-z]{2,3}(-[A-Za-z0-9]{1,8})*$')
+OUTPUT_MIMETYPES = {'mp4': 'video/mp4', 'm4a': 'audio/mp4', 'opus': 'audio/ogg', 'mp3': 'audio/mpeg',
+                    'vtt': 'text/vtt', 'srt': 'application/x-subrip'}
+
+def parse_quality(quality):
+    """Split a quality label into (kind, cache quality, file extension)
+
+    "720p" is an MP4 video, "audio.opus" an audio-only file and
+    "subtitles.en.srt" a subtitle track. Audio and subtitles are cached
+    under the quality "audio" or "subtitles.en" with the format as
+    extension. Raises ValueError for labels it does not know, including
+    video heights outside the ladder.
+    """
+    if quality.startswith('audio.'):
+        ext = quality[len('audio.'):]
+        if ext in AUDIO_OUTPUTS:
+            return 'audio', 'audio', ext
+    elif quality.startswith('subtitles.'):
+        lang, _, ext = quality[len('subtitles.'):].rpartition('.')
+        if ext in SUBTITLE_FORMATS and SUBTITLE_LANG_RE.match(lang):
+            return 'subtitles', f"subtitles.{lang}", ext
+    elif quality in VIDEO_QUALITIES:
+        return 'video', quality, 'mp4'
+    raise ValueError(f"Unknown output format: {quality}")
+
+def output_cached(video_id, quality):
+    """Whether the file for a quality label is in the download cache"""
+    _, cache_quality, ext = parse_quality(quality)
+    return _DOWNLOAD_CACHE.contains(video_id, cache_quality, ext)
+
+def format_short_side(fmt):
+    """Shorter side of a video format: the height, or the width of vertical video"""
+    return min(fmt.get('width') or fmt['height'], fmt['height'])
+
+def format_rung(fmt):
+    """Ladder height a video format is offered under: the highest rung at or below its short side
+
+    Non-16:9 sources (1920x800, 1080x1920) are bucketed instead of being
+    matched exactly, so they still get ladder entries. Returns None for
+    formats below the lowest rung or above the highest one.
+    """
+    short_side = format_short_side(fmt)
+    rungs = [height for height in STANDARD_HEIGHTS if height <= short_side]
+    if not rungs or short_side > STANDARD_HEIGHTS[-1]:
+        return None
+    return rungs[-1]
+
+def within_rung(short_side, height):
+    """Whether a short side is offered under rung height or a lower one (see format_rung)"""
+    above = [h for h in STANDARD_HEIGHTS if h > int(height)]
+    return short_side < above[0] if above else short_side <= int(height)
+
+def rung_boxes(height):
+    """yt-dlp filters matching the formats format_rung() puts at or below rung height
+
+    Landscape formats are filtered on their height and vertical ones on
+    their width, up to the next rung.
+    """
+    above = [h for h in STANDARD_HEIGHTS if h > int(height)]
+    limit = f"<{above[0]}" if above else f"<={height}"
+    return f"[aspect_ratio>=1][height{limit}]", f"[aspect_ratio<1][width{limit}]"
+
+def get_available_formats(video_info):
+    """Build the quality list from the formats array of a yt-dlp -j probe"""
     try:
-        url = f"https://www.youtube.com/watch?v={video_id}"
+        video_formats = []
+        best_audio = None
+        for fmt in video_info.get('formats') or []:
+            vcodec = fmt.get('vcodec') or 'none'
+            acodec = fmt.get('acodec') or 'none'
+            if vcodec == 'none':
+                # Audio-only stream: remember the best one for size estimates
+                if acodec != 'none' and (not best_audio or (fmt.get('abr') or 0) > (best_audio.get('abr') or 0)):
+                    best_audio = fmt
+                continue
+            if fmt.get('height') and format_rung(fmt):
+                video_formats.append(fmt)
         
-        # Run yt-dlp to list formats
-        cmd = [YT_DLP_PATH, "-F", url]
-        logger.info(f"Running yt-dlp format command: {' '.join(cmd)}")
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode != 0:
-            logger.error(f"yt-dlp format error: {result.stderr}")
-            return []
+        audio_size = 0
+        if best_audio:
+            audio_size = best_audio.get('filesize') or best_audio.get('filesize_approx') or 0
         
         formats = []
-        for line in result.stdout.splitlines():
-            # Look for lines that contain resolution
-            if any(res in line for res in ["x360", "x480", "x720", "x1080"]):
-                if "x360" in line:
-                    formats.append({"quality": "360p", "available": True})
-                elif "x480" in line:
-                    formats.append({"quality": "480p", "available": True})
-                elif "x720" in line:
-                    formats.append({"quality": "720p", "available": True})
-                elif "x1080" in line:
-                    formats.append({"quality": "1080p", "available": True})
-        
-        # Remove duplicates while preserving order
-        unique_formats = []
-        seen = set()
-        for fmt in formats:
-            if fmt["quality"] not in seen:
-                seen.add(fmt["quality"])
-                unique_formats.append(fmt)
-        
-        return unique_formats
+        for height in STANDARD_HEIGHTS:
+            candidates = [f for f in video_formats if format_rung(f) == height]
+            if not candidates:
+                continue
+            # Prefer the largest, then the highest bitrate stream in the bucket,
+            # which is what download_format_selector() picks
+            best = max(candidates, key=lambda f: (format_short_side(f), f.get('tbr') or 0, f.get('fps') or 0))
+            video_size = best.get('filesize') or best.get('filesize_approx') or 0
+            has_audio = (best.get('acodec') or 'none') != 'none'
+            filesize = video_size + (0 if has_audio else audio_size) if video_size else 0
+            formats.append({
+                'quality': f"{height}p",
+                'kind': 'video',
+                'available': True,
+                'height': best.get('height'),
+                'width': best.get('width'),
+                'fps': best.get('fps'),
+                'vcodec': best.get('vcodec'),
+                'acodec': best.get('acodec') if has_audio else (best_audio or {}).get('acodec'),
+                'filesize': filesize,
+                'size_formatted': format_size(filesize) if filesize else None
+            })
+        
+        formats.extend(get_audio_formats(video_info))
+        formats.extend(get_subtitle_formats(video_info))
+        return formats
     except Exception as e:
         logger.error(f"Error getting formats: {str(e)}")
         return []
 
+def get_audio_formats(video_info):
+    """Audio-only outputs of a video, noting which ones can be stream-copied"""
+    streams = [f for f in video_info.get('formats') or []
+               if (f.get('vcodec') or 'none') == 'none' and (f.get('acodec') or 'none') != 'none']
+    duration = video_info.get('duration') or 0
+    formats = []
+    for ext, output in AUDIO_OUTPUTS.items():
+        matching = [f for f in streams if f['acodec'].startswith(output['acodec'])]
+        best = max(matching or streams, key=lambda f: f.get('abr') or 0, default=None)
+        if matching:
+            filesize = best.get('filesize') or best.get('filesize_approx') or 0
+        else:
+            # Encoded: estimate from the encoder bitrate
+            filesize = int(duration * output['bitrate'] * 1000 / 8)
+        formats.append({
+            'quality': f"audio.{ext}",
+            'kind': 'audio',
+            'label': f"Audio ({ext.upper()})",
+            'available': bool(streams),
+            'acodec': best.get('acodec') if best else None,
+            'abr': best.get('abr') if best else None,
+            'stream_copy': bool(matching),
+            'filesize': filesize,
+            'size_formatted': format_size(filesize) if filesize else None
+        })
+    return formats
+
+def get_subtitle_formats(video_info):
+    """Subtitle outputs: uploaded subtitles, then original-language automatic captions"""
+    manual = video_info.get('subtitle_langs') or []
+    automatic = [lang for lang in video_info.get('caption_langs') or [] if lang not in manual]
+    formats = []
+    for lang, is_automatic in [(lang, False) for lang in manual] + [(lang, True) for lang in automatic]:
+        if not SUBTITLE_LANG_RE.match(lang):
+            continue
+        for ext in SUBTITLE_FORMATS:
+            formats.append({
+                'quality': f"subtitles.{lang}.{ext}",
+                'kind': 'subtitles',
+                'label': f"{'Captions' if is_automatic else 'Subtitles'} {lang} ({ext.upper()})",
+                'available': True,
+                'language': lang,
+                'automatic': is_automatic
+            })
+    return formats
+
+# Histogram buckets in seconds, from sub-second probes to long downloads
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metrics:
+    """Labelled counters and histograms rendered in the Prometheus text format
+
+    Values live in plain dicts so a process can dump a JSON snapshot of
+    them; with several server workers /metrics sums the snapshots of all
+    live workers. Gauges are not stored here: they are read from shared
+    state at scrape time.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+    
+    def counter(self, name, help_text):
+        self._help[name] = help_text
+        self._counters[name] = {}
+    
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._help[name] = help_text
+        self._histograms[name] = {}
+        self._buckets[name] = buckets
+    
+    @staticmethod
+    def _key(labels):
+        return json.dumps(labels, sort_keys=True)
+    
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms[name]
+            data = series.get(key)
+            if data is None:
+                data = series[key] = {'buckets': [0] * len(self._buckets[name]), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time a block into a histogram; the block may set labels['result']"""
+        labels.setdefault('result', 'ok')
+        start = time.time()
+        try:
+            yield labels
+        except BaseException:
+            labels['result'] = 'error'
+            raise
+        finally:
+            self.observe(name, time.time() - start, **labels)
+    
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps({'counters': self._counters, 'histograms': self._histograms}))
+    
+    def dump(self, directory):
+        """Write this process's snapshot for the other workers to merge"""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+    
+    def merged(self, directory=None):
+        """This process's values plus those dumped by other live workers"""
+        total = self.snapshot()
+        if not directory or not os.path.isdir(directory):
+            return total
+        for filename in os.listdir(directory):
+            pid = filename[:-len('.json')] if filename.endswith('.json') else ''
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not pid_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    other = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, series in other.get('counters', {}).items():
+                mine = total['counters'].setdefault(name, {})
+                for key, value in series.items():
+                    mine[key] = mine.get(key, 0) + value
+            for name, series in other.get('histograms', {}).items():
+                mine = total['histograms'].setdefault(name, {})
+                for key, data in series.items():
+                    if key not in mine:
+                        mine[key] = data
+                        continue
+                    mine[key]['buckets'] = [a + b for a, b in zip(mine[key]['buckets'], data['buckets'])]
+                    mine[key]['sum'] += data['sum']
+                    mine[key]['count'] += data['count']
+        return total
+    
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        pairs = []
+        for key in sorted(labels):
+            value = str(labels[key]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+    
+    def render(self, snapshot, gauges):
+        """Prometheus text exposition of a snapshot plus (name, help, samples) gauges"""
+        lines = []
+        for name, series in snapshot['counters'].items():
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{self._labels(json.loads(key))} {value}")
+        for name, series in snapshot['histograms'].items():
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, data in sorted(series.items()):
+                labels = json.loads(key)
+                for bound, count in zip(self._buckets[name], data['buckets']):
+                    lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {data['count']}")
+                lines.append(f"{name}_sum{self._labels(labels)} {round(data['sum'], 6)}")
+                lines.append(f"{name}_count{self._labels(labels)} {data['count']}")
+        for name, help_text, samples in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+_METRICS = Metrics()
+_METRICS.histogram('youtubedl_info_probe_seconds', 'yt-dlp metadata probes by engine and result')
+_METRICS.histogram('youtubedl_download_seconds', 'yt-dlp downloads by engine and result')
+_METRICS.histogram('youtubedl_transcode_seconds', 'ffmpeg conversions by kind (transcode, remux, renditions) and result')
+_METRICS.histogram('youtubedl_serve_seconds', 'Time to prepare a file response, by delivery mode')
+_METRICS.histogram('youtubedl_job_queue_wait_seconds', 'Time download jobs waited for a worker')
+_METRICS.counter('youtubedl_jobs_total', 'Finished download jobs by result and encode path')
+_METRICS.counter('youtubedl_cache_lookups_total', 'Download cache lookups by result')
+_METRICS.counter('youtubedl_metadata_cache_lookups_total', 'Video metadata cache lookups by result')
+_METRICS.counter('youtubedl_downloaded_bytes_total', 'Bytes fetched by yt-dlp, excluding resumed bytes')
+_METRICS.counter('youtubedl_served_bytes_total', 'Bytes of media sent to clients, by delivery mode')
+_METRICS.counter('youtubedl_thumbnail_requests_total', 'Thumbnail requests by result (hit, made, upstream)')
+_METRICS.counter('youtubedl_subprocess_exits_total', 'Exit codes of yt-dlp, ffmpeg and ffprobe runs')
+_METRICS.histogram('youtubedl_admission_wait_seconds', 'Time admitted /api/info and /api/download requests queued')
+_METRICS.counter('youtubedl_admission_rejections_total',
+                 'Requests refused by admission control, by endpoint and reason (rate_limited, queue_full, queue_timeout)')
+_METRICS.counter('youtubedl_prefetch_total',
+                 'Prefetcher work by kind (metadata, download) and result (refreshed, fresh, done, cached, over_budget, error)')
+_METRICS.counter('youtubedl_subprocess_kills_total',
+                 'Child processes killed by the supervisor, or refused a slot, by tool and reason')
+
+def count_exit(cmd, returncode):
+    """Count a finished subprocess by tool name and exit code"""
+    _METRICS.inc('youtubedl_subprocess_exits_total', tool=os.path.basename(cmd[0]), code=str(returncode))
+
+class ToolBusy(Exception):
+    """No slot for another child process of a tool became free in time"""
+
+# Event that cancels the child processes started under it (see cancel_scope)
+_CANCEL = contextvars.ContextVar('youtubedl_cancel', default=None)
+# Download speed limit in bytes per second for jobs queued from this context
+# (0 is unlimited); each new job takes it as its Throttle
+_RATE_LIMIT = contextvars.ContextVar('youtubedl_rate_limit', default=0)
+# Throttle of the job whose yt-dlp runs happen in this context
+_THROTTLE = contextvars.ContextVar('youtubedl_throttle', default=None)
+
+class Throttle:
+    """Download speed limit of a job, lifted once a request without one waits on it"""
+    
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.lifted = threading.Event()
+    
+    def lift(self):
+        """Drop the limit; False if there was none"""
+        if not self.limit:
+            return False
+        self.limit = 0
+        self.lifted.set()
+        return True
+
+class AnyEvent:
+    """Reads as set once any of its events is, for ToolSupervisor.run's cancel argument"""
+    
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+    
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+@contextmanager
+def cancel_scope(event):
+    """Kill supervised children started inside the block once event is set"""
+    token = _CANCEL.set(event)
+    try:
+        yield
+    finally:
+        _CANCEL.reset(token)
+
+@contextmanager
+def throttle_scope(throttle):
+    """Cap yt-dlp downloads started inside the block by throttle"""
+    token = _THROTTLE.set(throttle)
+    try:
+        yield
+    finally:
+        _THROTTLE.reset(token)
+
+class ToolResult:
+    """Outcome of one supervised child process"""
+    
+    def __init__(self, returncode, output='', tail='', timed_out=False, cancelled=False):
+        self.returncode = returncode
+        self.output = output
+        self.tail = tail
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+class ToolSupervisor:
+    """Starts every yt-dlp, ffmpeg and ffprobe child under shared limits
+
+    Each tool has a concurrency limit over the whole process. Children run
+    niced, with the configured rlimits, in a process group of their own, so
+    a timeout or cancellation also kills what they spawned (yt-dlp runs its
+    own ffmpeg). Priority and rlimits are applied by starting the child
+    through nice, prlimit and ionice. Output is read as it is produced and
+    only a tail of the diagnostic lines is kept.
+    """
+    
+    WATCH_INTERVAL = 0.2
+    # Seconds output may stay open after the child itself exited, before
+    # whatever it left running in its group is killed
+    ORPHAN_GRACE = 2
+    # Longest line read at once; a child flooding output without newlines
+    # is read in pieces of this size
+    LINE_LIMIT = 64 * 1024
+    # Most captured stdout kept in memory before the child is killed
+    MAX_CAPTURE = 64 * 1024 * 1024
+    
+    def __init__(self, limits, nice, queue_timeout):
+        self.limits = dict(limits)
+        self.nice = dict(nice)
+        self.queue_timeout = queue_timeout
+        self._slots = {tool: threading.BoundedSemaphore(max(1, limit)) for tool, limit in self.limits.items()}
+        self._lock = threading.Lock()
+        self._running = {}
+        self._waiting = {tool: 0 for tool in self.limits}
+        self.counts = {'started': 0, 'timed_out': 0, 'cancelled': 0, 'orphaned': 0, 'busy': 0}
+        self._warned_prlimit = False
+    
+    @staticmethod
+    def tool_name(cmd):
+        name = os.path.basename(cmd[0])
+        if cmd[0] == YT_DLP_PATH or name.startswith(('yt-dlp', 'yt_dlp')):
+            return 'yt-dlp'
+        if name.startswith('ffprobe'):
+            return 'ffprobe'
+        if name.startswith('ffmpeg'):
+            return 'ffmpeg'
+        return name
+    
+    def acquire(self, tool, cancel=None, timeout=None):
+        """Take one of tool's slots; False if cancel was set while waiting
+
+        Raises ToolBusy if no slot frees up within timeout seconds.
+        """
+        semaphore = self._slots.get(tool)
+        if semaphore is None:
+            return True
+        deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+        with self._lock:
+            self._waiting[tool] += 1
+        try:
+            while not semaphore.acquire(timeout=min(self.WATCH_INTERVAL, max(0, deadline - time.monotonic()))):
+                if cancel is not None and cancel.is_set():
+                    return False
+                if time.monotonic() >= deadline:
+                    with self._lock:
+                        self.counts['busy'] += 1
+                    _METRICS.inc('youtubedl_subprocess_kills_total', tool=tool, reason='busy')
+                    raise ToolBusy(f"Too many {tool} processes running, please retry shortly")
+            return True
+        finally:
+            with self._lock:
+                self._waiting[tool] -= 1
+    
+    def release(self, tool):
+        if tool in self._slots:
+            self._slots[tool].release()
+    
+    @contextmanager
+    def slot(self, tool, timeout=None):
+        """Hold one of tool's slots for the duration of the block"""
+        self.acquire(tool, timeout=timeout)
+        try:
+            yield
+        finally:
+            self.release(tool)
+    
+    def _prefix(self, tool):
+        # Wrapper commands that apply the tool's priority and limits and then
+        # exec it, so nothing runs in the forked child before exec (unlike
+        # preexec_fn, which is unsafe in a threaded server)
+        prefix = []
+        nice = self.nice.get(tool, 0)
+        if nice and shutil.which('nice'):
+            prefix += [shutil.which('nice'), '-n', str(nice)]
+        limits = [f"--{name}={value}" for name, value in (('as', TOOL_MEMORY_LIMIT), ('cpu', TOOL_CPU_LIMIT),
+                                                          ('fsize', TOOL_FILE_SIZE_LIMIT)) if value]
+        if limits:
+            prlimit = shutil.which('prlimit')
+            if prlimit:
+                prefix += [prlimit, *limits, '--']
+            elif not self._warned_prlimit:
+                self._warned_prlimit = True
+                logger.warning("prlimit not found on PATH, running tools without rlimits")
+        ionice = shutil.which('ionice') if TOOL_IONICE else None
+        if ionice:
+            prefix += [ionice, '-c', '3'] if TOOL_IONICE == 'idle' else [ionice, '-c', '2', '-n', '7']
+        return prefix
+    
+    def spawn(self, cmd, tool=None, **popen_args):
+        """Start a child in its own process group with the tool's priority and limits
+
+        The caller must already hold a slot for the tool, and must reap()
+        the process when it is done with it.
+        """
+        tool = tool or self.tool_name(cmd)
+        process = subprocess.Popen(self._prefix(tool) + list(cmd), start_new_session=True, **popen_args)
+        with self._lock:
+            self._running[process.pid] = (tool, process)
+            self.counts['started'] += 1
+        return process
+    
+    def kill(self, process):
+        """Kill a child and everything else in its process group
+
+        Until the child is reaped its pid, which is also the group id,
+        cannot be reused, so this is safe even after the child has exited.
+        """
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    
+    @staticmethod
+    def _exited(process):
+        # Like poll(), but leaves the child unreaped so kill() stays safe
+        if not hasattr(os, 'waitid'):
+            return False
+        try:
+            return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+        except ChildProcessError:
+            return True
+    
+    def reap(self, process, cmd=None):
+        """Wait for a child and forget it; its exit is counted if cmd is given"""
+        returncode = process.wait()
+        with self._lock:
+            known = self._running.pop(process.pid, None) is not None
+        if cmd is not None and known:
+            count_exit(cmd, returncode)
+        return returncode
+    
+    def _read_lines(self, stream, sink):
+        for line in iter(lambda: stream.readline(self.LINE_LIMIT), ''):
+            sink(line.rstrip('\n'))
+        stream.close()
+    
+    def run(self, cmd, timeout, on_line=None, capture=False, tail_lines=50, cancel=None, queue_timeout=None):
+        """Run a command to completion under the supervisor's limits
+
+        Without capture, stderr is merged into stdout and each line goes to
+        on_line; lines it returns True for are left out of the tail. With
+        capture, stdout is returned as output and stderr only as its tail.
+        The child's process group is killed after timeout seconds, or once
+        cancel (by default the event of the current cancel_scope) is set.
+        """
+        cancel = cancel if cancel is not None else _CANCEL.get()
+        tool = self.tool_name(cmd)
+        if cancel is not None and cancel.is_set() or not self.acquire(tool, cancel, queue_timeout):
+            return ToolResult(None, cancelled=True)
+        
+        tail = deque(maxlen=tail_lines)
+        outcome = {}
+        finished = threading.Event()
+        try:
+            process = self.spawn(cmd, tool, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                                 text=True, errors='replace')
+            
+            def watch():
+                deadline = time.monotonic() + timeout
+                exited = None
+                while not finished.wait(self.WATCH_INTERVAL):
+                    if cancel is not None and cancel.is_set():
+                        outcome['cancelled'] = True
+                    elif time.monotonic() >= deadline:
+                        outcome['timed_out'] = True
+                    elif exited is None:
+                        exited = time.monotonic() if self._exited(process) else None
+                        continue
+                    elif time.monotonic() - exited >= self.ORPHAN_GRACE:
+                        # Something the child started still holds its output open
+                        outcome['orphaned'] = True
+                    else:
+                        continue
+                    self.kill(process)
+                    return
+            
+            threading.Thread(target=watch, name=f"watch-{tool}", daemon=True).start()
+            try:
+                if capture:
+                    drain = threading.Thread(target=self._read_lines, args=(process.stderr, tail.append),
+                                             daemon=True)
+                    drain.start()
+                    chunks = []
+                    size = 0
+                    for chunk in iter(lambda: process.stdout.read(self.LINE_LIMIT), ''):
+                        size += len(chunk)
+                        if size > self.MAX_CAPTURE:
+                            tail.append(f"Output exceeded {self.MAX_CAPTURE} bytes")
+                            self.kill(process)
+                            break
+                        chunks.append(chunk)
+                    output = ''.join(chunks)
+                    drain.join()
+                else:
+                    def sink(line):
+                        if not (on_line and on_line(line)):
+                            tail.append(line)
+                    self._read_lines(process.stdout, sink)
+                    output = ''
+            finally:
+                finished.set()
+                # Kill the whole group so no grandchild outlives the call
+                self.kill(process)
+                returncode = self.reap(process, cmd)
+        finally:
+            self.release(tool)
+        
+        with self._lock:
+            for key in outcome:
+                self.counts[key] += 1
+        for key in outcome:
+            _METRICS.inc('youtubedl_subprocess_kills_total', tool=tool, reason=key)
+        if outcome:
+            logger.warning(f"Killed {tool} ({', '.join(outcome)}): {' '.join(cmd[:3])}...")
+        return ToolResult(returncode, output, '\n'.join(tail),
+                          timed_out='timed_out' in outcome, cancelled='cancelled' in outcome)
+    
+    def kill_all(self):
+        """Kill every running child, e.g. when the server process exits"""
+        with self._lock:
+            processes = [process for _, process in self._running.values()]
+        for process in processes:
+            self.kill(process)
+    
+    def stats(self):
+        with self._lock:
+            running = {tool: 0 for tool in self.limits}
+            for tool, _ in self._running.values():
+                running[tool] = running.get(tool, 0) + 1
+            return {
+                'limits': self.limits,
+                'running': running,
+                'waiting': dict(self._waiting),
+                'nice': self.nice,
+                'ionice': TOOL_IONICE or None,
+                'rlimits': {'memory': TOOL_MEMORY_LIMIT, 'cpu_seconds': TOOL_CPU_LIMIT,
+                            'file_size': TOOL_FILE_SIZE_LIMIT},
+                **self.counts
+            }
+
+_SUPERVISOR = ToolSupervisor(TOOL_CONCURRENCY, TOOL_NICE, TOOL_QUEUE_TIMEOUT)
+atexit.register(_SUPERVISOR.kill_all)
+
+_TOOL_PATHS = {}
+_TOOL_VERSIONS = {}
+_TOOL_VERSIONS_LOCK = threading.Lock()
+
+def discover_tools():
+    """Locate ffmpeg and yt-dlp once per process, without running them
+
+    When ffmpeg is not on PATH, the first FFMPEG_SEARCH_PATH directory that
+    has it is put in front of PATH, so every tool call finds it by name.
+    """
+    with _TOOL_VERSIONS_LOCK:
+        if _TOOL_PATHS:
+            return dict(_TOOL_PATHS)
+        ffmpeg_path = shutil.which('ffmpeg')
+        if not ffmpeg_path:
+            ffmpeg_path = shutil.which('ffmpeg', path=FFMPEG_SEARCH_PATH)
+            if ffmpeg_path:
+                os.environ['PATH'] = os.path.dirname(ffmpeg_path) + os.pathsep + os.environ.get('PATH', '')
+        _TOOL_PATHS.update({
+            'ffmpeg_path': ffmpeg_path or os.path.join(FFMPEG_PATH, "ffmpeg"),
+            'ffmpeg_exists': ffmpeg_path is not None,
+            'yt_dlp_path': YT_DLP_PATH,
+            'yt_dlp_exists': os.path.exists(YT_DLP_PATH)
+        })
+        return dict(_TOOL_PATHS)
+
+def load_yt_dlp():
+    """The yt_dlp module, imported on first call; None if it is not installed"""
+    global yt_dlp
+    if yt_dlp is None:
+        try:
+            yt_dlp = importlib.import_module('yt_dlp')
+        except ImportError:
+            return None
+    return yt_dlp
+
+def yt_dlp_module_version():
+    """Version of the installed yt_dlp package, read without importing it"""
+    if yt_dlp:
+        return yt_dlp.version.__version__
+    import importlib.metadata
+    try:
+        return importlib.metadata.version('yt-dlp')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def tool_versions():
+    """Paths and versions of ffmpeg and yt-dlp, detected once per process"""
+    paths = discover_tools()
+    with _TOOL_VERSIONS_LOCK:
+        if _TOOL_VERSIONS:
+            return dict(_TOOL_VERSIONS)
+        
+        # Try to get ffmpeg version
+        ffmpeg_path = paths['ffmpeg_path']
+        try:
+            result = _SUPERVISOR.run([ffmpeg_path, "-version"], 5, capture=True)
+            ffmpeg_version = result.output.split('\n')[0] if result.returncode == 0 else "Error"
+        except Exception as e:
+            ffmpeg_version = f"Error: {str(e)}"
+        
+        # Try to get yt-dlp version
+        try:
+            yt_dlp_version = "Not installed"
+            if paths['yt_dlp_exists']:
+                result = _SUPERVISOR.run([YT_DLP_PATH, "--version"], 5, capture=True)
+                yt_dlp_version = result.output.strip() if result.returncode == 0 else "Error"
+        except Exception as e:
+            yt_dlp_version = f"Error: {str(e)}"
+        
+        _TOOL_VERSIONS.update(paths, ffmpeg_version=ffmpeg_version, yt_dlp_version=yt_dlp_version,
+                              yt_dlp_module_version=yt_dlp_module_version())
+        logger.info(f"Detected tools: {_TOOL_VERSIONS}")
+        return dict(_TOOL_VERSIONS)
+
+class YoutubeDLPool:
+    """Bounded pool of pre-initialised yt_dlp.YoutubeDL instances
+
+    YoutubeDL objects are not thread-safe, so each caller checks one out
+    exclusively and returns it when done. Instances are created lazily up
+    to the pool size, or all at once with warm().
+    """
+    
+    def __init__(self, size, factory=None):
+        self.size = max(1, size)
+        self.factory = factory or self._default_factory
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _default_factory():
+        return yt_dlp.YoutubeDL({
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'noplaylist': True,
+            'nocheckcertificate': True
+        })
+    
+    def warm(self):
+        """Create every instance up front so the first requests pay no setup"""
+        instances = [self.acquire() for _ in range(self.size)]
+        for ydl in instances:
+            self.release(ydl)
+    
+    def acquire(self, timeout=30):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+    
+    def release(self, ydl):
+        self._idle.put(ydl)
+    
+    def extract_info(self, url):
+        """Run a metadata-only extraction and return -j compatible JSON data"""
+        ydl = self.acquire()
+        try:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info)
+        finally:
+            self.release(ydl)
+
+_YDL_POOL = YoutubeDLPool(YDL_POOL_SIZE)
+
+def use_inprocess_engine():
+    """Whether yt-dlp calls should run in-process instead of as a subprocess"""
+    return ENGINE == 'inprocess' and load_yt_dlp() is not None
+
 def get_video_info_with_yt_dlp(video_id):
     """Get video information using yt-dlp"""
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    if use_inprocess_engine():
+        try:
+            logger.info(f"Running in-process yt-dlp info extraction: {url}")
+            with _METRICS.timer('youtubedl_info_probe_seconds', engine='inprocess'):
+                return _YDL_POOL.extract_info(url)
+        except Exception as e:
+            logger.error(f"In-process yt-dlp info error, falling back to subprocess: {str(e)}")
+    
     try:
-        url = f"https://www.youtube.com/watch?v={video_id}"
-        
         # Run yt-dlp to get JSON info about the video
         cmd = [YT_DLP_PATH, "-j", url]
         logger.info(f"Running yt-dlp info command: {' '.join(cmd)}")
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        with _METRICS.timer('youtubedl_info_probe_seconds', engine='subprocess') as labels:
+            result = _SUPERVISOR.run(cmd, 30, capture=True, queue_timeout=30)
+            if result.returncode != 0:
+                labels['result'] = 'error'
         
         if result.returncode != 0:
-            logger.error(f"yt-dlp info error: {result.stderr}")
+            logger.error(f"yt-dlp info error: {stderr_tail(result.tail)}")
             return None
             
-        video_info = json.loads(result.stdout)
+        video_info = json.loads(result.output)
         return video_info
     except Exception as e:
         logger.error(f"Error getting video info with yt-dlp: {str(e)}")
         return None
 
-@app.route('/api/info')
-def get_video_info():
+def extract_playlist_entries(url, max_entries):
+    """Flat-extract a playlist or channel, returning (title, entries) or None
+
+    Only the entry list is fetched (id, title, url), not the metadata of
+    every video in it.
+    """
+    if use_inprocess_engine():
+        try:
+            logger.info(f"Running in-process yt-dlp playlist extraction: {url}")
+            with yt_dlp.YoutubeDL({
+                'quiet': True,
+                'no_warnings': True,
+                'skip_download': True,
+                'extract_flat': 'in_playlist',
+                'playlistend': max_entries,
+                'nocheckcertificate': True
+            }) as ydl:
+                playlist = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            return playlist.get('title'), list(playlist.get('entries') or [])
+        except Exception as e:
+            logger.error(f"In-process yt-dlp playlist error, falling back to subprocess: {str(e)}")
+    
+    try:
+        cmd = [YT_DLP_PATH, "--flat-playlist", "-J", "--playlist-end", str(max_entries), url]
+        logger.info(f"Running yt-dlp playlist command: {' '.join(cmd)}")
+        
+        result = _SUPERVISOR.run(cmd, 120, capture=True)
+        
+        if result.returncode != 0:
+            logger.error(f"yt-dlp playlist error: {stderr_tail(result.tail)}")
+            return None
+        
+        playlist = json.loads(result.output)
+        return playlist.get('title'), list(playlist.get('entries') or [])
+    except Exception as e:
+        logger.error(f"Error extracting playlist with yt-dlp: {str(e)}")
+        return None
+
+def run_tool(cmd, timeout, on_line=None, tail_lines=50, cancel=None):
+    """Run a command, feeding each output line to on_line as it is produced
+
+    stderr is merged into stdout. Returns (returncode, tail) where tail is
+    the last few non-progress lines, for error logging. The returncode is
+    None if the call was cancelled before the command started.
+    """
+    result = _SUPERVISOR.run(cmd, timeout, on_line=on_line, tail_lines=tail_lines, cancel=cancel)
+    return result.returncode, result.tail
+
+# yt-dlp progress as machine-readable fields (printed with --newline)
+YT_DLP_PROGRESS_PREFIX = '[progress]'
+YT_DLP_PROGRESS_TEMPLATE = (YT_DLP_PROGRESS_PREFIX + ' %(progress.downloaded_bytes)s'
+                            ' %(progress.total_bytes)s %(progress.total_bytes_estimate)s'
+                            ' %(progress.speed)s %(progress.eta)s')
+
+def _progress_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def make_download_progress(downloaded, total, speed, eta):
+    """Normalise download progress into the fields reported to clients"""
+    downloaded = _progress_number(downloaded)
+    total = _progress_number(total)
+    progress = {
+        'downloaded_bytes': int(downloaded) if downloaded is not None else None,
+        'total_bytes': int(total) if total else None,
+        'speed': _progress_number(speed),
+        'eta': _progress_number(eta),
+        'download_percent': None
+    }
+    if downloaded is not None and total:
+        progress['download_percent'] = round(min(100.0, downloaded * 100 / total), 1)
+    return progress
+
+def parse_yt_dlp_progress(line):
+    """Parse one --progress-template line, or return None for other output"""
+    if not line.startswith(YT_DLP_PROGRESS_PREFIX):
+        return None
+    fields = line[len(YT_DLP_PROGRESS_PREFIX):].split()
+    if len(fields) != 5:
+        return None
+    downloaded, total, estimate, speed, eta = fields
+    return make_download_progress(downloaded, total if total != 'NA' else estimate, speed, eta)
+
+def run_yt_dlp_download(format_selector, output_template, url, progress_callback=None):
+    """Download url with yt-dlp, returning (success, error_output)
+
+    The speed is capped by the Throttle of the current job, if any. When it
+    is lifted mid-download, yt-dlp carries on from its .part file at full
+    speed.
+    """
+    throttle = _THROTTLE.get()
+    if use_inprocess_engine():
+        try:
+            logger.info(f"Running in-process yt-dlp download: {url} ({format_selector})")
+            params = {
+                'format': format_selector,
+                'outtmpl': output_template,
+                'continuedl': True,
+                'noplaylist': True,
+                'nocheckcertificate': True,
+                'quiet': True,
+                'no_warnings': True
+            }
+            if throttle and throttle.limit:
+                params['ratelimit'] = throttle.limit
+            
+            def on_progress(d):
+                # The downloader reads the limit from ydl.params for every chunk
+                if throttle and throttle.lifted.is_set():
+                    ydl.params.pop('ratelimit', None)
+                if progress_callback:
+                    progress_callback(make_download_progress(
+                        d.get('downloaded_bytes'), d.get('total_bytes') or d.get('total_bytes_estimate'),
+                        d.get('speed'), d.get('eta')))
+            params['progress_hooks'] = [on_progress]
+            with _METRICS.timer('youtubedl_download_seconds', engine='inprocess') as labels, \
+                    yt_dlp.YoutubeDL(params) as ydl:
+                retcode = ydl.download([url])
+                if retcode != 0:
+                    labels['result'] = 'error'
+            return retcode == 0, ""
+        except Exception as e:
+            logger.error(f"In-process yt-dlp download error, falling back to subprocess: {str(e)}")
+    
+    # Use yt-dlp to download but skip the merge step - we'll do it with ffmpeg
+    cmd = [
+        YT_DLP_PATH,
+        "-f", format_selector,
+        "-o", output_template,
+        "--continue",  # Resume .part files left by an earlier attempt
+        "--no-playlist",
+        "--no-check-certificate",
+        "--newline",
+        "--progress-template", YT_DLP_PROGRESS_TEMPLATE,
+        url
+    ]
+    
+    def on_line(line):
+        progress = parse_yt_dlp_progress(line)
+        if progress is None:
+            return False
+        if progress_callback:
+            progress_callback(progress)
+        return True
+    
+    # Execute the download, parsing progress lines as they arrive
+    with _METRICS.timer('youtubedl_download_seconds', engine='subprocess') as labels:
+        while True:
+            limit = throttle.limit if throttle else 0
+            run_cmd = cmd[:-1] + ["--limit-rate", str(limit), url] if limit else cmd
+            logger.info(f"Running yt-dlp download command: {' '.join(run_cmd)}")
+            # A throttled run is stopped when the limit is lifted, then resumed without it
+            cancel = AnyEvent(_CANCEL.get(), throttle.lifted) if limit else None
+            returncode, output = run_tool(run_cmd, 600, on_line, cancel=cancel)
+            job_cancelled = _CANCEL.get() is not None and _CANCEL.get().is_set()
+            if returncode == 0 or not limit or not throttle.lifted.is_set() or job_cancelled:
+                break
+            logger.info("Download rate limit lifted, resuming at full speed")
+        if returncode != 0:
+            labels['result'] = 'error'
+    
+    logger.info(f"yt-dlp download completed with return code: {returncode}")
+    return returncode == 0, output
+
+def run_yt_dlp_subtitles(lang, output_template, url):
+    """Fetch one language of subtitles with yt-dlp, skipping the video; returns (success, error_output)
+
+    Uploaded subtitles are used when the video has them in that language,
+    automatic captions otherwise. yt-dlp writes "<name>.<lang>.vtt".
+    """
+    if use_inprocess_engine():
+        try:
+            logger.info(f"Running in-process yt-dlp subtitle download: {url} ({lang})")
+            params = {
+                'skip_download': True,
+                'writesubtitles': True,
+                'writeautomaticsub': True,
+                'subtitleslangs': [lang],
+                'subtitlesformat': 'vtt/best',
+                'outtmpl': output_template,
+                'noplaylist': True,
+                'nocheckcertificate': True,
+                'quiet': True,
+                'no_warnings': True
+            }
+            with _METRICS.timer('youtubedl_download_seconds', engine='inprocess') as labels, \
+                    yt_dlp.YoutubeDL(params) as ydl:
+                retcode = ydl.download([url])
+                if retcode != 0:
+                    labels['result'] = 'error'
+            return retcode == 0, ""
+        except Exception as e:
+            logger.error(f"In-process yt-dlp subtitle download error, falling back to subprocess: {str(e)}")
+    
+    cmd = [
+        YT_DLP_PATH,
+        "--skip-download",
+        "--write-subs",
+        "--write-auto-subs",
+        "--sub-langs", lang,
+        "--sub-format", "vtt/best",
+        "-o", output_template,
+        "--no-playlist",
+        "--no-check-certificate",
+        url
+    ]
+    
+    logger.info(f"Running yt-dlp subtitle command: {' '.join(cmd)}")
+    with _METRICS.timer('youtubedl_download_seconds', engine='subprocess') as labels:
+        returncode, output = run_tool(cmd, 120)
+        if returncode != 0:
+            labels['result'] = 'error'
+    return returncode == 0, output
+
+# Fields of the yt-dlp JSON worth keeping in the metadata cache; the full
+# -j output carries hundreds of KB of URLs and manifests per video
+CACHED_INFO_KEYS = ('id', 'title', 'thumbnail', 'duration')
+CACHED_FORMAT_KEYS = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'width',
+                      'fps', 'tbr', 'abr', 'filesize', 'filesize_approx')
+
+def trim_video_info(video_info):
+    """Reduce a yt-dlp info dict to the fields the app uses"""
+    trimmed = {key: video_info.get(key) for key in CACHED_INFO_KEYS if key in video_info}
+    trimmed['formats'] = [
+        {key: fmt.get(key) for key in CACHED_FORMAT_KEYS if fmt.get(key) is not None}
+        for fmt in video_info.get('formats') or []
+    ]
+    # Subtitle languages only; their URLs are looked up again on download.
+    # Automatic captions come in every translation, so only the track in
+    # the spoken language ("<lang>-orig", or the video language) is offered
+    trimmed['subtitle_langs'] = sorted(lang for lang in video_info.get('subtitles') or {} if lang != 'live_chat')
+    automatic = video_info.get('automatic_captions') or {}
+    captions = {lang[:-len('-orig')] for lang in automatic if lang.endswith('-orig')}
+    if not captions and video_info.get('language') in automatic:
+        captions = {video_info['language']}
+    trimmed['caption_langs'] = sorted(captions)
+    return trimmed
+
+class MetadataCache:
+    """TTL + LRU cache of video metadata keyed by video id
+
+    Concurrent lookups for the same missing id are coalesced so that only
+    one probe runs; the other callers wait for its result.
+    """
+    
+    def __init__(self, max_entries, ttl, path=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        if self.path:
+            self._load()
+    
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() once on a miss"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    _METRICS.inc('youtubedl_metadata_cache_lookups_total', result='hit')
+                    return entry[1]
+                pending = self._inflight.get(key)
+                if pending is None:
+                    pending = self._inflight[key] = threading.Event()
+                    self.misses += 1
+                    _METRICS.inc('youtubedl_metadata_cache_lookups_total', result='miss')
+                    break
+                self.coalesced += 1
+                _METRICS.inc('youtubedl_metadata_cache_lookups_total', result='coalesced')
+            # Another thread is probing this key; wait for it and re-check
+            pending.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+            # The probe failed; fall through and try it ourselves
+        
+        try:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending.set()
+    
+    def peek(self, key):
+        """The cached value for key if it is fresh, without loading or counting"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry and entry[0] > time.time() else None
+    
+    def expires(self, key):
+        """When the entry for key expires, or None if there is none"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            snapshot = list(self._entries.items()) if self.path else None
+        if snapshot is not None:
+            self._save(snapshot)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+                'path': self.path
+            }
+    
+    def _load(self):
+        try:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            for key, expires, value in data:
+                if expires > now:
+                    self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info(f"Loaded {len(self._entries)} metadata cache entries from {self.path}")
+        except Exception as e:
+            logger.error(f"Failed to load metadata cache from {self.path}: {str(e)}")
+    
+    def _save(self, snapshot):
+        try:
+            temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump([[key, expires, value] for key, (expires, value) in snapshot], f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.error(f"Failed to save metadata cache to {self.path}: {str(e)}")
+
+_METADATA_CACHE = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_CACHE_FILE or None)
+
+def get_cached_video_info(video_id):
+    """Get video information, probing yt-dlp only on a metadata cache miss"""
+    def load():
+        video_info = get_video_info_with_yt_dlp(video_id)
+        return trim_video_info(video_info) if video_info else None
+    return _METADATA_CACHE.get_or_load(video_id, load)
+
+def refresh_video_info(video_id):
+    """Probe a video again and replace its metadata cache entry, fresh or not"""
+    video_info = get_video_info_with_yt_dlp(video_id)
+    if not video_info:
+        return None
+    video_info = trim_video_info(video_info)
+    _METADATA_CACHE.put(video_id, video_info)
+    return video_info
+
+def info_is_cached():
+    """Whether /api/info can answer from the metadata cache"""
+    return _METADATA_CACHE.peek(request.args.get('id', '')) is not None
+
+@app.route('/api/info')
+@admission_controlled('info', info_is_cached)
+def get_video_info():
+    video_id = request.args.get('id')
+    if not video_id:
+        return jsonify({'error': 'Missing video ID'}), 400
+    if not VIDEO_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    _DOWNLOAD_CACHE.record_request(video_id)
+    
+    try:
+        # Get video info using yt-dlp (served from the metadata cache when fresh)
+        video_info_data = get_cached_video_info(video_id)
+        
+        if video_info_data:
+            title = video_info_data.get('title', 'YouTube Video')
+            thumbnail_source = video_info_data.get('thumbnail', f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg")
+            duration = video_info_data.get('duration', 0)
+            
+            # Build available formats from the same probe (no second yt-dlp run)
+            formats = get_available_formats(video_info_data)
+            
+            # If no video formats were found, use standard options
+            if not any(fmt['kind'] == 'video' for fmt in formats):
+                formats = [
+                    {'quality': '360p', 'kind': 'video', 'available': True},
+                    {'quality': '480p', 'kind': 'video', 'available': True},
+                    {'quality': '720p', 'kind': 'video', 'available': True},
+                    {'quality': '1080p', 'kind': 'video', 'available': True}
+                ] + formats
+                
+            response = {
+                'id': video_id,
+                'title': title,
+                'thumbnail': f"/api/thumb/{video_id}",
+                'thumbnail_source': thumbnail_source,
+                'duration': duration,
+                'available_formats': formats
+            }
+        else:
+            # Fallback to basic info
+            response = {
+                'id': video_id,
+                'title': 'YouTube Video',
+                'thumbnail': f"/api/thumb/{video_id}",
+                'thumbnail_source': f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg",
+                'available_formats': [
+                    {'quality': '360p', 'kind': 'video', 'available': True},
+                    {'quality': '480p', 'kind': 'video', 'available': True},
+                    {'quality': '720p', 'kind': 'video', 'available': True},
+                    {'quality': '1080p', 'kind': 'video', 'available': True}
+                ]
+            }
+        
+        return jsonify(response)
+    except Exception as e:
+        logger.error(f"Error getting info: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+def combine_audio_video(video_file, audio_file, output_file):
+    """Combine video and audio files using ffmpeg"""
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        # Command to combine video and audio
+        cmd = [
+            ffmpeg_path,
+            "-i", video_file,
+            "-i", audio_file,
+            "-c:v", "copy",       # Copy video without re-encoding
+            "-c:a", "aac",        # Convert audio to AAC
+            "-strict", "experimental",
+            "-y",                 # Overwrite output file if it exists
+            output_file
+        ]
+        
+        logger.info(f"Running ffmpeg combine command: {' '.join(cmd)}")
+        result = _SUPERVISOR.run(cmd, 300, capture=True)
+        
+        if result.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 10000:
+            logger.info(f"Successfully combined files to MP4: {output_file}")
+            return True
+        else:
+            logger.error(f"Combination failed: {stderr_tail(result.tail)}")
+            return False
+    except Exception as e:
+        logger.error(f"Error during combination: {str(e)}")
+        return False
+
+def parse_ffmpeg_progress(line, duration):
+    """Parse one -progress key=value line into client progress fields"""
+    key, sep, value = line.partition('=')
+    if not sep or key not in FFMPEG_PROGRESS_KEYS:
+        return None
+    if key in ('out_time_us', 'out_time_ms'):
+        # Both keys are in microseconds despite the name of the second one
+        seconds = _progress_number(value)
+        if seconds is None or not duration:
+            return {}
+        return {'transcode_percent': round(min(100.0, seconds / 1e6 * 100 / duration), 1)}
+    if key == 'speed':
+        return {'transcode_speed': _progress_number(value.rstrip('x'))}
+    if key == 'progress' and value == 'end':
+        return {'transcode_percent': 100.0}
+    return {}
+
+FFMPEG_PROGRESS_KEYS = {'frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms',
+                        'out_time', 'dup_frames', 'drop_frames', 'speed', 'progress'}
+
+# Per-quality encode ladder: target bitrate for capped VBR, CRF for
+# constant-quality modes, and the bitrate cap applied to both
+ENCODE_LADDER = {
+    "360": {'bitrate': "700k", 'crf': 26},
+    "480": {'bitrate': "1M", 'crf': 25},
+    "720": {'bitrate': "2.5M", 'crf': 23},
+    "1080": {'bitrate': "4M", 'crf': 22}
+}
+
+# Encode profiles. mode "vbr" targets the ladder bitrate, "crf" encodes at
+# constant quality with the ladder bitrate as a ceiling. crf_offset shifts
+# the ladder CRF, maxrate_factor scales the ceiling.
+ENCODE_PROFILES = {
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'mode': 'crf', 'crf_offset': 1, 'maxrate_factor': 1.5},
+    'balanced': {'codec': 'libx264', 'preset': 'fast', 'mode': 'vbr', 'crf_offset': 0, 'maxrate_factor': 1.0},
+    'quality': {'codec': 'libx264', 'preset': 'medium', 'mode': 'crf', 'crf_offset': -1, 'maxrate_factor': 1.5}
+}
+
+def load_encode_profiles(path):
+    """Merge profiles from a JSON file (name -> settings) over the built-in ones"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            custom = json.load(f)
+        for name, settings in custom.items():
+            ENCODE_PROFILES[name] = dict(ENCODE_PROFILES.get(name, ENCODE_PROFILES['balanced']), **settings)
+        logger.info(f"Loaded encode profiles {sorted(custom)} from {path}")
+    except Exception as e:
+        logger.error(f"Failed to load encode profiles from {path}: {str(e)}")
+
+if ENCODE_PROFILES_FILE:
+    load_encode_profiles(ENCODE_PROFILES_FILE)
+
+def encoder_threads():
+    """ffmpeg threads per transcode, so all transcode slots together fit the CPU budget"""
+    return max(1, ENCODE_CPU_BUDGET // max(1, JOB_TRANSCODE_CONCURRENCY))
+
+def _bitrate_value(bitrate):
+    # "2.5M" / "700k" -> bits per second
+    multiplier = {'k': 1000, 'm': 1000000}.get(bitrate[-1].lower(), 1)
+    return int(float(bitrate.rstrip('kKmM')) * multiplier)
+
+def scale_filter(height):
+    """Scale the short side to at most height, keeping the aspect ratio and never upscaling
+
+    The short side is the height of landscape video and the width of
+    vertical video, as in format_rung().
+    """
+    return (f"scale='if(gte(iw,ih),-2,min({height},iw))'"
+            f":'if(gte(iw,ih),min({height},ih),-2)'")
+
+def build_encode_args(height, profile=None, threads=None, scale=True):
+    """ffmpeg video encoding arguments for a target height and encode profile
+
+    The video's short side is scaled to at most the target height with its
+    aspect ratio kept (and never upscaled), instead of being stretched to 16:9. Pass
+    scale=False when the scaling is done in a filtergraph instead.
+    """
+    settings = ENCODE_PROFILES.get(profile or ENCODE_PROFILE) or ENCODE_PROFILES['balanced']
+    args = ["-c:v", settings['codec'], "-preset", settings['preset'],
+            "-threads", str(threads or encoder_threads())]
+    rung = ENCODE_LADDER.get(height)
+    if not rung:
+        return args
+    
+    maxrate = int(_bitrate_value(rung['bitrate']) * settings.get('maxrate_factor', 1.0))
+    if scale:
+        args.extend(["-vf", scale_filter(height)])
+    if settings['mode'] == 'crf':
+        args.extend(["-crf", str(rung['crf'] + settings.get('crf_offset', 0))])
+    else:
+        args.extend(["-b:v", rung['bitrate']])
+    args.extend([
+        "-maxrate", str(maxrate),
+        "-bufsize", str(maxrate * 2),
+        "-movflags", "+faststart"  # Web optimization
+    ])
+    return args
+
+def convert_to_mp4(input_file, output_file, height=None, duration=None, progress_callback=None, profile=None):
+    """Convert any video file to MP4 using ffmpeg with optional scaling"""
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        threads = encoder_threads()
+        # Base command
+        cmd = [
+            ffmpeg_path,
+            "-hide_banner",
+            "-nostats",
+            "-progress", "pipe:1",  # Machine-readable progress on stdout
+            "-threads", str(threads),  # Decoder threads
+            "-i", input_file
+        ]
+        cmd.extend(build_encode_args(height, profile, threads))
+        cmd.extend([
+            "-c:a", "aac",         # Use AAC for audio
+            "-b:a", "128k",        # Audio bitrate
+            "-strict", "experimental",
+            "-y",                  # Overwrite output file if it exists
+            output_file
+        ])
+        
+        logger.info(f"Running ffmpeg conversion command: {' '.join(cmd)}")
+        
+        def on_line(line):
+            progress = parse_ffmpeg_progress(line, duration)
+            if progress is None:
+                return False
+            if progress and progress_callback:
+                progress_callback(progress)
+            return True
+        
+        with _METRICS.timer('youtubedl_transcode_seconds', kind='transcode') as labels:
+            returncode, output = run_tool(cmd, 300, on_line)
+            if returncode != 0:
+                labels['result'] = 'error'
+        
+        if returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 10000:
+            logger.info(f"Successfully converted to MP4: {output_file}")
+            return True
+        else:
+            logger.error(f"Conversion failed: {stderr_tail(output)}")
+            return False
+    except Exception as e:
+        logger.error(f"Error during conversion: {str(e)}")
+        return False
+
+def convert_to_renditions(input_file, renditions, duration=None, progress_callback=None, profile=None,
+                          copy_audio=False):
+    """Encode several heights of one input in a single ffmpeg run
+
+    renditions is a list of (height, output_file). The input is decoded
+    once and split into one scaled branch per rendition, so decode cost
+    is paid once however many qualities are produced. The encoder threads
+    of the run are divided between its outputs.
+    """
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        threads = encoder_threads()
+        branches = ''.join(f"[s{i}]" for i in range(len(renditions)))
+        graph = [f"[0:v]split={len(renditions)}{branches}"]
+        graph.extend(f"[s{i}]{scale_filter(height)}[v{i}]" for i, (height, _) in enumerate(renditions))
+        
+        cmd = [
+            ffmpeg_path,
+            "-hide_banner",
+            "-nostats",
+            "-progress", "pipe:1",
+            "-threads", str(threads),
+            "-i", input_file,
+            "-filter_complex", ';'.join(graph)
+        ]
+        for i, (height, output_file) in enumerate(renditions):
+            cmd.extend(["-map", f"[v{i}]", "-map", "0:a:0?"])
+            cmd.extend(build_encode_args(height, profile, max(1, threads // len(renditions)), scale=False))
+            if copy_audio:
+                cmd.extend(["-c:a", "copy"])
+            else:
+                cmd.extend(["-c:a", "aac", "-b:a", "128k"])
+            cmd.extend(["-y", output_file])
+        
+        logger.info(f"Running ffmpeg multi-rendition command: {' '.join(cmd)}")
+        
+        def on_line(line):
+            progress = parse_ffmpeg_progress(line, duration)
+            if progress is None:
+                return False
+            if progress and progress_callback:
+                progress_callback(progress)
+            return True
+        
+        with _METRICS.timer('youtubedl_transcode_seconds', kind='renditions') as labels:
+            returncode, output = run_tool(cmd, 300 * len(renditions), on_line)
+            if returncode != 0:
+                labels['result'] = 'error'
+        
+        missing = [f for _, f in renditions if not os.path.exists(f) or os.path.getsize(f) <= 10000]
+        if returncode == 0 and not missing:
+            logger.info(f"Successfully encoded {len(renditions)} renditions of {input_file}")
+            return True
+        else:
+            logger.error(f"Multi-rendition encode failed: {stderr_tail(output)}")
+            return False
+    except Exception as e:
+        logger.error(f"Error during multi-rendition encode: {str(e)}")
+        return False
+
+def probe_media(input_file):
+    """Read codec and resolution of a media file with ffprobe"""
+    try:
+        ffprobe_path = shutil.which("ffprobe")
+        if not ffprobe_path:
+            logger.warning("ffprobe not found in PATH")
+            return None
+        
+        cmd = [
+            ffprobe_path,
+            "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,width,height",
+            "-of", "json",
+            input_file
+        ]
+        result = _SUPERVISOR.run(cmd, 30, capture=True)
+        if result.returncode != 0:
+            logger.error(f"ffprobe failed: {stderr_tail(result.tail)}")
+            return None
+        
+        media = {'video_codec': None, 'audio_codec': None, 'width': None, 'height': None}
+        for stream in json.loads(result.output).get('streams', []):
+            if stream.get('codec_type') == 'video' and not media['video_codec']:
+                media['video_codec'] = stream.get('codec_name')
+                media['width'] = stream.get('width')
+                media['height'] = stream.get('height')
+            elif stream.get('codec_type') == 'audio' and not media['audio_codec']:
+                media['audio_codec'] = stream.get('codec_name')
+        return media
+    except Exception as e:
+        logger.error(f"Error probing media: {str(e)}")
+        return None
+
+def choose_encode_path(media, height):
+    """Decide how to turn a downloaded file into the final MP4
+
+    Returns "remux" when video and audio can both be stream-copied,
+    "remux_audio" when only the audio needs converting to AAC, and
+    "transcode" when the video itself must be re-encoded. The resolution is
+    compared by short side, so a 1080x1920 source is a 1080p one.
+    """
+    if not media or media['video_codec'] != 'h264' or not media['height']:
+        return "transcode"
+    if height and height.isdigit() and not within_rung(format_short_side(media), height):
+        return "transcode"
+    if media['audio_codec'] in (None, 'aac'):
+        return "remux"
+    return "remux_audio"
+
+def remux_to_mp4(input_file, output_file, copy_audio=True, duration=None, progress_callback=None):
+    """Rewrite a compatible file into a web-optimised MP4 without re-encoding video"""
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        cmd = [
+            ffmpeg_path,
+            "-hide_banner",
+            "-nostats",
+            "-progress", "pipe:1",
+            "-i", input_file,
+            "-c:v", "copy",       # Copy video without re-encoding
+        ]
+        if copy_audio:
+            cmd.extend(["-c:a", "copy"])
+        else:
+            cmd.extend(["-c:a", "aac", "-b:a", "128k"])
+        cmd.extend([
+            "-movflags", "+faststart",  # Web optimization
+            "-y",
+            output_file
+        ])
+        
+        logger.info(f"Running ffmpeg remux command: {' '.join(cmd)}")
+        
+        def on_line(line):
+            progress = parse_ffmpeg_progress(line, duration)
+            if progress is None:
+                return False
+            if progress and progress_callback:
+                progress_callback(progress)
+            return True
+        
+        with _METRICS.timer('youtubedl_transcode_seconds', kind='remux') as labels:
+            returncode, output = run_tool(cmd, 300, on_line)
+            if returncode != 0:
+                labels['result'] = 'error'
+        
+        if returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 10000:
+            logger.info(f"Successfully remuxed to MP4: {output_file}")
+            return True
+        else:
+            logger.error(f"Remux failed: {stderr_tail(output)}")
+            return False
+    except Exception as e:
+        logger.error(f"Error during remux: {str(e)}")
+        return False
+
+def extract_audio(input_file, output_file, encode_args=None, duration=None, progress_callback=None):
+    """Write the first audio stream of a file on its own, stream-copied unless encode_args are given"""
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        cmd = [
+            ffmpeg_path,
+            "-hide_banner",
+            "-nostats",
+            "-progress", "pipe:1",
+            "-i", input_file,
+            "-map", "0:a:0",
+            "-vn",
+            *(encode_args or ["-c:a", "copy"])
+        ]
+        if output_file.endswith('.m4a'):
+            cmd.extend(["-movflags", "+faststart"])
+        cmd.extend(["-y", output_file])
+        
+        logger.info(f"Running ffmpeg audio command: {' '.join(cmd)}")
+        
+        def on_line(line):
+            progress = parse_ffmpeg_progress(line, duration)
+            if progress is None:
+                return False
+            if progress and progress_callback:
+                progress_callback(progress)
+            return True
+        
+        kind = 'audio_encode' if encode_args else 'audio_copy'
+        with _METRICS.timer('youtubedl_transcode_seconds', kind=kind) as labels:
+            returncode, output = run_tool(cmd, 600, on_line)
+            if returncode != 0:
+                labels['result'] = 'error'
+        
+        if returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 1000:
+            logger.info(f"Successfully extracted audio: {output_file}")
+            return True
+        else:
+            logger.error(f"Audio extraction failed: {stderr_tail(output)}")
+            return False
+    except Exception as e:
+        logger.error(f"Error during audio extraction: {str(e)}")
+        return False
+
+def convert_subtitles(input_file, output_file):
+    """Convert a subtitle file to the format of output_file's extension"""
+    try:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logger.warning("ffmpeg not found in PATH")
+            return False
+        
+        cmd = [ffmpeg_path, "-hide_banner", "-v", "error", "-i", input_file, "-y", output_file]
+        logger.info(f"Running ffmpeg subtitle command: {' '.join(cmd)}")
+        with _METRICS.timer('youtubedl_transcode_seconds', kind='subtitles') as labels:
+            result = _SUPERVISOR.run(cmd, 60, capture=True)
+            if result.returncode != 0:
+                labels['result'] = 'error'
+        
+        if result.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+            return True
+        logger.error(f"Subtitle conversion failed: {stderr_tail(result.tail)}")
+        return False
+    except Exception as e:
+        logger.error(f"Error during subtitle conversion: {str(e)}")
+        return False
+
+def format_size(size_bytes):
+    """Format file size in human-readable format"""
+    if size_bytes < 1024:
+        return f"{size_bytes} bytes"
+    elif size_bytes < 1024 * 1024:
+        return f"{size_bytes/1024:.1f} KB"
+    elif size_bytes < 1024 * 1024 * 1024:
+        return f"{size_bytes/(1024*1024):.1f} MB"
+    else:
+        return f"{size_bytes/(1024*1024*1024):.1f} GB"
+
+def sanitize_filename(filename):
+    """Sanitize a string to be used as a filename"""
+    # Remove invalid characters for filenames across operating systems
+    filename = re.sub(r'[\\/*?:"<>|]', '', filename)
+    # Replace multiple spaces with a single space
+    filename = re.sub(r'\s+', ' ', filename).strip()
+    # Limit filename length (most filesystems have limits around 255 chars)
+    if len(filename) > 100:
+        filename = filename[:97] + '...'
+    return filename
+
+def cache_filename(title, video_id, quality, ext):
+    """On-disk name of a cached file; the video id keeps equal titles apart"""
+    return f"{sanitize_filename(title)} [{video_id}]-{quality}.{ext}"
+
+# Matches names produced by cache_filename, to recover the key on warm
+# start; subtitle qualities ("subtitles.pt-BR") may contain hyphens
+CACHE_FILENAME_RE = re.compile(r'^(?P<title>.*) \[(?P<id>[\w-]+)\]-(?P<quality>[^\[\]]+)\.(?P<ext>\w+)$')
+CACHE_VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mkv')
+CACHE_MEDIA_EXTENSIONS = CACHE_VIDEO_EXTENSIONS + tuple(f".{ext}" for ext in [*AUDIO_OUTPUTS, *SUBTITLE_FORMATS])
+
+def file_checksum(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DownloadCache:
+    """Persistent index of finished files in DOWNLOAD_DIR
+
+    Entries are keyed by (video id, quality, format) and record the file
+    size, checksum and last access time in a SQLite database. When the
+    total size exceeds max_bytes, least recently used files are deleted.
+    The index is opened lazily and on first use picks up any media files
+    already in the directory. The same database keeps the request history:
+    a request count per video and quality that halves every
+    history_half_life seconds, so it ranks what is popular now.
+    """
+    
+    # Request counts are buffered and written at most this often (seconds)
+    HISTORY_FLUSH_INTERVAL = 30
+    
+    def __init__(self, directory, index_path, max_bytes=0, history_half_life=3 * 86400):
+        self.directory = directory
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.history_half_life = history_half_life
+        self._db = None
+        self._lock = threading.Lock()
+        self._pending_requests = {}
+        self._requests_flushed = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_evicted = 0
+    
+    def _conn(self):
+        # Called with the lock held
+        if self._db is None:
+            self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    path TEXT PRIMARY KEY,
+                    video_id TEXT,
+                    quality TEXT,
+                    format TEXT,
+                    title TEXT,
+                    size INTEGER NOT NULL,
+                    checksum TEXT,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self._db.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS entries_key
+                ON entries (video_id, quality, format) WHERE video_id IS NOT NULL""")
+            # quality is '' for metadata-only requests
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS requests (
+                    video_id TEXT NOT NULL,
+                    quality TEXT NOT NULL,
+                    score REAL NOT NULL,
+                    last_request REAL NOT NULL,
+                    PRIMARY KEY (video_id, quality)
+                )""")
+            self._warm_start()
+            self._db.commit()
+        return self._db
+    
+    def _warm_start(self):
+        """Index media files on disk that the database does not know about"""
+        known = {row[0] for row in self._db.execute("SELECT path FROM entries")}
+        added = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename in known or not filename.endswith(CACHE_MEDIA_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            match = CACHE_FILENAME_RE.match(filename)
+            # Files from before the index existed carry no video id; they are
+            # counted against the quota and adopted when their title is requested
+            video_id, quality, fmt, title = None, None, None, filename.rsplit('.', 1)[0]
+            if match:
+                video_id, quality = match.group('id'), match.group('quality')
+                fmt, title = match.group('ext'), match.group('title')
+            self._db.execute(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?)",
+                (filename, video_id, quality, fmt, title, stat.st_size, stat.st_mtime, stat.st_mtime))
+            added += 1
+        # Forget entries whose file was deleted behind our back
+        removed = 0
+        for filename in known:
+            if not os.path.exists(os.path.join(self.directory, filename)):
+                self._db.execute("DELETE FROM entries WHERE path = ?", (filename,))
+                removed += 1
+        if added or removed:
+            logger.info(f"Download cache warm start: indexed {added} files, dropped {removed} missing entries")
+    
+    def lookup(self, video_id, quality, fmt):
+        """Return (path, title) for a cached file, or None on a miss"""
+        with self._lock:
+            db = self._conn()
+            row = db.execute(
+                "SELECT path, title, size FROM entries WHERE video_id = ? AND quality = ? AND format = ?",
+                (video_id, quality, fmt)).fetchone()
+            if row:
+                path = os.path.join(self.directory, row[0])
+                if os.path.exists(path) and os.path.getsize(path) == row[2]:
+                    db.execute("UPDATE entries SET last_access = ? WHERE path = ?", (time.time(), row[0]))
+                    db.commit()
+                    self.hits += 1
+                    _METRICS.inc('youtubedl_cache_lookups_total', result='hit')
+                    return path, row[1]
+                # The file vanished or changed size; drop the stale entry
+                db.execute("DELETE FROM entries WHERE path = ?", (row[0],))
+                db.commit()
+            self.misses += 1
+            _METRICS.inc('youtubedl_cache_lookups_total', result='miss')
+            return None
+    
+    def contains(self, video_id, quality, fmt):
+        """Whether a file for the key is cached, without counting a lookup"""
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT path, size FROM entries WHERE video_id = ? AND quality = ? AND format = ?",
+                (video_id, quality, fmt)).fetchone()
+        if not row:
+            return False
+        path = os.path.join(self.directory, row[0])
+        return os.path.exists(path) and os.path.getsize(path) == row[1]
+    
+    def media_files(self):
+        """Map of video id to its largest cached video file, for every cached video"""
+        video_formats = tuple(ext.lstrip('.') for ext in CACHE_VIDEO_EXTENSIONS)
+        with self._lock:
+            rows = self._conn().execute(
+                f"SELECT video_id, path FROM entries WHERE video_id IS NOT NULL "
+                f"AND format IN ({', '.join('?' * len(video_formats))}) ORDER BY size", video_formats).fetchall()
+        # Later (larger) files overwrite smaller ones of the same video
+        files = {video_id: os.path.join(self.directory, path) for video_id, path in rows}
+        return {video_id: path for video_id, path in files.items() if os.path.exists(path)}
+    
+    def add(self, path, video_id, quality, fmt, title, checksum=None):
+        """Record a finished file and evict old entries if over quota"""
+        filename = os.path.basename(path)
+        size = os.path.getsize(path)
+        if checksum is None:
+            checksum = file_checksum(path)
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            # A re-download replaces whatever the key pointed at before
+            db.execute("DELETE FROM entries WHERE video_id = ? AND quality = ? AND format = ? AND path != ?",
+                       (video_id, quality, fmt, filename))
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (filename, video_id, quality, fmt, title, size, checksum, now, now))
+            self._evict(keep=filename)
+            db.commit()
+    
+    def _evict(self, keep=None):
+        # Called with the lock held
+        if not self.max_bytes:
+            return
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for filename, size in self._db.execute(
+                "SELECT path, size FROM entries WHERE path != ? ORDER BY last_access", (keep or '',)).fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Failed to evict {filename}: {str(e)}")
+                continue
+            self._db.execute("DELETE FROM entries WHERE path = ?", (filename,))
+            total -= size
+            self.evictions += 1
+            self.bytes_evicted += size
+            logger.info(f"Evicted {filename} ({format_size(size)}) from download cache")
+    
+    def record_request(self, video_id, quality=None):
+        """Count a request for a video, in a quality or for its metadata only"""
+        key = (video_id, quality or '')
+        now = time.time()
+        with self._lock:
+            self._pending_requests[key] = self._pending_requests.get(key, 0) + 1
+            if now - self._requests_flushed >= self.HISTORY_FLUSH_INTERVAL:
+                self._flush_requests(now)
+    
+    def _decayed(self, score, since, now):
+        return score * 0.5 ** (max(0.0, now - since) / self.history_half_life)
+    
+    def _flush_requests(self, now):
+        # Called with the lock held
+        db = self._conn()
+        for (video_id, quality), count in self._pending_requests.items():
+            row = db.execute("SELECT score, last_request FROM requests WHERE video_id = ? AND quality = ?",
+                             (video_id, quality)).fetchone()
+            score = self._decayed(*row, now) + count if row else count
+            db.execute("INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)", (video_id, quality, score, now))
+        db.commit()
+        self._pending_requests = {}
+        self._requests_flushed = now
+    
+    def popular(self, min_score=0):
+        """(video id, quality, current score) of the requested videos, most popular first
+
+        quality is '' for metadata-only requests. Entries whose score has
+        decayed to almost nothing are dropped from the history.
+        """
+        now = time.time()
+        with self._lock:
+            self._flush_requests(now)
+            db = self._conn()
+            ranked = []
+            for video_id, quality, score, last_request in db.execute("SELECT * FROM requests").fetchall():
+                score = self._decayed(score, last_request, now)
+                if score < 0.01:
+                    db.execute("DELETE FROM requests WHERE video_id = ? AND quality = ?", (video_id, quality))
+                elif score >= min_score:
+                    ranked.append((video_id, quality, round(score, 3)))
+            db.commit()
+        return sorted(ranked, key=lambda entry: -entry[2])
+    
+    def stats(self):
+        with self._lock:
+            db = self._conn()
+            entries, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'bytes_evicted': self.bytes_evicted,
+                'index_path': self.index_path
+            }
+
+_DOWNLOAD_CACHE = DownloadCache(DOWNLOAD_DIR, CACHE_INDEX_FILE or os.path.join(DOWNLOAD_DIR, ".cache_index.sqlite3"),
+                                CACHE_MAX_BYTES, PREFETCH_HISTORY_HALF_LIFE)
+
+class ThumbnailCache:
+    """Video thumbnails fetched once and kept on disk as resized variants
+
+    Each video gets a directory holding one source image and the WebP/JPEG
+    variants ffmpeg makes from it. The source is a frame of a downloaded
+    file when there is one, so no network is needed, and the YouTube
+    thumbnail otherwise. Files are tracked in a SQLite index with their
+    last access time; when the total exceeds max_bytes the least recently
+    used videos are deleted. Concurrent requests for one video share a
+    single fetch.
+    """
+    
+    SOURCE = 'source.jpg'
+    SOURCE_WIDTH = 640
+    FORMATS = {'webp': ('webp', 'image/webp'), 'jpeg': ('jpg', 'image/jpeg')}
+    MAX_FETCH_BYTES = 5 * 1024 * 1024
+    # Seconds before a video whose thumbnail could not be had is retried
+    FAILURE_TTL = 300
+    # Access times are written back at most this often per file
+    TOUCH_INTERVAL = 300
+    UPSTREAM_HOSTS = ('ytimg.com', 'youtube.com', 'ggpht.com', 'googleusercontent.com')
+    
+    def __init__(self, directory, max_bytes, widths):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.widths = widths
+        self.webp = None
+        self._db = None
+        self._lock = threading.Lock()
+        self._video_locks = {}
+        self._failed = {}
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.extracted = 0
+        self.failures = 0
+        self.evictions = 0
+    
+    def _conn(self):
+        # Called with the lock held
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    video_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self._db.commit()
+        return self._db
+    
+    def width_for(self, requested):
+        """The smallest variant width at least as wide as requested"""
+        return next((width for width in self.widths if width >= (requested or 0)), self.widths[-1])
+    
+    def upstream_url(self, video_id):
+        """Where YouTube serves the thumbnail: from cached metadata, or the standard URL"""
+        info = _METADATA_CACHE.peek(video_id) or {}
+        url = urllib.parse.urlparse(info.get('thumbnail') or '')
+        if url.scheme == 'https' and (url.hostname or '').endswith(self.UPSTREAM_HOSTS):
+            return url.geturl()
+        return f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
+    
+    @contextmanager
+    def _video_lock(self, video_id):
+        with self._lock:
+            entry = self._video_locks.setdefault(video_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._video_locks[video_id]
+    
+    def _touch(self, relative):
+        # Whether the index knows the file; refreshes its access time
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT last_access FROM files WHERE path = ?", (relative,)).fetchone()
+            if row and time.time() - row[0] > self.TOUCH_INTERVAL:
+                db.execute("UPDATE files SET last_access = ? WHERE path = ?", (time.time(), relative))
+                db.commit()
+            return row is not None
+    
+    def get(self, video_id, width, fmt):
+        """Path of one variant, made on first use; None if no source image can be had"""
+        relative = f"{video_id}/{width}.{self.FORMATS[fmt][0]}"
+        path = os.path.join(self.directory, relative)
+        if self._touch(relative) and os.path.exists(path):
+            self.hits += 1
+            return path
+        
+        with self._video_lock(video_id):
+            # Another request may have made it while this one waited
+            if self._touch(relative) and os.path.exists(path):
+                self.hits += 1
+                return path
+            self.misses += 1
+            source = self._source(video_id)
+            if not source or not self._resize(source, path, width, fmt):
+                return None
+            self._record(video_id, [relative])
+        return path
+    
+    def cached(self, video_id, width, fmt):
+        """Whether get() can answer without ffmpeg or a fetch: the variant exists or its source recently failed"""
+        path = os.path.join(self.directory, video_id, f"{width}.{self.FORMATS[fmt][0]}")
+        return os.path.exists(path) or self._failed.get(video_id, 0) > time.time()
+    
+    def _source(self, video_id):
+        source = os.path.join(self.directory, video_id, self.SOURCE)
+        if os.path.exists(source):
+            return source
+        if self._failed.get(video_id, 0) > time.time():
+            return None
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        
+        media = _DOWNLOAD_CACHE.media_files().get(video_id)
+        if media and self._extract_frame(media, source):
+            self.extracted += 1
+        elif self._fetch(self.upstream_url(video_id), source):
+            self.fetched += 1
+        else:
+            self.failures += 1
+            now = time.time()
+            self._failed = {key: until for key, until in self._failed.items() if until > now}
+            self._failed[video_id] = now + self.FAILURE_TTL
+            return None
+        self._record(video_id, [f"{video_id}/{self.SOURCE}"])
+        return source
+    
+    def _extract_frame(self, media, output):
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            return False
+        temp = output + '.tmp.jpg'
+        # A frame a little way in, picked by the thumbnail filter to avoid
+        # black fades; very short videos fall back to the start
+        for offset in ('10', '0'):
+            cmd = [
+                ffmpeg_path, "-hide_banner", "-v", "error",
+                "-ss", offset, "-i", media,
+                "-vf", f"thumbnail=25,scale='min({self.SOURCE_WIDTH},iw)':-2",
+                "-frames:v", "1", "-update", "1", "-q:v", "3",
+                "-y", temp
+            ]
+            result = _SUPERVISOR.run(cmd, 60, capture=True)
+            if result.returncode == 0 and os.path.exists(temp) and os.path.getsize(temp) > 0:
+                os.replace(temp, output)
+                return True
+        logger.warning(f"Could not extract a thumbnail frame from {media}: {stderr_tail(result.tail)}")
+        return False
+    
+    def _fetch(self, url, output):
+        try:
+            logger.info(f"Fetching thumbnail {url}")
+            fetch_request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+            with urllib.request.urlopen(fetch_request, timeout=10) as response:
+                data = response.read(self.MAX_FETCH_BYTES + 1)
+            if not data or len(data) > self.MAX_FETCH_BYTES:
+                return False
+            temp = output + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, output)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to fetch thumbnail {url}: {str(e)}")
+            return False
+    
+    def _resize(self, source, output, width, fmt):
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            return False
+        temp = f"{output}.tmp.{self.FORMATS[fmt][0]}"
+        codec = ["-c:v", "libwebp", "-quality", "80"] if fmt == 'webp' else ["-q:v", "4"]
+        cmd = [
+            ffmpeg_path, "-hide_banner", "-v", "error",
+            "-i", source,
+            "-vf", f"scale='min({width},iw)':-2",
+            "-frames:v", "1", "-update", "1",
+            *codec,
+            "-y", temp
+        ]
+        result = _SUPERVISOR.run(cmd, 30, capture=True)
+        if result.returncode == 0 and os.path.exists(temp) and os.path.getsize(temp) > 0:
+            os.replace(temp, output)
+            if fmt == 'webp':
+                self.webp = True
+            return True
+        if fmt == 'webp' and not self.webp:
+            # ffmpeg built without libwebp; JPEG is served instead
+            self.webp = False
+        logger.error(f"Thumbnail resize failed: {stderr_tail(result.tail)}")
+        return False
+    
+    def _record(self, video_id, relatives):
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            for relative in relatives:
+                size = os.path.getsize(os.path.join(self.directory, relative))
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (relative, video_id, size, now))
+            self._evict(keep=video_id)
+            db.commit()
+    
+    def _evict(self, keep):
+        # Called with the lock held; whole videos go, least recently used first
+        if not self.max_bytes:
+            return
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        for video_id, size in self._db.execute(
+                "SELECT video_id, SUM(size) FROM files WHERE video_id != ? "
+                "GROUP BY video_id ORDER BY MAX(last_access)", (keep,)).fetchall():
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, video_id), ignore_errors=True)
+            self._db.execute("DELETE FROM files WHERE video_id = ?", (video_id,))
+            total -= size
+            self.evictions += 1
+    
+    def pregenerate(self, width):
+        """Make the default variants for every downloaded video that lacks them"""
+        made = 0
+        for video_id in _DOWNLOAD_CACHE.media_files():
+            for fmt in ('jpeg', 'webp'):
+                if fmt == 'webp' and self.webp is False:
+                    continue
+                relative = f"{video_id}/{width}.{self.FORMATS[fmt][0]}"
+                if self._touch(relative) and os.path.exists(os.path.join(self.directory, relative)):
+                    continue
+                if self.get(video_id, width, fmt):
+                    made += 1
+        return made
+    
+    def stats(self):
+        with self._lock:
+            files, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            return {
+                'directory': self.directory,
+                'files': files,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+                'widths': list(self.widths),
+                'webp': self.webp,
+                'hits': self.hits,
+                'misses': self.misses,
+                'fetched': self.fetched,
+                'extracted': self.extracted,
+                'failures': self.failures,
+                'evictions': self.evictions
+            }
+
+_THUMBS = ThumbnailCache(THUMB_DIR, THUMB_MAX_BYTES, THUMB_WIDTHS)
+
+class WorkDirs:
+    """Stable per-download work directories under TEMP_DIR
+
+    A download of a video at a given height, or of its audio-only stream,
+    always works in TEMP_DIR/<video id>-<source> ("-720p", "-audio-opus"),
+    so a retry after a failure, timeout or restart finds the .part files
+    yt-dlp left behind and resumes them.
+    Directories are deleted when their download succeeds and kept when it
+    fails. Each claimed directory is held under an exclusive flock; a
+    caller that finds it locked by another process works in a private
+    directory instead.
+    """
+    
+    MARKER = 'job.json'
+    LOCK = '.lock'
+    OUTPUT = 'out'
+    
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self.resumed = 0
+        self.resumed_bytes = 0
+        self.recovered = 0
+        self.collected = 0
+        self.bytes_collected = 0
+    
+    def _try_lock(self, path):
+        """Open and exclusively lock path's lock file; None if another holder has it"""
+        lock_file = open(os.path.join(path, self.LOCK), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+        return lock_file
+    
+    def _usage(self, path):
+        # (bytes, newest mtime) of everything in a work directory
+        size, newest = 0, os.path.getmtime(path)
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                if filename == self.LOCK:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                size += stat.st_size
+                newest = max(newest, stat.st_mtime)
+        return size, newest
+    
+    def _partial_bytes(self, path):
+        # What an earlier attempt already downloaded: .part files and finished streams
+        total = 0
+        for filename in os.listdir(path):
+            file_path = os.path.join(path, filename)
+            if filename not in (self.MARKER, self.LOCK) and os.path.isfile(file_path):
+                total += os.path.getsize(file_path)
+        return total
+    
+    @contextmanager
+    def claim(self, video_id, qualities, source):
+        """Lock the work directory for a download and yield (path, resumed bytes)
+
+        yt-dlp should download into the directory itself; conversion output
+        belongs in its OUTPUT subdirectory.
+        """
+        safe_id = re.sub(r'[^\w-]', '_', video_id)
+        path = os.path.join(self.root, f"{safe_id}-{source}")
+        os.makedirs(path, exist_ok=True)
+        lock_file = self._try_lock(path)
+        if lock_file is None:
+            logger.info(f"Work directory {path} is in use, downloading into a private one")
+            path = tempfile.mkdtemp(dir=self.root)
+            lock_file = self._try_lock(path)
+        
+        resumed = self._partial_bytes(path)
+        with open(os.path.join(path, self.MARKER), 'w', encoding='utf-8') as f:
+            json.dump({'video_id': video_id, 'qualities': list(qualities), 'source': source,
+                       'updated': time.time()}, f)
+        shutil.rmtree(os.path.join(path, self.OUTPUT), ignore_errors=True)
+        os.makedirs(os.path.join(path, self.OUTPUT))
+        if resumed:
+            logger.info(f"Resuming download in {path}, {format_size(resumed)} already on disk")
+            with self._lock:
+                self.resumed += 1
+                self.resumed_bytes += resumed
+        
+        succeeded = False
+        try:
+            yield path, resumed
+            succeeded = True
+        finally:
+            if succeeded:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Cleaned up work directory: {path}")
+            else:
+                logger.info(f"Keeping work directory {path} so the download can resume")
+            lock_file.close()
+    
+    def recover(self, submit, is_cached, max_age, max_bytes):
+        """Re-queue interrupted downloads and delete stale work directories
+
+        Runs once at startup. Directories locked by a running download are
+        left alone. Unmarked directories (left by older versions) and stray
+        files are deleted once they are idle.
+        """
+        now = time.time()
+        candidates = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if not os.path.isdir(path):
+                    # Stream tee files and other leftovers
+                    if now - os.path.getmtime(path) > max_age:
+                        self._collect(path, os.path.getsize(path))
+                    continue
+                # Measure before locking, which may create the lock file
+                size, newest = self._usage(path)
+                lock_file = self._try_lock(path)
+            except FileNotFoundError:
+                continue
+            if lock_file is None:
+                continue
+            try:
+                with open(os.path.join(path, self.MARKER), 'r', encoding='utf-8') as f:
+                    marker = json.load(f)
+            except (OSError, ValueError):
+                marker = None
+            candidates.append({'path': path, 'size': size, 'newest': newest, 'marker': marker, 'lock': lock_file})
+        
+        keep = []
+        for entry in candidates:
+            stale = now - entry['newest'] > max_age
+            orphaned = entry['marker'] is None and now - entry['newest'] > 60
+            done = entry['marker'] and all(is_cached(entry['marker']['video_id'], quality)
+                                           for quality in entry['marker']['qualities'])
+            if stale or orphaned or done:
+                self._collect(entry['path'], entry['size'])
+            elif entry['marker']:
+                keep.append(entry)
+        # Over the size budget: drop the least recently active first
+        keep.sort(key=lambda e: e['newest'])
+        total = sum(entry['size'] for entry in keep)
+        while max_bytes and keep and total > max_bytes:
+            entry = keep.pop(0)
+            self._collect(entry['path'], entry['size'])
+            total -= entry['size']
+        
+        for entry in candidates:
+            entry['lock'].close()
+        for entry in keep:
+            marker = entry['marker']
+            try:
+                submit(marker['video_id'], marker['qualities'])
+                self.recovered += 1
+                logger.info(f"Re-queued interrupted download of {marker['video_id']} "
+                            f"({', '.join(marker['qualities'])}), {format_size(entry['size'])} on disk")
+            except Exception as e:
+                logger.error(f"Failed to re-queue {entry['path']}: {str(e)}")
+    
+    def _collect(self, path, size):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Failed to remove {path}: {str(e)}")
+            return
+        self.collected += 1
+        self.bytes_collected += size
+        logger.info(f"Removed stale work directory {path} ({format_size(size)})")
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'resumed': self.resumed,
+                'resumed_bytes': self.resumed_bytes,
+                'recovered': self.recovered,
+                'collected': self.collected,
+                'bytes_collected': self.bytes_collected
+            }
+
+_WORK_DIRS = WorkDirs(TEMP_DIR)
+
+class DownloadError(Exception):
+    """A download/conversion failure with a message safe to show the user"""
+
+class DownloadJob:
+    """State of one download request as it moves through the pipeline"""
+    
+    def __init__(self, video_id, quality):
+        self.id = uuid.uuid4().hex
+        self.video_id = video_id
+        self.quality = quality
+        self.state = 'queued'
+        self.progress = {}
+        self.error = None
+        self.title = None
+        self.output_file = None
+        self.download_name = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.timings = {}
+        self.encode_path = None
+        self.attached = 0
+        self.version = 0
+        self.on_change = None
+        self._changed = threading.Condition()
+        self._done = threading.Event()
+        # Set to kill the job's running yt-dlp/ffmpeg children
+        self.cancelled = threading.Event()
+        self.throttle = Throttle(_RATE_LIMIT.get())
+    
+    def _notify(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+        if self.on_change:
+            self.on_change(self)
+    
+    def set_state(self, state):
+        self.state = state
+        self._notify()
+    
+    def update_progress(self, progress):
+        self.progress.update(progress)
+        self._notify()
+    
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes past version; returns the new version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+    
+    @contextmanager
+    def stage(self, name):
+        """Mark the job as being in a pipeline stage and record its duration"""
+        self.set_state(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.time() - start, 3)
+    
+    def finish(self, error=None):
+        self.error = error
+        self.state = 'error' if error else 'done'
+        self.finished = time.time()
+        self._done.set()
+        self._notify()
+    
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    @property
+    def is_finished(self):
+        return self._done.is_set()
+    
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'video_id': self.video_id,
+            'quality': self.quality,
+            'state': self.state,
+            'progress': dict(self.progress),
+            'error': self.error,
+            'title': self.title,
+            'download_name': self.download_name,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'queue_wait': round(self.started - self.created, 3) if self.started else None,
+            'timings': self.timings,
+            'encode_path': self.encode_path,
+            'attached': self.attached
+        }
+
+def download_format_selector(height):
+    """yt-dlp format selector for a target height
+
+    Prefers H.264/AAC streams that can be remuxed into the final MP4
+    without re-encoding. Streams are filtered on their short side up to
+    the next rung, matching the buckets of format_rung(), so a 1920x800
+    or a vertical source downloads the stream listed for the quality.
+    """
+    if height not in [str(h) for h in STANDARD_HEIGHTS]:
+        return "best"
+    selectors = []
+    for box in rung_boxes(height):
+        selectors.append(f"bestvideo{box}[vcodec^=avc1]+bestaudio[ext=m4a]")
+        selectors.append(f"bestvideo{box}+bestaudio")
+    return "/".join(selectors + [f"best[height<={height}]", "best"])
+
+def quality_height(quality):
+    """Target height ("720") for a quality label ("720p"), defaulting to 720"""
+    height = quality.rstrip('p')
+    return height if height.isdigit() else "720"
+
+def output_download_name(title, quality):
+    """File name offered to the browser for a quality label ("Title-720p.mp4", "Title-audio.opus")"""
+    _, cache_quality, ext = parse_quality(quality)
+    return f"{sanitize_filename(title)}-{cache_quality}.{ext}"
+
+def output_path(title, video_id, quality):
+    """Path in DOWNLOAD_DIR of the cached file for a quality label"""
+    _, cache_quality, ext = parse_quality(quality)
+    return os.path.join(DOWNLOAD_DIR, cache_filename(title, video_id, cache_quality, ext))
+
+def use_cached_output(job):
+    """Point the job at its file in the download cache; returns the path or None"""
+    _, cache_quality, ext = parse_quality(job.quality)
+    cached = _DOWNLOAD_CACHE.lookup(job.video_id, cache_quality, ext)
+    if not cached:
+        return None
+    cached_file, video_title = cached
+    logger.info(f"File already exists, serving from cache: {cached_file}")
+    job.title = video_title
+    job.download_name = output_download_name(video_title, job.quality)
+    job.output_file = cached_file
+    job.update_progress({'cached': True})
+    return cached_file
+
+def adopt_legacy_output(job, video_title):
+    """Set the job's title and, if a pre-index file for it exists, adopt it into the cache"""
+    safe_title = sanitize_filename(video_title)
+    job.title = video_title
+    job.download_name = f"{safe_title}-{job.quality}.mp4"
+    
+    # Files saved before the cache index existed are named by title only;
+    # adopt one into the index instead of downloading it again
+    legacy_file = os.path.join(DOWNLOAD_DIR, f"{safe_title}-{job.quality}.mp4")
+    if os.path.exists(legacy_file) and os.path.getsize(legacy_file) > 1000000:
+        logger.info(f"File already exists, serving from cache: {legacy_file}")
+        _DOWNLOAD_CACHE.add(legacy_file, job.video_id, job.quality, 'mp4', video_title)
+        job.output_file = legacy_file
+        job.update_progress({'cached': True})
+        return legacy_file
+    return None
+
+def commit_output(job, temp_output_file, final_output_file, video_title):
+    """Move a finished file into DOWNLOAD_DIR and record it in the cache"""
+    _, cache_quality, ext = parse_quality(job.quality)
+    checksum = file_checksum(temp_output_file)
+    os.replace(temp_output_file, final_output_file)
+    _DOWNLOAD_CACHE.add(final_output_file, job.video_id, cache_quality, ext, video_title, checksum)
+    job.output_file = final_output_file
+    return final_output_file
+
+# Containers yt-dlp may leave behind for audio-only and subtitle downloads
+AUDIO_SOURCE_EXTENSIONS = ('.m4a', '.webm', '.opus', '.ogg', '.mp3', '.mp4', '.mkv', '.aac')
+SUBTITLE_SOURCE_EXTENSIONS = ('.vtt', '.srt')
+
+def pick_downloaded_file(temp_dir, extensions=CACHE_VIDEO_EXTENSIONS):
+    """Return the file yt-dlp left in temp_dir, or raise DownloadError"""
+    # Find the downloaded files
+    downloaded_files = [os.path.join(temp_dir, f) for f in os.listdir(temp_dir) if os.path.isfile(os.path.join(temp_dir, f))]
+    logger.info(f"Downloaded files: {downloaded_files}")
+    
+    if not downloaded_files:
+        logger.error("No files were downloaded")
+        raise DownloadError("No files were downloaded.")
+    
+    # Choose the best video file
+    video_file = None
+    
+    for file in downloaded_files:
+        if file.endswith(extensions):
+            # Simple approach: pick the largest file as our source
+            if not video_file or os.path.getsize(file) > os.path.getsize(video_file):
+                video_file = file
+    
+    if not video_file:
+        logger.error("No valid file found")
+        raise DownloadError("No valid file was downloaded.")
+    
+    logger.info(f"Using source file: {video_file} with size {os.path.getsize(video_file)} bytes")
+    return video_file
+
+def run_download_pipeline(job, download_slots, transcode_slots):
+    """Fetch, download and convert one video, leaving the MP4 in DOWNLOAD_DIR"""
+    video_id = job.video_id
+    quality = job.quality
+    
+    # A cache hit needs neither the network nor the metadata probe
+    cached_file = use_cached_output(job)
+    if cached_file:
+        return cached_file
+    
+    with job.stage('info'):
+        # Get video info first to get the title (usually cached by /api/info)
+        video_info = get_cached_video_info(video_id)
+    if not video_info:
+        raise DownloadError('Could not retrieve video information')
+    
+    # Get video title and sanitize it for use in filename
+    video_title = video_info.get('title', 'YouTube Video')
+    legacy_file = adopt_legacy_output(job, video_title)
+    if legacy_file:
+        return legacy_file
+    
+    # Set up the output file path
+    final_output_file = os.path.join(DOWNLOAD_DIR, cache_filename(video_title, video_id, quality, 'mp4'))
+    
+    # Get height from quality
+    height = quality_height(quality)
+    
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    # Direct download approach with ffmpeg post-processing, in a work
+    # directory that survives failures so a retry can resume
+    with _WORK_DIRS.claim(video_id, [quality], f"{height}p") as (temp_dir, resumed_bytes):
+        if resumed_bytes:
+            job.update_progress({'resumed_bytes': resumed_bytes})
+        format_selector = download_format_selector(height)
+        
+        # Build the MP4 inside the work directory and rename it into place
+        # when complete, so readers never see a half-written file
+        temp_output_file = os.path.join(temp_dir, WorkDirs.OUTPUT, "output.mp4")
+        
+        # Network stage: limited separately from the CPU-bound transcode
+        job.set_state('waiting_download')
+        with download_slots, job.stage('download'):
+            success, error_output = run_yt_dlp_download(
+                format_selector, os.path.join(temp_dir, "%(id)s.%(ext)s"), url,
+                progress_callback=job.update_progress)
+        
+        if not success:
+            logger.error(f"yt-dlp error output: {stderr_tail(error_output)}")
+            raise DownloadError("Failed to download video. Please try again later.")
+        
+        video_file = pick_downloaded_file(temp_dir)
+        _METRICS.inc('youtubedl_downloaded_bytes_total', max(0, os.path.getsize(video_file) - resumed_bytes))
+        
+        # Now convert the video file to the desired quality using ffmpeg
+        logger.info(f"Converting {video_file} to quality {quality}")
+        
+        # Only re-encode when the source is not already H.264 at or below the target
+        media = probe_media(video_file)
+        job.encode_path = choose_encode_path(media, height)
+        logger.info(f"Source media {media}, using encode path: {job.encode_path}")
+        
+        converted = False
+        if job.encode_path != "transcode":
+            # Stream copy is I/O bound, so it does not take a transcode slot
+            with job.stage('remux'):
+                converted = remux_to_mp4(video_file, temp_output_file,
+                                         copy_audio=job.encode_path == "remux",
+                                         duration=video_info.get('duration'),
+                                         progress_callback=job.update_progress)
+            if not converted:
+                job.encode_path = "transcode"
+        
+        if not converted:
+            job.set_state('waiting_transcode')
+            with transcode_slots, job.stage('transcode'):
+                converted = convert_to_mp4(video_file, temp_output_file, height,
+                                           duration=video_info.get('duration'),
+                                           progress_callback=job.update_progress)
+        
+        if converted:
+            logger.info(f"Successfully converted to quality {quality}")
+        else:
+            logger.error(f"Failed to convert {video_file} to quality {quality}")
+            
+            # Fallback: just copy the source file if conversion failed
+            logger.info(f"Falling back to original file")
+            job.encode_path = "copy_fallback"
+            shutil.copy(video_file, temp_output_file)
+        
+        if os.path.exists(temp_output_file) and os.path.getsize(temp_output_file) > 10000:
+            return commit_output(job, temp_output_file, final_output_file, video_title)
+        
+        # If we get here, something went wrong
+        logger.error(f"Final file not found or too small: {temp_output_file}")
+        raise DownloadError("Failed to process video. Please try again.")
+
+def run_rendition_pipeline(jobs, download_slots, transcode_slots):
+    """Produce several qualities of one video from a single download
+
+    The source is downloaded once, at the highest quality any of the jobs
+    needs. Jobs the source already satisfies are remuxed; the rest are
+    encoded together by one ffmpeg run that decodes the source once. Each
+    job is finished as soon as its own file is in the cache.
+    """
+    pending = []
+    for job in jobs:
+        if use_cached_output(job):
+            job.finish()
+        else:
+            pending.append(job)
+    if not pending:
+        return
+    video_id = pending[0].video_id
+    
+    with ExitStack() as stages:
+        for job in pending:
+            stages.enter_context(job.stage('info'))
+        video_info = get_cached_video_info(video_id)
+    if not video_info:
+        raise DownloadError('Could not retrieve video information')
+    
+    video_title = video_info.get('title', 'YouTube Video')
+    for job in list(pending):
+        if adopt_legacy_output(job, video_title):
+            job.finish()
+            pending.remove(job)
+    if not pending:
+        return
+    
+    heights = {job.id: quality_height(job.quality) for job in pending}
+    top_height = max(heights.values(), key=int)
+    duration = video_info.get('duration')
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    def fan_out(group):
+        # Progress of a shared step is reported to every job in it
+        return lambda progress: [job.update_progress(progress) for job in group]
+    
+    logger.info(f"Producing {[job.quality for job in pending]} of {video_id} from one {top_height}p download")
+    
+    with _WORK_DIRS.claim(video_id, [job.quality for job in pending], f"{top_height}p") as (temp_dir, resumed_bytes):
+        if resumed_bytes:
+            fan_out(pending)({'resumed_bytes': resumed_bytes})
+        for job in pending:
+            job.set_state('waiting_download')
+        with download_slots, ExitStack() as stages:
+            for job in pending:
+                stages.enter_context(job.stage('download'))
+            success, error_output = run_yt_dlp_download(
+                download_format_selector(top_height), os.path.join(temp_dir, "%(id)s.%(ext)s"), url,
+                progress_callback=fan_out(pending))
+        
+        if not success:
+            logger.error(f"yt-dlp error output: {stderr_tail(error_output)}")
+            raise DownloadError("Failed to download video. Please try again later.")
+        
+        video_file = pick_downloaded_file(temp_dir)
+        _METRICS.inc('youtubedl_downloaded_bytes_total', max(0, os.path.getsize(video_file) - resumed_bytes))
+        media = probe_media(video_file)
+        
+        outputs = {}
+        transcode = []
+        for job in pending:
+            temp_output_file = os.path.join(temp_dir, WorkDirs.OUTPUT, f"output-{job.quality}.mp4")
+            final_output_file = os.path.join(DOWNLOAD_DIR, cache_filename(video_title, video_id, job.quality, 'mp4'))
+            outputs[job.id] = (temp_output_file, final_output_file)
+            job.encode_path = choose_encode_path(media, heights[job.id])
+            if job.encode_path != "transcode":
+                with job.stage('remux'):
+                    remuxed = remux_to_mp4(video_file, temp_output_file,
+                                           copy_audio=job.encode_path == "remux",
+                                           duration=duration, progress_callback=job.update_progress)
+                if remuxed:
+                    commit_output(job, temp_output_file, final_output_file, video_title)
+                    job.finish()
+                    continue
+                job.encode_path = "transcode"
+            transcode.append(job)
+        if not transcode:
+            return
+        
+        for job in transcode:
+            job.set_state('waiting_transcode')
+        with transcode_slots, ExitStack() as stages:
+            for job in transcode:
+                stages.enter_context(job.stage('transcode'))
+            converted = False
+            if len(transcode) > 1:
+                converted = convert_to_renditions(
+                    video_file, [(heights[job.id], outputs[job.id][0]) for job in transcode],
+                    duration=duration, progress_callback=fan_out(transcode),
+                    copy_audio=bool(media) and media['audio_codec'] == 'aac')
+            if not converted:
+                # One at a time, as the single-quality pipeline would
+                for job in transcode:
+                    if not convert_to_mp4(video_file, outputs[job.id][0], heights[job.id],
+                                          duration=duration, progress_callback=job.update_progress):
+                        logger.error(f"Failed to convert {video_file} to quality {job.quality}, "
+                                     f"falling back to original file")
+                        job.encode_path = "copy_fallback"
+                        shutil.copy(video_file, outputs[job.id][0])
+        
+        for job in transcode:
+            temp_output_file, final_output_file = outputs[job.id]
+            if os.path.exists(temp_output_file) and os.path.getsize(temp_output_file) > 10000:
+                commit_output(job, temp_output_file, final_output_file, video_title)
+                job.finish()
+            else:
+                logger.error(f"Final file not found or too small: {temp_output_file}")
+                job.finish("Failed to process video. Please try again.")
+
+def prepare_output(job):
+    """Common start of the audio and subtitle pipelines: returns (video info, title)
+
+    Cache hits return (None, None) with the job already pointing at the file.
+    """
+    if use_cached_output(job):
+        return None, None
+    with job.stage('info'):
+        video_info = get_cached_video_info(job.video_id)
+    if not video_info:
+        raise DownloadError('Could not retrieve video information')
+    video_title = video_info.get('title', 'YouTube Video')
+    job.title = video_title
+    job.download_name = output_download_name(video_title, job.quality)
+    return video_info, video_title
+
+def run_audio_pipeline(job, download_slots, transcode_slots):
+    """Download only the audio stream of a video and save it as M4A, Opus or MP3
+
+    No video is fetched. The selector prefers a stream that already has
+    the target codec, which is then copied into the container; anything
+    else is encoded, taking a transcode slot.
+    """
+    video_info, video_title = prepare_output(job)
+    if not video_info:
+        return job.output_file
+    
+    _, _, ext = parse_quality(job.quality)
+    output = AUDIO_OUTPUTS[ext]
+    final_output_file = output_path(video_title, job.video_id, job.quality)
+    url = f"https://www.youtube.com/watch?v={job.video_id}"
+    
+    with _WORK_DIRS.claim(job.video_id, [job.quality], f"audio-{ext}") as (temp_dir, resumed_bytes):
+        if resumed_bytes:
+            job.update_progress({'resumed_bytes': resumed_bytes})
+        temp_output_file = os.path.join(temp_dir, WorkDirs.OUTPUT, f"output.{ext}")
+        
+        job.set_state('waiting_download')
+        with download_slots, job.stage('download'):
+            success, error_output = run_yt_dlp_download(
+                output['selector'], os.path.join(temp_dir, "%(id)s.%(ext)s"), url,
+                progress_callback=job.update_progress)
+        if not success:
+            logger.error(f"yt-dlp error output: {stderr_tail(error_output)}")
+            raise DownloadError("Failed to download audio. Please try again later.")
+        
+        audio_file = pick_downloaded_file(temp_dir, AUDIO_SOURCE_EXTENSIONS)
+        _METRICS.inc('youtubedl_downloaded_bytes_total', max(0, os.path.getsize(audio_file) - resumed_bytes))
+        media = probe_media(audio_file)
+        duration = video_info.get('duration')
+        
+        converted = False
+        if media and media['audio_codec'] == output['codec']:
+            job.encode_path = "audio_copy"
+            with job.stage('remux'):
+                converted = extract_audio(audio_file, temp_output_file, duration=duration,
+                                          progress_callback=job.update_progress)
+        if not converted:
+            job.encode_path = "audio_encode"
+            job.set_state('waiting_transcode')
+            with transcode_slots, job.stage('transcode'):
+                converted = extract_audio(audio_file, temp_output_file, output['encode'], duration=duration,
+                                          progress_callback=job.update_progress)
+        if not converted:
+            raise DownloadError("Failed to process audio. Please try again.")
+        return commit_output(job, temp_output_file, final_output_file, video_title)
+
+def run_subtitle_pipeline(job, download_slots, transcode_slots):
+    """Fetch the subtitles of one language as WebVTT, converting to SRT when asked
+
+    Subtitle files are a few KB, so this takes neither a download nor a
+    transcode slot and is not held up behind video downloads. There is
+    nothing to resume either, so it works in a throwaway directory.
+    """
+    video_info, video_title = prepare_output(job)
+    if not video_info:
+        return job.output_file
+    
+    _, cache_quality, ext = parse_quality(job.quality)
+    lang = cache_quality[len('subtitles.'):]
+    final_output_file = output_path(video_title, job.video_id, job.quality)
+    url = f"https://www.youtube.com/watch?v={job.video_id}"
+    
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=TEMP_DIR) as temp_dir:
+        with job.stage('download'):
+            success, error_output = run_yt_dlp_subtitles(lang, os.path.join(temp_dir, "%(id)s.%(ext)s"), url)
+        if not success:
+            logger.error(f"yt-dlp error output: {stderr_tail(error_output)}")
+            raise DownloadError("Failed to download subtitles. Please try again later.")
+        try:
+            subtitle_file = pick_downloaded_file(temp_dir, SUBTITLE_SOURCE_EXTENSIONS)
+        except DownloadError:
+            raise DownloadError(f"No subtitles are available in language '{lang}'.") from None
+        
+        temp_output_file = os.path.join(temp_dir, f"output.{ext}")
+        if subtitle_file.endswith(f".{ext}"):
+            job.encode_path = "subtitles_copy"
+            os.replace(subtitle_file, temp_output_file)
+        else:
+            job.encode_path = "subtitles_convert"
+            with job.stage('remux'):
+                if not convert_subtitles(subtitle_file, temp_output_file):
+                    raise DownloadError("Failed to convert subtitles. Please try again.")
+        return commit_output(job, temp_output_file, final_output_file, video_title)
+
+# Pipeline that produces each kind of output for one job
+OUTPUT_PIPELINES = {
+    'video': run_download_pipeline,
+    'audio': run_audio_pipeline,
+    'subtitles': run_subtitle_pipeline
+}
+
+def stream_format_selector(height):
+    """yt-dlp format selector for streaming: H.264/AAC only, so ffmpeg can stream-copy"""
+    selectors = [f"bestvideo{box}[vcodec^=avc1]+bestaudio[ext=m4a]" for box in rung_boxes(height)]
+    selectors += [f"best{box}[vcodec^=avc1][acodec^=mp4a]" for box in rung_boxes(height)]
+    return "/".join(selectors)
+
+def can_stream(video_info, height):
+    """Whether the formats of a video allow a stream-copied pipe download"""
+    formats = video_info.get('formats') or []
+    has_audio = any((f.get('vcodec') or 'none') == 'none' and f.get('ext') == 'm4a' for f in formats)
+    for fmt in formats:
+        vcodec = fmt.get('vcodec') or 'none'
+        if not vcodec.startswith('avc1') or not fmt.get('height') or not within_rung(format_short_side(fmt), height):
+            continue
+        if has_audio or (fmt.get('acodec') or 'none').startswith('mp4a'):
+            return True
+    return False
+
+def _drain_stderr(stream, tail):
+    for line in iter(lambda: stream.readline(ToolSupervisor.LINE_LIMIT), b''):
+        tail.append(line.decode('utf-8', errors='replace').rstrip('\n'))
+    stream.close()
+
+class StreamPipeline:
+    """yt-dlp piped into ffmpeg, producing a fragmented MP4 on stdout
+
+    yt-dlp writes the merged download to its stdout (MPEG-TS when it has to
+    merge separate video and audio), and ffmpeg stream-copies that into a
+    fragmented MP4 which can be sent to the client as it is produced. Both
+    children hold a supervisor slot of their tool until close(), and run in
+    their own process groups so close() can kill yt-dlp's own ffmpeg helper
+    too. Raises ToolBusy if the tools have no free slot.
+    """
+    
+    # Seconds to wait for tool slots before the client gets a 503
+    SLOT_TIMEOUT = 5
+    
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, format_selector, url):
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            raise DownloadError("ffmpeg not found in PATH")
+        self.tails = {'yt-dlp': deque(maxlen=20), 'ffmpeg': deque(maxlen=20)}
+        ytdlp_cmd = [
+            YT_DLP_PATH,
+            "-f", format_selector,
+            "-o", "-",
+            "--no-playlist",
+            "--no-check-certificate",
+            "--no-progress",
+            url
+        ]
+        ffmpeg_cmd = [
+            ffmpeg_path,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-i", "pipe:0",
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c", "copy",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4",
+            "pipe:1"
+        ]
+        self.commands = {'yt-dlp': ytdlp_cmd, 'ffmpeg': ffmpeg_cmd}
+        logger.info(f"Running streaming pipeline: {' '.join(ytdlp_cmd)} | {' '.join(ffmpeg_cmd)}")
+        self._slots = ExitStack()
+        try:
+            self._slots.enter_context(_SUPERVISOR.slot('yt-dlp', self.SLOT_TIMEOUT))
+            self._slots.enter_context(_SUPERVISOR.slot('ffmpeg', self.SLOT_TIMEOUT))
+            self.ytdlp = _SUPERVISOR.spawn(ytdlp_cmd, 'yt-dlp', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            self._slots.close()
+            raise
+        try:
+            self.ffmpeg = _SUPERVISOR.spawn(ffmpeg_cmd, 'ffmpeg', stdin=self.ytdlp.stdout,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            _SUPERVISOR.kill(self.ytdlp)
+            _SUPERVISOR.reap(self.ytdlp)
+            self._slots.close()
+            raise
+        # Only ffmpeg reads yt-dlp's output; closing our copy lets yt-dlp
+        # see a broken pipe if ffmpeg dies
+        self.ytdlp.stdout.close()
+        for name, process in (('yt-dlp', self.ytdlp), ('ffmpeg', self.ffmpeg)):
+            threading.Thread(target=_drain_stderr, args=(process.stderr, self.tails[name]),
+                             daemon=True).start()
+    
+    def read(self):
+        """Return the next chunk of MP4 output, or b'' at the end"""
+        return self.ffmpeg.stdout.read1(self.CHUNK_SIZE)
+    
+    def wait(self):
+        """Wait for both children; True if both succeeded"""
+        ffmpeg_code = _SUPERVISOR.reap(self.ffmpeg, self.commands['ffmpeg'])
+        ytdlp_code = _SUPERVISOR.reap(self.ytdlp, self.commands['yt-dlp'])
+        if ytdlp_code != 0 or ffmpeg_code != 0:
+            logger.error(f"Streaming pipeline failed (yt-dlp {ytdlp_code}, ffmpeg {ffmpeg_code}): "
+                         f"{stderr_tail(' / '.join(self.tails['yt-dlp']))} / "
+                         f"{stderr_tail(' / '.join(self.tails['ffmpeg']))}")
+            return False
+        return True
+    
+    def close(self):
+        """Kill both children if they are still running and free their slots"""
+        for process in (self.ytdlp, self.ffmpeg):
+            _SUPERVISOR.kill(process)
+            _SUPERVISOR.reap(process)
+        self.ffmpeg.stdout.close()
+        self._slots.close()
+
+class StreamStats:
+    """Counters and time-to-first-byte figures for pipe-mode streams"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.aborted = 0
+        self.active = 0
+        self.bytes_sent = 0
+        self._ttfb_total = 0.0
+        self._ttfb_max = 0.0
+    
+    def record_start(self, ttfb):
+        with self._lock:
+            self.started += 1
+            self.active += 1
+            self._ttfb_total += ttfb
+            self._ttfb_max = max(self._ttfb_max, ttfb)
+    
+    def record_end(self, outcome, sent):
+        with self._lock:
+            self.active -= 1
+            self.bytes_sent += sent
+            setattr(self, outcome, getattr(self, outcome) + 1)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': STREAM_CONCURRENCY,
+                'active': self.active,
+                'started': self.started,
+                'completed': self.completed,
+                'failed': self.failed,
+                'aborted': self.aborted,
+                'bytes_sent': self.bytes_sent,
+                'ttfb_avg': round(self._ttfb_total / self.started, 3) if self.started else None,
+                'ttfb_max': round(self._ttfb_max, 3)
+            }
+
+_STREAM_STATS = StreamStats()
+_STREAM_SLOTS = threading.BoundedSemaphore(STREAM_CONCURRENCY)
+
+def pid_alive(pid):
+    """Whether a process with this pid exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobStore:
+    """SQLite record of jobs shared by every server worker process
+
+    Each worker runs its own JobManager; the store lets any worker answer
+    status and file requests for a job another worker owns, and holds the
+    cross-process single-flight claim for each (video, quality).
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+    
+    def _conn(self):
+        # Called with the lock held
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    owner_pid INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    finished INTEGER NOT NULL,
+                    updated REAL NOT NULL,
+                    data TEXT NOT NULL
+                )""")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS active (
+                    video_id TEXT NOT NULL,
+                    quality TEXT NOT NULL,
+                    job_id TEXT NOT NULL,
+                    owner_pid INTEGER NOT NULL,
+                    PRIMARY KEY (video_id, quality)
+                )""")
+        return self._db
+    
+    @staticmethod
+    def _row(job):
+        data = job.to_dict()
+        data['output_file'] = job.output_file
+        return (job.id, os.getpid(), job.state, int(job.is_finished), time.time(), json.dumps(data))
+    
+    def save(self, job):
+        with self._lock:
+            self._conn().execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", self._row(job))
+    
+    def load(self, job_id):
+        """Return (data, version) for a job, or None if it is unknown"""
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT owner_pid, finished, updated, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        owner_pid, finished, updated, data = row
+        data = json.loads(data)
+        if not finished and not pid_alive(owner_pid):
+            # The owning worker died mid-job; report it instead of waiting forever
+            data['state'] = 'error'
+            data['error'] = 'The server worker running this job exited before it finished'
+            data['finished'] = updated
+        return data, updated
+    
+    def claim(self, job):
+        """Record job and claim its (video, quality); returns the id of a live job already holding it"""
+        video_id, quality = job.video_id, job.quality
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("""
+                    SELECT active.job_id, active.owner_pid FROM active
+                    JOIN jobs ON jobs.id = active.job_id
+                    WHERE active.video_id = ? AND active.quality = ? AND jobs.finished = 0""",
+                    (video_id, quality)).fetchone()
+                if row and row[1] != os.getpid() and pid_alive(row[1]):
+                    db.execute("COMMIT")
+                    return row[0]
+                db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", self._row(job))
+                db.execute("INSERT OR REPLACE INTO active VALUES (?, ?, ?, ?)",
+                           (video_id, quality, job.id, os.getpid()))
+                db.execute("COMMIT")
+                return None
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+    
+    def release(self, video_id, quality, job_id):
+        with self._lock:
+            self._conn().execute("DELETE FROM active WHERE video_id = ? AND quality = ? AND job_id = ?",
+                                 (video_id, quality, job_id))
+    
+    def prune(self, cutoff):
+        with self._lock:
+            self._conn().execute("DELETE FROM jobs WHERE finished = 1 AND updated < ?", (cutoff,))
+    
+    def states(self):
+        """Count unfinished jobs of live workers by state"""
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT owner_pid, state, COUNT(*) FROM jobs WHERE finished = 0 GROUP BY owner_pid, state").fetchall()
+        states = {}
+        for owner_pid, state, count in rows:
+            if pid_alive(owner_pid):
+                states[state] = states.get(state, 0) + count
+        return states
+
+class RemoteJob:
+    """Read-only view of a job owned by another server worker process"""
+    
+    POLL_INTERVAL = 0.5
+    
+    def __init__(self, store, job_id, data, version):
+        self._store = store
+        self.id = job_id
+        self._apply(data, version)
+    
+    def _apply(self, data, version):
+        self.data = data
+        self.version = version
+        self.state = data['state']
+        self.error = data['error']
+        self.output_file = data.get('output_file')
+        self.download_name = data['download_name']
+    
+    def refresh(self):
+        loaded = self._store.load(self.id)
+        if loaded:
+            self._apply(*loaded)
+    
+    @property
+    def is_finished(self):
+        return self.state in ('done', 'error')
+    
+    def wait_for_change(self, version, timeout):
+        deadline = time.time() + timeout
+        while self.version == version and not self.is_finished and time.time() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            self.refresh()
+        return self.version
+    
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.is_finished and (deadline is None or time.time() < deadline):
+            time.sleep(self.POLL_INTERVAL)
+            self.refresh()
+        return self.is_finished
+    
+    def to_dict(self):
+        data = dict(self.data)
+        data.pop('output_file', None)
+        return data
+
+class ShuttingDown(Exception):
+    """Raised when a job is submitted while the server is draining"""
+
+class JobManager:
+    """Runs download jobs on a bounded worker pool
+
+    Workers are limited overall, and inside a job the network download and
+    the CPU transcode each take a slot from their own semaphore, so a burst
+    of downloads cannot start more encoders than the box has room for.
+    Requests for a (video, quality) that is already in progress attach to
+    the running job instead of starting a second download, including jobs
+    run by other server worker processes through the shared JobStore.
+    """
+    
+    # Minimum seconds between progress-only writes to the job store
+    STORE_INTERVAL = 1.0
+    
+    def __init__(self, workers, download_concurrency, transcode_concurrency, retention, store):
+        self.workers = workers
+        self.retention = retention
+        self.store = store
+        self.download_slots = threading.BoundedSemaphore(download_concurrency)
+        self.transcode_slots = threading.BoundedSemaphore(transcode_concurrency)
+        self.limits = {
+            'workers': workers,
+            'download_concurrency': download_concurrency,
+            'transcode_concurrency': transcode_concurrency
+        }
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stage_totals = {}
+        self.encode_paths = {}
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self._accepting = True
+        self._saved = {}
+    
+    def submit(self, video_id, quality):
+        with self._lock:
+            job, created = self._claim(video_id, quality)
+        if created:
+            # The job's log records keep the id of the request that queued it
+            self._executor.submit(contextvars.copy_context().run, self._run, job)
+            logger.info(f"Queued job {job.id} for {video_id} ({quality})")
+        return job
+    
+    def submit_batch(self, video_id, qualities):
+        """Queue several qualities of one video, to be made from a single download
+
+        Returns one job per quality. Qualities already in progress attach to
+        their running jobs; the new video qualities share one
+        run_rendition_pipeline call, and audio or subtitle outputs run as
+        jobs of their own.
+        """
+        with self._lock:
+            claimed = [self._claim(video_id, quality) for quality in qualities]
+        created = [job for job, is_new in claimed if is_new]
+        videos = [job for job in created if parse_quality(job.quality)[0] == 'video']
+        for job in videos[1:]:
+            job.cancelled = videos[0].cancelled
+            job.throttle = videos[0].throttle
+        for job in created:
+            if len(videos) == 1 or job not in videos:
+                self._executor.submit(contextvars.copy_context().run, self._run, job)
+        if len(videos) > 1:
+            self._executor.submit(contextvars.copy_context().run, self._run_batch, videos)
+        if created:
+            logger.info(f"Queued jobs {[job.id for job in created]} for {video_id} "
+                        f"({', '.join(job.quality for job in created)})")
+        return [job for job, _ in claimed]
+    
+    def claim(self, video_id, quality):
+        """Take the single-flight key for work run outside the worker pool
+
+        Returns (job, created) like _claim: an existing job to attach to, or a
+        new one that the caller runs and ends with finish_claimed().
+        """
+        with self._lock:
+            job, created = self._claim(video_id, quality)
+        if created:
+            job.started = time.time()
+        return job, created
+    
+    def finish_claimed(self, job, error=None):
+        """End a job taken with claim()
+
+        If it failed while other requests were attached to it, the job is
+        handed to the worker pool and downloaded normally for them instead.
+        """
+        with self._lock:
+            handover = bool(error) and job.attached > 0 and self._accepting and not job.cancelled.is_set()
+        if handover:
+            logger.info(f"Job {job.id} failed outside the worker pool ({error}), "
+                        f"downloading it for {job.attached} attached requests")
+            job.encode_path = None
+            job.set_state('queued')
+            self._executor.submit(contextvars.copy_context().run, self._run, job)
+            return
+        job.finish(error)
+        self._release(job)
+    
+    def _claim(self, video_id, quality):
+        # Called with the lock held; returns (job, whether it is new)
+        key = (video_id, quality)
+        if not self._accepting:
+            raise ShuttingDown("Server is shutting down, please retry shortly")
+        existing = self._active.get(key)
+        if existing and not existing.is_finished:
+            # Single flight: share the in-progress job
+            existing.attached += 1
+            self.deduplicated += 1
+            logger.info(f"Attached request for {video_id} ({quality}) to job {existing.id}")
+            # A user waiting on a prefetch job should not get its off-peak speed limit
+            if not _RATE_LIMIT.get() and existing.throttle.lift():
+                logger.info(f"Lifted the download rate limit of job {existing.id}")
+            return existing, False
+        job = DownloadJob(video_id, quality)
+        job.on_change = self._persist
+        # Another worker process may already be downloading this key
+        owner = self.store.claim(job)
+        while owner:
+            loaded = self.store.load(owner)
+            if loaded and loaded[0]['state'] not in ('done', 'error'):
+                self.deduplicated += 1
+                logger.info(f"Attached request for {video_id} ({quality}) to job {owner} of another worker")
+                return RemoteJob(self.store, owner, *loaded), False
+            # It finished in the meantime; try to take the key over
+            owner = self.store.claim(job)
+        self._prune()
+        self._jobs[job.id] = job
+        self._active[key] = job
+        return job, True
+    
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job:
+            return job
+        loaded = self.store.load(job_id)
+        return RemoteJob(self.store, job_id, *loaded) if loaded else None
+    
+    def _persist(self, job):
+        # Write state changes immediately and progress at a bounded rate
+        now = time.time()
+        saved_state, saved_at = self._saved.get(job.id, (None, 0))
+        if job.state == saved_state and not job.is_finished and now - saved_at < self.STORE_INTERVAL:
+            return
+        self._saved[job.id] = (job.state, now)
+        try:
+            self.store.save(job)
+        except Exception as e:
+            logger.error(f"Failed to save job {job.id}: {str(e)}")
+        if job.is_finished:
+            self._saved.pop(job.id, None)
+    
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+    
+    def cancel(self, job_id):
+        """Cancel a job of this worker, killing its children; False if unknown here
+
+        Jobs of one batch share their download, so cancelling one cancels all.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if not job:
+            return False
+        if not job.is_finished:
+            logger.info(f"Cancelling job {job_id}")
+            job.cancel()
+        return True
+    
+    def _run(self, job):
+        job.started = time.time()
+        with log_context(job_id=job.id), cancel_scope(job.cancelled), throttle_scope(job.throttle):
+            try:
+                pipeline = OUTPUT_PIPELINES[parse_quality(job.quality)[0]]
+                pipeline(job, self.download_slots, self.transcode_slots)
+                job.finish()
+            except DownloadError as e:
+                job.finish("Cancelled" if job.cancelled.is_set() else str(e))
+            except Exception as e:
+                logger.error(f"Error during download/conversion: {str(e)}")
+                job.finish("Cancelled" if job.cancelled.is_set() else f"Processing error: {str(e)}")
+            self._release(job)
+    
+    def _run_batch(self, jobs):
+        started = time.time()
+        for job in jobs:
+            job.started = started
+        error = None
+        # The jobs share one download, so they share one cancel event
+        with log_context(job_id=','.join(job.id for job in jobs)), cancel_scope(jobs[0].cancelled), \
+                throttle_scope(jobs[0].throttle):
+            try:
+                run_rendition_pipeline(jobs, self.download_slots, self.transcode_slots)
+            except DownloadError as e:
+                error = str(e)
+            except Exception as e:
+                logger.error(f"Error during download/conversion: {str(e)}")
+                error = f"Processing error: {str(e)}"
+        if jobs[0].cancelled.is_set():
+            error = "Cancelled"
+        for job in jobs:
+            if not job.is_finished:
+                job.finish(error or "Processing error: rendition was not produced")
+            with log_context(job_id=job.id):
+                self._release(job)
+    
+    def _release(self, job):
+        with self._lock:
+            if self._active.get((job.video_id, job.quality)) is job:
+                del self._active[(job.video_id, job.quality)]
+        try:
+            self.store.release(job.video_id, job.quality, job.id)
+        except Exception as e:
+            logger.error(f"Failed to release job {job.id}: {str(e)}")
+        self._record(job)
+        logger.info(f"Job {job.id} finished with state {job.state} in "
+                    f"{job.finished - job.created:.1f}s (timings: {job.timings})",
+                    extra={'video_id': job.video_id, 'quality': job.quality, 'state': job.state,
+                           'durations': dict(job.timings, queue_wait=round(job.started - job.created, 3),
+                                             total=round(job.finished - job.created, 3))})
+    
+    def _record(self, job):
+        with self._lock:
+            if job.error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            if job.encode_path:
+                self.encode_paths[job.encode_path] = self.encode_paths.get(job.encode_path, 0) + 1
+            _METRICS.inc('youtubedl_jobs_total', result='error' if job.error else 'done',
+                         encode_path=job.encode_path or ('cached' if job.progress.get('cached') else 'none'))
+            _METRICS.observe('youtubedl_job_queue_wait_seconds', job.started - job.created)
+            stages = dict(job.timings, queue_wait=job.started - job.created)
+            for name, seconds in stages.items():
+                total = self._stage_totals.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+                total['count'] += 1
+                total['total'] += seconds
+                total['max'] = max(total['max'], seconds)
+    
+    def _prune(self):
+        # Forget finished jobs once their result has been retained long enough
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.is_finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+        self.store.prune(cutoff)
+    
+    def shutdown(self, timeout):
+        """Stop accepting jobs and wait up to timeout for queued and running ones"""
+        with self._lock:
+            self._accepting = False
+            pending = [job for job in self._jobs.values() if not job.is_finished]
+        logger.info(f"Draining {len(pending)} download jobs (up to {timeout}s)")
+        deadline = time.time() + timeout
+        for job in pending:
+            job.wait(max(0, deadline - time.time()))
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        unfinished = [job for job in pending if not job.is_finished]
+        for job in unfinished:
+            # Kill the job's children instead of leaving them to run on
+            job.cancel()
+            job.finish("Server shut down before the job finished")
+        logger.info(f"Job queue drained, {len(unfinished)} jobs abandoned")
+    
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {
+                'limits': self.limits,
+                'queue_depth': states.get('queued', 0),
+                'states': states,
+                'all_workers_states': self.store.states(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'deduplicated': self.deduplicated,
+                'encode_paths': dict(self.encode_paths),
+                'stage_timings': {
+                    name: {
+                        'count': t['count'],
+                        'avg': round(t['total'] / t['count'], 3),
+                        'max': round(t['max'], 3)
+                    }
+                    for name, t in self._stage_totals.items()
+                }
+            }
+
+_JOBS = JobManager(JOB_WORKERS, JOB_DOWNLOAD_CONCURRENCY, JOB_TRANSCODE_CONCURRENCY, JOB_RETENTION,
+                   JobStore(JOB_STORE_FILE or os.path.join(DOWNLOAD_DIR, ".jobs.sqlite3")))
+
+class HostRateLimiter:
+    """Token bucket per host, with exponential backoff after failures
+
+    acquire() blocks until the host has a token and is not backing off.
+    Each failure doubles the host's backoff (with jitter) up to max_backoff,
+    and a success resets it.
+    """
+    
+    def __init__(self, rate, burst, backoff, max_backoff):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    def _host(self, host):
+        # Called with the lock held
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {'tokens': float(self.burst), 'updated': time.time(),
+                                         'failures': 0, 'blocked_until': 0.0}
+        return state
+    
+    def acquire(self, host, cancelled=None):
+        """Wait for a token for host; returns False if cancelled() became true"""
+        while True:
+            with self._lock:
+                state = self._host(host)
+                now = time.time()
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+                state['updated'] = now
+                if now >= state['blocked_until'] and state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return True
+                wait = max(state['blocked_until'] - now, (1 - state['tokens']) / self.rate if self.rate else 1)
+            if cancelled and cancelled():
+                return False
+            time.sleep(min(wait, 1.0))
+    
+    def success(self, host):
+        with self._lock:
+            self._host(host)['failures'] = 0
+    
+    def failure(self, host):
+        """Record a failed request and return the backoff in seconds"""
+        with self._lock:
+            state = self._host(host)
+            state['failures'] += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (state['failures'] - 1))
+            delay *= random.uniform(0.8, 1.2)
+            state['blocked_until'] = max(state['blocked_until'], time.time() + delay)
+            return delay
+    
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                host: {
+                    'failures': state['failures'],
+                    'backoff_remaining': round(max(0.0, state['blocked_until'] - now), 1)
+                }
+                for host, state in self._hosts.items()
+            }
+
+def youtube_entry_id(entry):
+    """Video id of a flat playlist entry, or None if it is not a YouTube video"""
+    video_id = entry.get('id')
+    if not video_id or not re.match(r'^[\w-]{11}$', video_id):
+        return None
+    if entry.get('ie_key') not in (None, 'Youtube'):
+        return None
+    return video_id
+
+class PlaylistIngest:
+    """One playlist or channel being archived
+
+    The entry list is flat-extracted once. Entries already in the download
+    cache are skipped; the rest go through the job queue, at most
+    `concurrency` at a time and paced by the shared per-host rate limiter.
+    A failed entry is retried after the host's backoff.
+    """
+    
+    def __init__(self, url, quality, concurrency, attempts, max_entries):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.quality = quality
+        self.concurrency = max(1, concurrency)
+        self.attempts = max(1, attempts)
+        self.max_entries = max_entries
+        self.state = 'extracting'
+        self.title = None
+        self.error = None
+        self.entries = []
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+    
+    def _set(self, entry, **fields):
+        with self._lock:
+            entry.update(fields)
+    
+    def run(self, extractor, submit, limiter):
+        try:
+            extracted = extractor(self.url, self.max_entries)
+            if not extracted:
+                self.error = 'Could not retrieve the playlist'
+                return
+            self.title, raw_entries = extracted
+            for raw in raw_entries[:self.max_entries]:
+                video_id = youtube_entry_id(raw)
+                entry = {'video_id': video_id or raw.get('id'), 'title': raw.get('title'), 'url': raw.get('url'),
+                         'state': 'pending', 'job_id': None, 'attempts': 0, 'error': None}
+                if not video_id:
+                    entry['state'] = 'unsupported'
+                elif output_cached(video_id, self.quality):
+                    entry['state'] = 'cached'
+                self.entries.append(entry)
+            self.state = 'downloading'
+            logger.info(f"Ingest {self.id}: {len(self.entries)} entries from {self.url}")
+            
+            pending = [entry for entry in self.entries if entry['state'] == 'pending']
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ingest') as executor:
+                for entry in pending:
+                    executor.submit(self._download, entry, submit, limiter)
+        except Exception as e:
+            logger.error(f"Ingest {self.id} failed: {str(e)}")
+            self.error = f"Processing error: {str(e)}"
+        finally:
+            self.state = 'cancelled' if self.cancelled else 'error' if self.error else 'done'
+            self.finished = time.time()
+            logger.info(f"Ingest {self.id} finished with state {self.state}: {self.counts()}")
+    
+    def _download(self, entry, submit, limiter):
+        host = urllib.parse.urlparse(entry['url'] or '').netloc or 'www.youtube.com'
+        while entry['attempts'] < self.attempts and not self.cancelled:
+            if not limiter.acquire(host, lambda: self.cancelled):
+                break
+            self._set(entry, state='downloading', attempts=entry['attempts'] + 1)
+            try:
+                job = submit(entry['video_id'], self.quality)
+            except ShuttingDown as e:
+                self._set(entry, state='cancelled', error=str(e))
+                return
+            self._set(entry, job_id=job.id)
+            job.wait()
+            if not job.error:
+                limiter.success(host)
+                self._set(entry, state='done', error=None)
+                return
+            delay = limiter.failure(host)
+            logger.warning(f"Ingest {self.id}: {entry['video_id']} failed (attempt {entry['attempts']}), "
+                           f"backing off {host} for {delay:.0f}s: {job.error}")
+            self._set(entry, state='retrying', error=job.error)
+        self._set(entry, state='cancelled' if self.cancelled else 'failed')
+    
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for entry in self.entries:
+                counts[entry['state']] = counts.get(entry['state'], 0) + 1
+            return counts
+    
+    @property
+    def is_finished(self):
+        return self.finished is not None
+    
+    def to_dict(self, with_entries=True):
+        counts = self.counts()
+        total = len(self.entries)
+        settled = sum(counts.get(state, 0) for state in ('done', 'cached', 'failed', 'unsupported', 'cancelled'))
+        data = {
+            'ingest_id': self.id,
+            'url': self.url,
+            'quality': self.quality,
+            'title': self.title,
+            'state': self.state,
+            'error': self.error,
+            'total': total,
+            'counts': counts,
+            'percent': round(settled * 100 / total, 1) if total else None,
+            'created': self.created,
+            'finished': self.finished
+        }
+        if with_entries:
+            with self._lock:
+                data['entries'] = [dict(entry) for entry in self.entries]
+        return data
+
+class IngestManager:
+    """Runs playlist ingests in the background and keeps them queryable"""
+    
+    def __init__(self, limiter, retention, extractor=None, submit=None):
+        self.limiter = limiter
+        self.retention = retention
+        self.extractor = extractor or extract_playlist_entries
+        self.submit = submit or _JOBS.submit
+        self._ingests = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def start(self, url, quality, max_entries=INGEST_MAX_ENTRIES):
+        ingest = PlaylistIngest(url, quality, INGEST_CONCURRENCY, INGEST_ATTEMPTS, max_entries)
+        with self._lock:
+            cutoff = time.time() - self.retention
+            for ingest_id in [i.id for i in self._ingests.values() if i.is_finished and i.finished < cutoff]:
+                del self._ingests[ingest_id]
+            self._ingests[ingest.id] = ingest
+        threading.Thread(target=ingest.run, args=(self.extractor, self.submit, self.limiter),
+                         name=f"ingest-{ingest.id[:8]}", daemon=True).start()
+        return ingest
+    
+    def get(self, ingest_id):
+        with self._lock:
+            return self._ingests.get(ingest_id)
+    
+    def ingests(self):
+        with self._lock:
+            return list(self._ingests.values())
+
+_INGESTS = IngestManager(HostRateLimiter(INGEST_RATE, INGEST_BURST, INGEST_BACKOFF, INGEST_BACKOFF_MAX),
+                         JOB_RETENTION)
+
+# A video id in a watch-list URL (watch?v=, youtu.be/, /shorts/, /embed/), or a bare id
+WATCHLIST_URL_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/)([A-Za-z0-9_-]{11})')
+
+def parse_prefetch_window(window):
+    """(start, end) minutes of the day of an "HH:MM-HH:MM" window, or None if it is empty"""
+    if not window:
+        return None
+    try:
+        bounds = []
+        for part in window.split('-'):
+            hours, minutes = part.strip().split(':')
+            bounds.append(int(hours) * 60 + int(minutes))
+        start, end = bounds
+    except ValueError:
+        raise ValueError(f"Invalid prefetch window '{window}', expected HH:MM-HH:MM")
+    return start, end
+
+class Prefetcher:
+    """Refreshes popular and watch-listed videos into the caches off-peak
+
+    Each pass takes the watch-list entries and the most requested videos and
+    qualities from the request history. It re-probes metadata that expires
+    within refresh_ahead seconds, then queues the renditions missing from
+    the download cache through the job queue, one at a time, so peak-hour
+    requests are cache hits. A pass stops when the window closes, waits
+    while the machine is busier than cpu_budget, downloads with yt-dlp's
+    rate limit and skips files that would exceed the byte budget or the
+    prefetch share of the cache quota.
+    """
+    
+    # Seconds between load checks while the machine is too busy
+    BUSY_WAIT = 30
+    
+    def __init__(self, window, watchlist=None, top=20, min_requests=2, interval=1800, refresh_ahead=900,
+                 cpu_budget=0.5, rate_limit=0, max_bytes=0, cache_share=0.9, job_timeout=3600, submit=None):
+        self.window_text = window or None
+        self.window = parse_prefetch_window(window)
+        self.watchlist = watchlist
+        self.top = top
+        self.min_requests = min_requests
+        self.interval = interval
+        self.refresh_ahead = refresh_ahead
+        self.cpu_budget = cpu_budget
+        self.rate_limit = rate_limit
+        self.max_bytes = max_bytes
+        self.cache_share = cache_share
+        self.job_timeout = job_timeout
+        self.submit = submit or _JOBS.submit
+        self.passes = 0
+        self.last_pass = None
+        self.counts = {}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.window is not None
+    
+    def in_window(self, now=None):
+        if not self.window:
+            return False
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        start, end = self.window
+        # A window like 22:00-05:00 wraps past midnight
+        return start <= minute < end if start <= end else minute >= start or minute < end
+    
+    def seconds_until_window(self, now=None):
+        now = now or time.time()
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        return ((self.window[0] - minute) % 1440) * 60 - local.tm_sec
+    
+    def _count(self, kind, result):
+        with self._lock:
+            key = f"{kind}_{result}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+        _METRICS.inc('youtubedl_prefetch_total', kind=kind, result=result)
+    
+    def read_watchlist(self):
+        """(video id, qualities) of each watch-list line; lines that do not parse are skipped"""
+        if not self.watchlist or not os.path.exists(self.watchlist):
+            return []
+        entries = []
+        with open(self.watchlist, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                match = WATCHLIST_URL_RE.search(fields[0])
+                video_id = match.group(1) if match else fields[0]
+                qualities = fields[1:] or ['720p']
+                try:
+                    if not VIDEO_ID_RE.match(video_id):
+                        raise ValueError(f"'{fields[0]}' is not a video id or URL")
+                    for quality in qualities:
+                        parse_quality(quality)
+                except ValueError as e:
+                    logger.warning(f"Skipping line {number} of {self.watchlist}: {str(e)}")
+                    continue
+                entries.append((video_id, qualities))
+        return entries
+    
+    def candidates(self):
+        """Ordered {video id: [qualities]}: the watch-list first, then the most requested"""
+        videos = OrderedDict()
+        for video_id, qualities in self.read_watchlist():
+            videos.setdefault(video_id, [])
+            videos[video_id] += [q for q in qualities if q not in videos[video_id]]
+        popular = 0
+        for video_id, quality, _ in _DOWNLOAD_CACHE.popular(self.min_requests):
+            if popular >= self.top:
+                break
+            popular += 1
+            qualities = videos.setdefault(video_id, [])
+            if not quality or quality in qualities:
+                continue
+            try:
+                parse_quality(quality)
+            except ValueError:
+                continue
+            qualities.append(quality)
+        return videos
+    
+    def _wait_for_cpu(self):
+        """Wait until the load average per CPU is within budget; False if the pass should stop"""
+        while True:
+            if self._stop.is_set() or not self.in_window():
+                return False
+            try:
+                load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            except (AttributeError, OSError):
+                # No load average on this platform
+                return True
+            if load <= self.cpu_budget:
+                return True
+            logger.debug(f"Prefetch waiting: load {load:.2f} per CPU is over {self.cpu_budget}")
+            self._stop.wait(self.BUSY_WAIT)
+    
+    def _fits(self, video_info, quality, fetched):
+        """Whether downloading quality stays within the byte budget and the cache quota"""
+        estimate = next((fmt.get('filesize') or 0 for fmt in get_available_formats(video_info)
+                         if fmt['quality'] == quality), 0)
+        if self.max_bytes and fetched + estimate > self.max_bytes:
+            return False
+        if _DOWNLOAD_CACHE.max_bytes:
+            return _DOWNLOAD_CACHE.stats()['bytes'] + estimate <= _DOWNLOAD_CACHE.max_bytes * self.cache_share
+        return shutil.disk_usage(DOWNLOAD_DIR).free > estimate * 2
+    
+    def run_pass(self):
+        """Refresh every candidate once, or until the window closes or a budget runs out"""
+        start = time.time()
+        fetched = 0
+        videos = self.candidates()
+        logger.info(f"Prefetch pass over {len(videos)} videos")
+        for video_id, qualities in videos.items():
+            if not self._wait_for_cpu():
+                break
+            
+            expires = _METADATA_CACHE.expires(video_id)
+            if expires is None or expires - time.time() < self.refresh_ahead:
+                video_info = refresh_video_info(video_id)
+                self._count('metadata', 'refreshed' if video_info else 'error')
+            else:
+                video_info = _METADATA_CACHE.peek(video_id)
+                self._count('metadata', 'fresh')
+            if not video_info:
+                continue
+            
+            for quality in qualities:
+                if output_cached(video_id, quality):
+                    self._count('download', 'cached')
+                    continue
+                if not self._fits(video_info, quality, fetched):
+                    self._count('download', 'over_budget')
+                    continue
+                if not self._wait_for_cpu():
+                    break
+                # The job takes the rate limit from the context it is queued from
+                token = _RATE_LIMIT.set(self.rate_limit)
+                try:
+                    job = self.submit(video_id, quality)
+                except ShuttingDown:
+                    return
+                finally:
+                    _RATE_LIMIT.reset(token)
+                if not job.wait(self.job_timeout):
+                    logger.warning(f"Prefetch of {video_id} ({quality}) still running after "
+                                   f"{self.job_timeout}s, moving on")
+                    # Stop it unless a user request is waiting on it too
+                    if isinstance(job, DownloadJob) and not job.attached:
+                        job.cancel()
+                    self._count('download', 'timeout')
+                    continue
+                if job.error:
+                    logger.warning(f"Prefetch of {video_id} ({quality}) failed: {job.error}")
+                    self._count('download', 'error')
+                    continue
+                self._count('download', 'done')
+                if job.output_file and os.path.exists(job.output_file):
+                    fetched += os.path.getsize(job.output_file)
+        with self._lock:
+            self.passes += 1
+            self.last_pass = {'started': start, 'seconds': round(time.time() - start, 1), 'bytes': fetched}
+        logger.info(f"Prefetch pass done in {time.time() - start:.1f}s, {format_size(fetched)} downloaded")
+    
+    def run(self):
+        """Run passes in the window every interval seconds until stopped"""
+        while not self._stop.is_set():
+            if self.in_window():
+                try:
+                    self.run_pass()
+                except Exception as e:
+                    logger.error(f"Prefetch pass failed: {str(e)}")
+                self._stop.wait(self.interval)
+            else:
+                self._stop.wait(min(self.interval, max(60, self.seconds_until_window())))
+    
+    def stop(self):
+        self._stop.set()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'window': self.window_text,
+                'in_window': self.in_window(),
+                'watchlist': self.watchlist,
+                'passes': self.passes,
+                'last_pass': self.last_pass,
+                **self.counts
+            }
+
+_PREFETCHER = Prefetcher(PREFETCH_WINDOW, PREFETCH_WATCHLIST or None, PREFETCH_TOP, PREFETCH_MIN_REQUESTS,
+                         PREFETCH_INTERVAL, PREFETCH_REFRESH_AHEAD, PREFETCH_CPU_BUDGET, PREFETCH_RATE_LIMIT,
+                         PREFETCH_MAX_BYTES, PREFETCH_CACHE_SHARE, PREFETCH_JOB_TIMEOUT)
+
+def serve_download(path, download_name, as_attachment=True, mimetype="video/mp4"):
+    """Send a file from DOWNLOAD_DIR, or hand it to the fronting web server
+
+    Served from Python, send_file answers Range requests (resume and
+    in-browser seeking) and If-None-Match/If-Modified-Since itself. With an
+    offload mode the response only carries headers and the web server
+    streams the bytes and handles Range, freeing the Python thread.
+    """
+    start = time.time()
+    response = _build_download_response(path, download_name, as_attachment, mimetype)
+    mode = FILE_OFFLOAD or 'python'
+    # Counted at hand-off: file bodies are passed straight through to the
+    # server (sendfile), which skips the response's close callbacks
+    if response.status_code in (200, 206):
+        _METRICS.inc('youtubedl_served_bytes_total', response.content_length or 0, mode=mode)
+    _METRICS.observe('youtubedl_serve_seconds', time.time() - start, mode=mode)
+    return response
+
+def _build_download_response(path, download_name, as_attachment, mimetype):
+    if not app.config['USE_X_SENDFILE']:
+        return send_file(path, as_attachment=as_attachment, download_name=download_name,
+                         mimetype=mimetype, conditional=True)
+    
+    response = send_file(path, as_attachment=as_attachment, download_name=download_name,
+                         mimetype=mimetype, conditional=False)
+    # Only answer 304s here; Range is left to the web server
+    response = response.make_conditional(request.environ)
+    if FILE_OFFLOAD == 'x-accel-redirect':
+        sendfile_path = response.headers.pop('X-Sendfile', None)
+        if sendfile_path:
+            relative = os.path.relpath(sendfile_path, DOWNLOAD_DIR)
+            response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX + urllib.parse.quote(relative)
+    if response.status_code == 304:
+        response.headers.pop('X-Sendfile', None)
+        response.headers.pop('X-Accel-Redirect', None)
+    return response
+
+def output_mimetype(path):
+    """Content type of a cached file by its extension; None lets send_file guess"""
+    return OUTPUT_MIMETYPES.get(path.rsplit('.', 1)[-1])
+
+def send_job_file(job):
+    """Send the finished file of a job as an attachment"""
+    logger.info(f"Serving file: {job.output_file}")
+    return serve_download(job.output_file, job.download_name, mimetype=output_mimetype(job.output_file))
+
+# Video ids as they appear in thumbnail URLs (also a safe directory name)
+THUMB_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def thumbnail_format():
+    """(format, whether it was negotiated from Accept) of a /api/thumb request"""
+    fmt = request.args.get('format')
+    if fmt is not None:
+        return fmt, False
+    # Only an explicit image/webp counts; */* is sent by clients without WebP support too
+    accepts_webp = any(mimetype == 'image/webp' for mimetype, _ in request.accept_mimetypes)
+    return 'webp' if accepts_webp and _THUMBS.webp is not False else 'jpeg', True
+
+def thumbnail_is_cached():
+    """Whether /api/thumb can answer without running ffmpeg (or will refuse the request anyway)"""
+    video_id = request.view_args['video_id']
+    fmt, _ = thumbnail_format()
+    if not THUMB_ID_RE.match(video_id) or fmt not in ThumbnailCache.FORMATS:
+        return True
+    return _THUMBS.cached(video_id, _THUMBS.width_for(request.args.get('w', THUMB_DEFAULT_WIDTH, type=int)), fmt)
+
+def upstream_thumbnail(video_id):
+    """Send the browser to YouTube's own thumbnail rather than show a broken image"""
+    _METRICS.inc('youtubedl_thumbnail_requests_total', result='upstream')
+    response = redirect(_THUMBS.upstream_url(video_id))
+    response.cache_control.max_age = ThumbnailCache.FAILURE_TTL
+    return response
+
+@app.route('/api/thumb/<video_id>')
+@admission_controlled('thumb', thumbnail_is_cached,
+                      refused=lambda e: upstream_thumbnail(request.view_args['video_id']))
+def get_thumbnail(video_id):
+    """Cached, resized video thumbnail (?w=width, ?format=webp|jpeg)"""
+    if not THUMB_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    
+    fmt, negotiated = thumbnail_format()
+    if fmt not in ThumbnailCache.FORMATS:
+        return jsonify({'error': 'Format must be webp or jpeg'}), 400
+    width = _THUMBS.width_for(request.args.get('w', THUMB_DEFAULT_WIDTH, type=int))
+    
+    hits = _THUMBS.hits
+    path = _THUMBS.get(video_id, width, fmt)
+    if path is None and fmt == 'webp' and _THUMBS.webp is False and negotiated:
+        fmt = 'jpeg'
+        path = _THUMBS.get(video_id, width, fmt)
+    if path is None:
+        return upstream_thumbnail(video_id)
+    _METRICS.inc('youtubedl_thumbnail_requests_total', result='hit' if _THUMBS.hits > hits else 'made')
+    
+    response = send_file(path, mimetype=ThumbnailCache.FORMATS[fmt][1], conditional=True, etag=True,
+                         max_age=THUMB_MAX_AGE)
+    response.cache_control.public = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+def download_is_cached():
+    """Whether /api/download or /api/stream can send a cached file (or will refuse the request anyway)"""
+    video_id = request.args.get('id', '')
+    if not VIDEO_ID_RE.match(video_id):
+        return True
+    try:
+        return output_cached(video_id, request.args.get('quality', '720p'))
+    except ValueError:
+        return True
+
+@app.route('/api/download')
+@admission_controlled('download', download_is_cached)
+def download_video():
+    video_id = request.args.get('id')
+    quality = request.args.get('quality', '720p')
+    
+    if not video_id:
+        return jsonify({'error': 'Missing video ID'}), 400
+    if not VIDEO_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    try:
+        parse_quality(quality)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    _DOWNLOAD_CACHE.record_request(video_id, quality)
+    
+    try:
+        # Run through the job queue so concurrency limits apply, then block
+        job = _JOBS.submit(video_id, quality)
+        # From here the job queue bounds the work; waiting for it takes no admission slot
+        release_admission()
+        if not job.wait(DOWNLOAD_WAIT_TIMEOUT):
+            return jsonify({'error': 'Download is still in progress, please retry shortly',
+                            'job_id': job.id, 'status_url': f"/api/jobs/{job.id}"}), 503, {'Retry-After': '30'}
+        if job.error:
+            return jsonify({'error': job.error}), 500
+        return send_job_file(job)
+    except ShuttingDown as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error(f"Download error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/stream')
+@admission_controlled('stream', download_is_cached)
+def stream_video():
+    """Send an MP4 while it is still being downloaded
+
+    Opt-in alternative to /api/download: yt-dlp and ffmpeg run as a pipe
+    and their fragmented MP4 output goes straight to the client, so the
+    first bytes arrive within seconds instead of after the whole download.
+    The stream is also written to the download cache, and is kept if it
+    completes. Cached videos are served as normal files; audio/subtitle
+    outputs and videos without an H.264/AAC rendition are redirected to
+    /api/download.
+    
+    A stream runs as a job under the single-flight key of its video and
+    quality: when a download of it is already running the client is sent
+    to /api/download, which attaches to that job, and downloads requested
+    during a stream wait for the streamed file. If the stream fails or its
+    client goes away, those waiting downloads continue in the job queue.
+    """
     video_id = request.args.get('id')
+    quality = request.args.get('quality', '720p')
+    as_attachment = request.args.get('download') == '1'
+    
     if not video_id:
         return jsonify({'error': 'Missing video ID'}), 400
+    if not VIDEO_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    try:
+        kind, _, _ = parse_quality(quality)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if kind != 'video':
+        return redirect(f"/api/download?{urllib.parse.urlencode({'id': video_id, 'quality': quality})}")
+    _DOWNLOAD_CACHE.record_request(video_id, quality)
+    
+    cached = _DOWNLOAD_CACHE.lookup(video_id, quality, 'mp4')
+    if cached:
+        cached_file, video_title = cached
+        return serve_download(cached_file, f"{sanitize_filename(video_title)}-{quality}.mp4",
+                              as_attachment=as_attachment)
+    
+    video_info = get_cached_video_info(video_id)
+    if not video_info:
+        return jsonify({'error': 'Could not retrieve video information'}), 500
     
+    height = quality_height(quality)
+    if not can_stream(video_info, height):
+        logger.info(f"No streamable H.264/AAC format for {video_id} at {quality}, using /api/download")
+        return redirect(f"/api/download?{urllib.parse.urlencode({'id': video_id, 'quality': quality})}")
+    
+    # Take the same single-flight key as download jobs, so a stream and a
+    # download of one video are never two fetches
     try:
-        # Get video info using yt-dlp
-        video_info_data = get_video_info_with_yt_dlp(video_id)
-        
-        if video_info_data:
-            title = video_info_data.get('title', 'YouTube Video')
-            thumbnail = video_info_data.get('thumbnail', f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg")
-            duration = video_info_data.get('duration', 0)
-            
-            # Get available formats from format list
-            formats = get_available_formats(video_id)
-            
-            # If no formats were found, use standard options
-            if not formats:
-                formats = [
-                    {'quality': '360p', 'available': True},
-                    {'quality': '480p', 'available': True},
-                    {'quality': '720p', 'available': True},
-                    {'quality': '1080p', 'available': True}
-                ]
-                
-            response = {
-                'id': video_id,
-                'title': title,
-                'thumbnail': thumbnail,
-                'duration': duration,
-                'available_formats': formats
-            }
-        else:
-            # Fallback to basic info
-            response = {
-                'id': video_id,
-                'title': 'YouTube Video',
-                'thumbnail': f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg",
-                'available_formats': [
-                    {'quality': '360p', 'available': True},
-                    {'quality': '480p', 'available': True},
-                    {'quality': '720p', 'available': True},
-                    {'quality': '1080p', 'available': True}
-                ]
-            }
-        
-        return jsonify(response)
-    except Exception as e:
-        logger.error(f"Error getting info: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-
-def combine_audio_video(video_file, audio_file, output_file):
-    """Combine video and audio files using ffmpeg"""
+        job, created = _JOBS.claim(video_id, quality)
+    except ShuttingDown as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    if not created:
+        logger.info(f"{video_id} at {quality} is already being fetched by job {job.id}, using /api/download")
+        return redirect(f"/api/download?{urllib.parse.urlencode({'id': video_id, 'quality': quality})}")
+    
+    if not _STREAM_SLOTS.acquire(blocking=False):
+        _JOBS.finish_claimed(job, 'Too many streams in progress')
+        return jsonify({'error': 'Too many streams in progress, please retry shortly'}), 503, {'Retry-After': '5'}
+    
+    video_title = video_info.get('title', 'YouTube Video')
+    final_output_file = os.path.join(DOWNLOAD_DIR, cache_filename(video_title, video_id, quality, 'mp4'))
+    download_name = f"{sanitize_filename(video_title)}-{quality}.mp4"
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    job.title = video_title
+    job.encode_path = 'stream'
+    job.set_state('streaming')
+    start = time.time()
     try:
-        ffmpeg_path = shutil.which("ffmpeg")
-        if not ffmpeg_path:
-            logger.warning("ffmpeg not found in PATH")
-            return False
-        
-        # Command to combine video and audio
-        cmd = [
-            ffmpeg_path,
-            "-i", video_file,
-            "-i", audio_file,
-            "-c:v", "copy",       # Copy video without re-encoding
-            "-c:a", "aac",        # Convert audio to AAC
-            "-strict", "experimental",
-            "-y",                 # Overwrite output file if it exists
-            output_file
-        ]
-        
-        logger.info(f"Running ffmpeg combine command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 10000:
-            logger.info(f"Successfully combined files to MP4: {output_file}")
-            return True
-        else:
-            logger.error(f"Combination failed: {result.stderr}")
-            return False
+        pipeline = StreamPipeline(stream_format_selector(height), url)
+    except ToolBusy as e:
+        _STREAM_SLOTS.release()
+        _JOBS.finish_claimed(job, str(e))
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
     except Exception as e:
-        logger.error(f"Error during combination: {str(e)}")
-        return False
+        _STREAM_SLOTS.release()
+        _JOBS.finish_claimed(job, str(e))
+        logger.error(f"Failed to start streaming pipeline: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    # Wait for the first chunk before answering, so a failed download can
+    # still get a proper error response
+    timer = threading.Timer(STREAM_FIRST_BYTE_TIMEOUT, pipeline.close)
+    timer.start()
+    try:
+        first_chunk = pipeline.read()
+    except Exception:
+        first_chunk = b''
+    finally:
+        timer.cancel()
+    if not first_chunk:
+        pipeline.close()
+        pipeline.wait()
+        _STREAM_SLOTS.release()
+        _JOBS.finish_claimed(job, 'Stream produced no output')
+        return jsonify({'error': 'Failed to download video. Please try again later.'}), 500
+    ttfb = time.time() - start
+    _STREAM_STATS.record_start(ttfb)
+    logger.info(f"Streaming {video_id} at {quality}, first byte after {ttfb:.2f}s")
+    
+    result = {'outcome': 'aborted', 'sent': 0}
+    
+    def generate():
+        fd, temp_output_file = tempfile.mkstemp(suffix='.mp4', dir=TEMP_DIR)
+        digest = hashlib.sha256()
+        reported = time.time()
+        try:
+            with os.fdopen(fd, 'wb') as tee:
+                chunk = first_chunk
+                while chunk:
+                    if job.cancelled.is_set():
+                        result['outcome'] = 'cancelled'
+                        return
+                    tee.write(chunk)
+                    digest.update(chunk)
+                    # GeneratorExit is raised here if the client goes away
+                    yield chunk
+                    result['sent'] += len(chunk)
+                    if time.time() - reported >= 1:
+                        reported = time.time()
+                        job.update_progress({'downloaded_bytes': result['sent']})
+                    chunk = pipeline.read()
+            result['outcome'] = 'completed' if pipeline.wait() else 'failed'
+            if result['outcome'] == 'completed' and os.path.getsize(temp_output_file) > 10000:
+                os.replace(temp_output_file, final_output_file)
+                _DOWNLOAD_CACHE.add(final_output_file, video_id, quality, 'mp4', video_title, digest.hexdigest())
+                job.output_file = final_output_file
+                job.download_name = download_name
+                logger.info(f"Stream of {video_id} at {quality} complete, cached as {final_output_file}")
+        finally:
+            try:
+                os.remove(temp_output_file)
+            except FileNotFoundError:
+                pass
+    
+    closed = threading.Lock()
+    
+    def close():
+        # Runs when the server closes the response, whether or not the
+        # body was ever iterated
+        if not closed.acquire(blocking=False):
+            return
+        pipeline.close()
+        _STREAM_SLOTS.release()
+        _STREAM_STATS.record_end(result['outcome'], result['sent'])
+        _METRICS.inc('youtubedl_served_bytes_total', result['sent'], mode='stream')
+        if result['outcome'] != 'completed':
+            logger.info(f"Stream of {video_id} at {quality} {result['outcome']} after {format_size(result['sent'])}")
+        _JOBS.finish_claimed(job, None if job.output_file else f"Stream {result['outcome']}")
+    
+    disposition = 'attachment' if as_attachment else 'inline'
+    response = Response(generate(), mimetype='video/mp4', headers={
+        'Content-Disposition': f"{disposition}; filename*=UTF-8''{urllib.parse.quote(download_name)}",
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+        'Server-Timing': f"ttfb;dur={ttfb * 1000:.0f}"
+    })
+    response.call_on_close(close)
+    return response
 
-def convert_to_mp4(input_file, output_file, height=None):
-    """Convert any video file to MP4 using ffmpeg with optional scaling"""
+def job_is_cached():
+    """Whether POST /api/jobs will finish from the cache (or refuse the request anyway)"""
+    params = request.get_json(silent=True) or request.values
+    video_id = params.get('id') or ''
+    if not VIDEO_ID_RE.match(video_id):
+        return True
     try:
-        ffmpeg_path = shutil.which("ffmpeg")
-        if not ffmpeg_path:
-            logger.warning("ffmpeg not found in PATH")
-            return False
-        
-        # Set video bitrate based on quality
-        bitrate_map = {
-            "1080": "4M",  # 1080p
-            "720": "2.5M",  # 720p
-            "480": "1M",    # 480p
-            "360": "700k",  # 360p
-        }
-        
-        # Set scale resolution based on quality
-        scale_map = {
-            "1080": "1920:1080",
-            "720": "1280:720",
-            "480": "854:480",
-            "360": "640:360"
-        }
-        
-        # Base command
-        cmd = [
-            ffmpeg_path,
-            "-i", input_file,
-            "-c:v", "libx264",     # Use H.264 for video
-            "-c:a", "aac",         # Use AAC for audio
-            "-b:a", "128k",        # Audio bitrate
-            "-strict", "experimental",
-            "-y"                   # Overwrite output file if it exists
-        ]
-        
-        # Add scaling and bitrate if height is specified
-        if height and height in ["360", "480", "720", "1080"]:
-            bitrate = bitrate_map.get(height, "2M")
-            scale = scale_map.get(height, "1280:720")
-            
-            cmd.extend([
-                "-vf", f"scale={scale}", # Scale to resolution
-                "-b:v", bitrate,         # Video bitrate
-                "-maxrate", bitrate,
-                "-bufsize", "2M",
-                "-preset", "fast",       # Faster encoding
-                "-movflags", "+faststart" # Web optimization
-            ])
-        
-        cmd.append(output_file)
-        
-        logger.info(f"Running ffmpeg conversion command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 10000:
-            logger.info(f"Successfully converted to MP4: {output_file}")
-            return True
-        else:
-            logger.error(f"Conversion failed: {result.stderr}")
-            return False
-    except Exception as e:
-        logger.error(f"Error during conversion: {str(e)}")
-        return False
+        return output_cached(video_id, params.get('quality', '720p'))
+    except ValueError:
+        return True
 
-def format_size(size_bytes):
-    """Format file size in human-readable format"""
-    if size_bytes < 1024:
-        return f"{size_bytes} bytes"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes/1024:.1f} KB"
-    elif size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes/(1024*1024):.1f} MB"
-    else:
-        return f"{size_bytes/(1024*1024*1024):.1f} GB"
+def batch_is_cached():
+    """Whether every quality of POST /api/jobs/batch is cached (or the request will be refused anyway)"""
+    params = request.get_json(silent=True) or request.values
+    video_id = params.get('id') or ''
+    qualities = params.get('qualities') or []
+    if isinstance(qualities, str):
+        qualities = qualities.split(',')
+    if not VIDEO_ID_RE.match(video_id):
+        return True
+    try:
+        return all(output_cached(video_id, q.strip()) for q in qualities if q and q.strip())
+    except (ValueError, AttributeError):
+        return True
 
-def sanitize_filename(filename):
-    """Sanitize a string to be used as a filename"""
-    # Remove invalid characters for filenames across operating systems
-    filename = re.sub(r'[\\/*?:"<>|]', '', filename)
-    # Replace multiple spaces with a single space
-    filename = re.sub(r'\s+', ' ', filename).strip()
-    # Limit filename length (most filesystems have limits around 255 chars)
-    if len(filename) > 100:
-        filename = filename[:97] + '...'
-    return filename
+@app.route('/api/jobs', methods=['POST'])
+@admission_controlled('jobs', job_is_cached)
+def create_job():
+    """Queue a download and return its job id immediately"""
+    params = request.get_json(silent=True) or request.values
+    video_id = params.get('id')
+    quality = params.get('quality', '720p')
+    
+    if not video_id:
+        return jsonify({'error': 'Missing video ID'}), 400
+    if not VIDEO_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    try:
+        parse_quality(quality)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    _DOWNLOAD_CACHE.record_request(video_id, quality)
+    
+    try:
+        job = _JOBS.submit(video_id, quality)
+    except ShuttingDown as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    response = job.to_dict()
+    response['status_url'] = f"/api/jobs/{job.id}"
+    response['file_url'] = f"/api/jobs/{job.id}/file"
+    return jsonify(response), 202
 
-@app.route('/api/download')
-def download_video():
-    video_id = request.args.get('id')
-    quality = request.args.get('quality', '720p')
+@app.route('/api/jobs/batch', methods=['POST'])
+@admission_controlled('jobs_batch', batch_is_cached)
+def create_batch_jobs():
+    """Queue several qualities of one video, produced from a single download"""
+    params = request.get_json(silent=True) or request.values
+    video_id = params.get('id')
+    qualities = params.get('qualities') or []
+    if isinstance(qualities, str):
+        qualities = qualities.split(',')
+    # Keep the order but drop duplicates and blanks
+    qualities = list(OrderedDict.fromkeys(q.strip() for q in qualities if q and q.strip()))
     
     if not video_id:
         return jsonify({'error': 'Missing video ID'}), 400
+    if not VIDEO_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    if not qualities:
+        return jsonify({'error': 'Missing qualities'}), 400
+    try:
+        for quality in qualities:
+            parse_quality(quality)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    for quality in qualities:
+        _DOWNLOAD_CACHE.record_request(video_id, quality)
     
     try:
-        # Get video info first to get the title
-        video_info = get_video_info_with_yt_dlp(video_id)
-        if not video_info:
-            return jsonify({'error': 'Could not retrieve video information'}), 500
-        
-        # Get video title and sanitize it for use in filename
-        video_title = video_info.get('title', 'YouTube Video')
-        # Sanitize title for filename use
-        safe_title = sanitize_filename(video_title)
-        
-        # Set up the output file path
-        quality_suffix = quality.lower().replace('p', '')
-        final_output_file = os.path.join(DOWNLOAD_DIR, f"{safe_title}-{quality}.mp4")
-        
-        # If the final MP4 file already exists and is valid, serve it
-        if os.path.exists(final_output_file) and os.path.getsize(final_output_file) > 1000000:
-            logger.info(f"File already exists, serving from cache: {final_output_file}")
-            return send_file(
-                final_output_file,
-                as_attachment=True,
-                download_name=f"{safe_title}-{quality}.mp4",
-                mimetype="video/mp4"
-            )
-        
-        # Get height from quality
-        height = quality.rstrip('p')
-        if not height.isdigit():
-            height = "720"  # Default if not a valid number
-        
-        url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Direct download approach with ffmpeg post-processing
-        temp_dir = tempfile.mkdtemp(dir=TEMP_DIR)
-        logger.info(f"Created temporary directory: {temp_dir}")
-        
-        try:
-            # Modified approach: Download video directly at the requested format
-            # This simplifies the process and avoids the problematic merge step
-            temp_video_path = os.path.join(temp_dir, f"{video_id}_temp.mp4")
-            
-            # Choose format based on quality
-            format_selector = {
-                "360": "bestvideo[height<=360]+bestaudio/best[height<=360]/best",
-                "480": "bestvideo[height<=480]+bestaudio/best[height<=480]/best",
-                "720": "bestvideo[height<=720]+bestaudio/best[height<=720]/best",
-                "1080": "bestvideo[height<=1080]+bestaudio/best[height<=1080]/best"
-            }.get(height, "best")
-            
-            # Use yt-dlp to download but skip the merge step - we'll do it with ffmpeg
-            cmd = [
-                YT_DLP_PATH,
-                "-f", format_selector,
-                "-o", os.path.join(temp_dir, "%(id)s.%(ext)s"),
-                "--no-playlist",
-                "--no-check-certificate",
-                url
-            ]
-            
-            logger.info(f"Running yt-dlp download command: {' '.join(cmd)}")
-            
-            # Execute the download
-            process = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-            
-            logger.info(f"yt-dlp download completed with return code: {process.returncode}")
-            
-            if process.returncode != 0:
-                logger.error(f"yt-dlp error output: {process.stderr}")
-                return jsonify({"error": "Failed to download video. Please try again later."}), 500
-            
-            # Find the downloaded files
-            downloaded_files = [os.path.join(temp_dir, f) for f in os.listdir(temp_dir) if os.path.isfile(os.path.join(temp_dir, f))]
-            logger.info(f"Downloaded files: {downloaded_files}")
-            
-            if not downloaded_files:
-                logger.error("No files were downloaded")
-                return jsonify({"error": "No video files were downloaded."}), 500
-            
-            # Choose the best video and audio files
-            video_file = None
-            audio_file = None
-            
-            for file in downloaded_files:
-                if file.endswith(('.mp4', '.webm', '.mkv')):
-                    # Simple approach: pick the largest file as our source
-                    if not video_file or os.path.getsize(file) > os.path.getsize(video_file):
-                        video_file = file
-            
-            if not video_file:
-                logger.error("No valid video file found")
-                return jsonify({"error": "No valid video file was downloaded."}), 500
-            
-            logger.info(f"Using source file: {video_file} with size {os.path.getsize(video_file)} bytes")
-            
-            # Now convert the video file to the desired quality using ffmpeg
-            logger.info(f"Converting {video_file} to quality {quality}")
-            
-            if convert_to_mp4(video_file, final_output_file, height):
-                logger.info(f"Successfully converted to quality {quality}")
-                
-                # Serve the file
-                if os.path.exists(final_output_file) and os.path.getsize(final_output_file) > 10000:
-                    logger.info(f"Serving file: {final_output_file}")
-                    return send_file(
-                        final_output_file,
-                        as_attachment=True,
-                        download_name=f"{safe_title}-{quality}.mp4",
-                        mimetype="video/mp4"
-                    )
-                else:
-                    logger.error(f"Final file not found or too small: {final_output_file}")
+        jobs = _JOBS.submit_batch(video_id, qualities)
+    except ShuttingDown as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    response = []
+    for job in jobs:
+        entry = job.to_dict()
+        entry['status_url'] = f"/api/jobs/{job.id}"
+        entry['file_url'] = f"/api/jobs/{job.id}/file"
+        response.append(entry)
+    return jsonify({'jobs': response}), 202
+
+@app.route('/api/jobs')
+def list_jobs():
+    """List known jobs together with queue statistics"""
+    return jsonify({
+        'stats': _JOBS.stats(),
+        'jobs': [job.to_dict() for job in _JOBS.jobs()]
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+def get_job(job_id):
+    """Job state and progress; DELETE cancels the job and kills its processes"""
+    job = _JOBS.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    if request.method == 'DELETE' and not _JOBS.cancel(job_id):
+        return jsonify({'error': 'Job is running in another server worker'}), 409
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/events')
+def get_job_events(job_id):
+    """Stream job state and progress as Server-Sent Events until it finishes"""
+    job = _JOBS.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    def generate():
+        version = None
+        while True:
+            # Read the finished flag first so the last event carries the final state
+            finished = job.is_finished
+            if job.version != version:
+                version = job.version
+                yield f"data: {json.dumps(job.to_dict())}\n\n"
             else:
-                logger.error(f"Failed to convert {video_file} to quality {quality}")
-                
-                # Fallback: just copy the source file if conversion failed
-                logger.info(f"Falling back to original file")
-                shutil.copy(video_file, final_output_file)
-                
-                if os.path.exists(final_output_file) and os.path.getsize(final_output_file) > 10000:
-                    logger.info(f"Serving original file as fallback: {final_output_file}")
-                    return send_file(
-                        final_output_file,
-                        as_attachment=True,
-                        download_name=f"{safe_title}-{quality}.mp4",
-                        mimetype="video/mp4"
-                    )
-            
-            # If we get here, something went wrong
-            return jsonify({"error": "Failed to process video. Please try again."}), 500
-            
-        except Exception as e:
-            logger.error(f"Error during download/conversion: {str(e)}")
-            return jsonify({"error": f"Processing error: {str(e)}"}), 500
-        finally:
-            # Clean up temp directory
-            try:
-                shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up temporary directory: {temp_dir}")
-            except Exception as cleanup_error:
-                logger.error(f"Failed to clean up temp directory: {str(cleanup_error)}")
-            
+                # Nothing new within the keep-alive interval
+                yield ": keep-alive\n\n"
+            if finished:
+                return
+            job.wait_for_change(version, SSE_KEEPALIVE)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/jobs/<job_id>/file')
+def get_job_file(job_id):
+    job = _JOBS.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.error:
+        return jsonify({'error': job.error, 'state': job.state}), 500
+    if not job.is_finished:
+        return jsonify({'error': 'Job is not finished yet', 'state': job.state}), 409
+    try:
+        return send_job_file(job)
     except Exception as e:
-        logger.error(f"Download error: {str(e)}")
+        logger.error(f"Error serving job file: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/playlists', methods=['POST'])
+@admission_controlled('playlists', lambda: False)
+def create_ingest():
+    """Archive a playlist or channel: queue every entry not already cached"""
+    params = request.get_json(silent=True) or request.values
+    url = params.get('url')
+    playlist_id = params.get('list')
+    quality = params.get('quality', '720p')
+    if not url and playlist_id:
+        url = f"https://www.youtube.com/playlist?list={urllib.parse.quote(playlist_id)}"
+    
+    if not url:
+        return jsonify({'error': 'Missing playlist URL'}), 400
+    if urllib.parse.urlparse(url).scheme not in ('http', 'https'):
+        return jsonify({'error': 'Invalid playlist URL'}), 400
+    try:
+        parse_quality(quality)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        max_entries = max(1, min(int(params.get('max_entries', INGEST_MAX_ENTRIES)), INGEST_MAX_ENTRIES))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid max_entries'}), 400
+    
+    ingest = _INGESTS.start(url, quality, max_entries)
+    response = ingest.to_dict(with_entries=False)
+    response['status_url'] = f"/api/playlists/{ingest.id}"
+    return jsonify(response), 202
+
+@app.route('/api/playlists')
+def list_ingests():
+    return jsonify({
+        'ingests': [ingest.to_dict(with_entries=False) for ingest in _INGESTS.ingests()],
+        'hosts': _INGESTS.limiter.stats()
+    })
+
+@app.route('/api/playlists/<ingest_id>', methods=['GET', 'DELETE'])
+def get_ingest(ingest_id):
+    """Aggregate and per-entry progress of an ingest; DELETE stops starting new entries"""
+    ingest = _INGESTS.get(ingest_id)
+    if not ingest:
+        return jsonify({'error': 'Unknown ingest'}), 404
+    if request.method == 'DELETE':
+        ingest.cancelled = True
+    return jsonify(ingest.to_dict())
+
+@app.route('/api/files/<path:filename>')
+def get_download_file(filename):
+    """Serve a file from DOWNLOAD_DIR by name, inline unless ?download=1"""
+    file_path = safe_join(DOWNLOAD_DIR, filename)
+    if not file_path or not filename.endswith(CACHE_MEDIA_EXTENSIONS) or not os.path.isfile(file_path):
+        return jsonify({'error': 'File not found'}), 404
+    as_attachment = request.args.get('download') == '1'
+    return serve_download(file_path, os.path.basename(filename), as_attachment=as_attachment,
+                          mimetype=output_mimetype(filename))
+
+def hit_ratio(counters, name, hit='hit'):
+    """hits / lookups for a lookups counter, or None before the first lookup"""
+    series = {json.loads(key).get('result'): value for key, value in counters.get(name, {}).items()}
+    lookups = sum(series.values())
+    return round(series.get(hit, 0) / lookups, 4) if lookups else None
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, summed over all server worker processes"""
+    if SERVER_WORKERS > 1:
+        _METRICS.dump(METRICS_DIR)
+    snapshot = _METRICS.merged(METRICS_DIR if SERVER_WORKERS > 1 else None)
+    cache = _DOWNLOAD_CACHE.stats()
+    thumbnails = _THUMBS.stats()
+    subprocesses = _SUPERVISOR.stats()
+    admission = _ADMISSION.stats()
+    tools = tool_versions()
+    gauges = [
+        ('youtubedl_jobs_in_flight', 'Unfinished download jobs of all workers by state',
+         [({'state': state}, count) for state, count in sorted(_JOBS.store.states().items())]),
+        ('youtubedl_download_cache_hit_ratio', 'Share of download cache lookups that were hits',
+         [({}, value) for value in [hit_ratio(snapshot['counters'], 'youtubedl_cache_lookups_total')] if value is not None]),
+        ('youtubedl_metadata_cache_hit_ratio', 'Share of metadata cache lookups that were hits',
+         [({}, value) for value in [hit_ratio(snapshot['counters'], 'youtubedl_metadata_cache_lookups_total')]
+          if value is not None]),
+        ('youtubedl_download_cache_bytes', 'Bytes of finished files in the download cache', [({}, cache['bytes'])]),
+        ('youtubedl_download_cache_entries', 'Files in the download cache', [({}, cache['entries'])]),
+        ('youtubedl_download_cache_max_bytes', 'Download cache quota in bytes (0 is unlimited)',
+         [({}, cache['max_bytes'])]),
+        ('youtubedl_thumbnail_cache_bytes', 'Bytes of source images and variants in the thumbnail cache',
+         [({}, thumbnails['bytes'])]),
+        ('youtubedl_subprocesses_running', 'Supervised child processes running in this worker, by tool',
+         [({'tool': tool}, count) for tool, count in sorted(subprocesses['running'].items())]),
+        ('youtubedl_subprocesses_waiting', 'Calls waiting for a child process slot in this worker, by tool',
+         [({'tool': tool}, count) for tool, count in sorted(subprocesses['waiting'].items())]),
+        ('youtubedl_admission_in_flight', 'Admitted /api/info and /api/download requests running in this worker',
+         [({}, admission['in_flight'])]),
+        ('youtubedl_admission_queued', 'Requests waiting for admission in this worker', [({}, admission['queued'])]),
+        ('youtubedl_log_records_dropped', 'Log records dropped because the log queue was full',
+         [({}, _LOGGING.stats()['dropped'])]),
+        ('youtubedl_tool_info', 'Versions of the external tools, detected at startup', [
+            ({'tool': 'ffmpeg', 'version': tools['ffmpeg_version']}, 1),
+            ({'tool': 'yt-dlp', 'version': tools['yt_dlp_version']}, 1)
+        ])
+    ]
+    return Response(_METRICS.render(snapshot, gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/debug')
 def debug_info():
     try:
-        # Try to get ffmpeg version
-        try:
-            ffmpeg_path = shutil.which('ffmpeg') or os.path.join(FFMPEG_PATH, "ffmpeg")
-            result = subprocess.run([ffmpeg_path, "-version"], 
-                                   capture_output=True, text=True, timeout=5)
-            ffmpeg_version = result.stdout.split('\n')[0] if result.returncode == 0 else "Error"
-        except Exception as e:
-            ffmpeg_version = f"Error: {str(e)}"
+        # Detected once per process, not on every request
+        tools = tool_versions()
         
-        # Try to get yt-dlp version
-        try:
-            yt_dlp_version = "Not installed"
-            if os.path.exists(YT_DLP_PATH):
-                result = subprocess.run([YT_DLP_PATH, "--version"], 
-                                      capture_output=True, text=True, timeout=5)
-                yt_dlp_version = result.stdout.strip() if result.returncode == 0 else "Error"
-        except Exception as e:
-            yt_dlp_version = f"Error: {str(e)}"
-            
         # List directory contents
         try:
             dir_contents = os.listdir(BASE_DIR)
@@ -482,12 +5273,33 @@ def debug_info():
             temp_contents = "Not available"
             
         return jsonify({
-            'ffmpeg_path': ffmpeg_path,
-            'ffmpeg_exists': os.path.exists(ffmpeg_path),
-            'ffmpeg_version': ffmpeg_version,
-            'yt_dlp_path': YT_DLP_PATH,
-            'yt_dlp_exists': os.path.exists(YT_DLP_PATH),
-            'yt_dlp_version': yt_dlp_version,
+            'ffmpeg_path': tools['ffmpeg_path'],
+            'ffmpeg_exists': tools['ffmpeg_exists'],
+            'ffmpeg_version': tools['ffmpeg_version'],
+            'yt_dlp_path': tools['yt_dlp_path'],
+            'yt_dlp_exists': tools['yt_dlp_exists'],
+            'yt_dlp_version': tools['yt_dlp_version'],
+            'yt_dlp_module_version': tools['yt_dlp_module_version'],
+            'engine': ENGINE,
+            'file_offload': FILE_OFFLOAD or None,
+            'inprocess_engine_active': use_inprocess_engine(),
+            'metadata_cache': _METADATA_CACHE.stats(),
+            'jobs': _JOBS.stats(),
+            'download_cache': _DOWNLOAD_CACHE.stats(),
+            'thumbnails': _THUMBS.stats(),
+            'work_dirs': _WORK_DIRS.stats(),
+            'encode': {
+                'profile': ENCODE_PROFILE,
+                'profiles': ENCODE_PROFILES,
+                'cpu_budget': ENCODE_CPU_BUDGET,
+                'threads_per_transcode': encoder_threads()
+            },
+            'streams': _STREAM_STATS.stats(),
+            'subprocesses': _SUPERVISOR.stats(),
+            'admission': _ADMISSION.stats(),
+            'prefetch': _PREFETCHER.stats(),
+            'popular': _DOWNLOAD_CACHE.popular()[:20],
+            'logging': _LOGGING.stats(),
             'python_version': sys.version,
             'html_file_path': HTML_FILE,
             'html_file_exists': os.path.exists(HTML_FILE),
@@ -498,48 +5310,172 @@ def debug_info():
             'downloads_contents': downloads_contents,
             'temp_contents': temp_contents,
             'path_environment': os.environ.get('PATH', ''),
-            'system_ffmpeg': shutil.which('ffmpeg')
+            'system_ffmpeg': tools['ffmpeg_path'] if tools['ffmpeg_exists'] else None,
+            'setup_seconds': _STARTUP.get('seconds')
         })
     except Exception as e:
         return jsonify({'error': str(e)})
 
+def describe_download(filename, stat):
+    """Listing entry for one file in DOWNLOAD_DIR"""
+    # Cache names carry "[video id]" before the quality; older files are
+    # "{title}-{quality}.ext", and titles themselves may contain hyphens
+    video_id = None
+    name_match = CACHE_FILENAME_RE.match(filename)
+    quality_match = re.search(r'-(360p|480p|720p|1080p)\.(mp4|webm|mkv)$', filename)
+    if name_match:
+        title = name_match.group('title')
+        video_id = name_match.group('id')
+        quality = name_match.group('quality')
+    elif quality_match:
+        title = filename[:quality_match.start()]
+        quality = quality_match.group(1)
+    else:
+        title = filename.rsplit('.', 1)[0]
+        quality = "Unknown"
+    ext = filename.rsplit('.', 1)[-1]
+    
+    return {
+        'filename': filename,
+        'title': title,
+        'video_id': video_id,
+        'kind': 'audio' if ext in AUDIO_OUTPUTS else 'subtitles' if ext in SUBTITLE_FORMATS else 'video',
+        'quality': quality,
+        'thumbnail_url': f"/api/thumb/{video_id}" if video_id else None,
+        'path': os.path.join(DOWNLOAD_DIR, filename),
+        'url': f"/api/files/{urllib.parse.quote(filename)}",
+        'size': stat.st_size,
+        'size_formatted': format_size(stat.st_size),
+        'modified': stat.st_mtime,
+        'modified_formatted': time.ctime(stat.st_mtime)
+    }
+
+class DownloadsIndex:
+    """In-memory listing of DOWNLOAD_DIR kept fresh by mtime-diff scanning
+
+    The directory's own mtime changes whenever a file is added, renamed
+    or removed, so most refreshes are a single stat(). When it does change
+    only files whose size or mtime differ are re-described. A periodic full
+    rescan covers filesystems with coarse timestamps.
+    
+    The digest identifies the listing by its (name, size, mtime) entries, so
+    server workers that see the same files agree on it and workers that
+    scanned at different times do not.
+    """
+    
+    def __init__(self, directory, rescan_interval=30):
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self.digest = self._digest({})
+        self._entries = {}
+        self._dir_mtime = None
+        self._last_scan = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _digest(entries):
+        listing = sorted((name, entry['size'], entry['modified']) for name, entry in entries.items())
+        return hashlib.sha1(repr(listing).encode()).hexdigest()
+    
+    def refresh(self):
+        """Rescan the directory if it may have changed; returns the digest of the listing"""
+        with self._lock:
+            try:
+                dir_mtime = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                dir_mtime = None
+            if dir_mtime == self._dir_mtime and time.time() - self._last_scan < self.rescan_interval:
+                return self.digest
+            
+            changed = False
+            seen = set()
+            if dir_mtime is not None:
+                with os.scandir(self.directory) as it:
+                    for dir_entry in it:
+                        if not dir_entry.name.endswith(CACHE_MEDIA_EXTENSIONS) or not dir_entry.is_file():
+                            continue
+                        seen.add(dir_entry.name)
+                        stat = dir_entry.stat()
+                        current = self._entries.get(dir_entry.name)
+                        if current and current['size'] == stat.st_size and current['modified'] == stat.st_mtime:
+                            continue
+                        self._entries[dir_entry.name] = describe_download(dir_entry.name, stat)
+                        changed = True
+            for filename in set(self._entries) - seen:
+                del self._entries[filename]
+                changed = True
+            
+            self._dir_mtime = dir_mtime
+            self._last_scan = time.time()
+            if changed:
+                self.digest = self._digest(self._entries)
+            return self.digest
+    
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+_DOWNLOADS_INDEX = DownloadsIndex(DOWNLOAD_DIR)
+
+LIST_SORT_KEYS = {
+    'modified': lambda f: f['modified'],
+    'title': lambda f: f['title'].lower(),
+    'size': lambda f: f['size'],
+    'quality': lambda f: int(f['quality'].rstrip('p')) if f['quality'].rstrip('p').isdigit() else 0
+}
+
 @app.route('/api/list-downloads')
 def list_downloads():
-    """List all downloaded files"""
-    try:
-        files = []
-        
-        # Check main download directory
-        if os.path.exists(DOWNLOAD_DIR):
-            for filename in os.listdir(DOWNLOAD_DIR):
-                if filename.endswith(('.mp4', '.webm', '.mkv')):
-                    file_path = os.path.join(DOWNLOAD_DIR, filename)
-                    size = os.path.getsize(file_path)
-                    modified = os.path.getmtime(file_path)
-                    
-                    # Extract title and quality from filename
-                    # Filename format should be "{title}-{quality}.mp4"
-                    quality_match = re.search(r'-(360p|480p|720p|1080p)\.(mp4|webm|mkv)$', filename)
-                    quality = quality_match.group(1) if quality_match else "Unknown"
-                    
-                    # Extract title (everything before the last hyphen)
-                    title = filename.rsplit('-', 1)[0] if '-' in filename else filename
-                    
-                    files.append({
-                        'filename': filename,
-                        'title': title,
-                        'quality': quality,
-                        'path': file_path,
-                        'size': size,
-                        'size_formatted': format_size(size),
-                        'modified': modified,
-                        'modified_formatted': time.ctime(modified)
-                    })
+    """List downloaded files with filtering, sorting and pagination
+
+    Query parameters: quality, q (title substring), since/until (epoch
+    seconds), sort (modified, title, size, quality), order (asc, desc),
+    page and per_page. Responses carry an ETag, so unchanged polls get 304.
+    """
+    try:
+        digest = _DOWNLOADS_INDEX.refresh()
         
-        return jsonify({
+        # The listing only changes when the index does, so the ETag can be
+        # checked before doing any filtering or serialisation
+        etag = hashlib.sha1(f"{digest}:{request.query_string.decode()}".encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
+        
+        files = _DOWNLOADS_INDEX.entries()
+        
+        quality = request.args.get('quality')
+        if quality:
+            files = [f for f in files if f['quality'] == quality]
+        title_query = request.args.get('q', '').strip().lower()
+        if title_query:
+            files = [f for f in files if title_query in f['title'].lower()]
+        since = request.args.get('since', type=float)
+        if since is not None:
+            files = [f for f in files if f['modified'] >= since]
+        until = request.args.get('until', type=float)
+        if until is not None:
+            files = [f for f in files if f['modified'] <= until]
+        
+        sort = request.args.get('sort', 'modified')
+        if sort not in LIST_SORT_KEYS:
+            return jsonify({'status': 'error', 'message': f"Unknown sort key: {sort}"}), 400
+        files.sort(key=LIST_SORT_KEYS[sort], reverse=request.args.get('order', 'desc') == 'desc')
+        
+        total = len(files)
+        per_page = max(1, min(request.args.get('per_page', 100, type=int), 1000))
+        page = max(1, request.args.get('page', 1, type=int))
+        files = files[(page - 1) * per_page:page * per_page]
+        
+        response = jsonify({
             'status': 'success',
-            'files': files
+            'files': files,
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'pages': (total + per_page - 1) // per_page
         })
+        response.set_etag(etag)
+        return response
     except Exception as e:
         logger.error(f"Error listing downloads: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)})
@@ -590,37 +5526,188 @@ def kill_port_process():
         logger.error(f"Error in kill_port_process: {str(e)}")
         return False
 
+def warm_engine():
+    """Pre-initialise the YoutubeDL pool so the first requests are warm"""
+    if use_inprocess_engine():
+        try:
+            _YDL_POOL.warm()
+            logger.info(f"Warmed {_YDL_POOL.size} in-process yt-dlp instances")
+        except Exception as e:
+            logger.error(f"Failed to warm yt-dlp pool: {str(e)}")
+
+def recover_downloads():
+    """Re-queue downloads interrupted by a crash and clean up stale work directories"""
+    def run():
+        try:
+            _WORK_DIRS.recover(_JOBS.submit_batch if RECOVER_JOBS else lambda video_id, qualities: None,
+                               output_cached,
+                               WORK_DIR_MAX_AGE, WORK_DIR_MAX_BYTES)
+        except Exception as e:
+            logger.error(f"Work directory recovery failed: {str(e)}")
+    threading.Thread(target=run, name='recovery', daemon=True).start()
+
+def flush_metrics():
+    """Periodically publish this worker's metrics for /metrics in other workers"""
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                _METRICS.dump(METRICS_DIR)
+            except Exception as e:
+                logger.error(f"Failed to write metrics snapshot: {str(e)}")
+    threading.Thread(target=run, name='metrics', daemon=True).start()
+
+def pregenerate_thumbnails():
+    """Make thumbnails for downloaded files in the background, in one worker only"""
+    def run():
+        lock = None
+        try:
+            if fcntl:
+                os.makedirs(THUMB_DIR, exist_ok=True)
+                lock = open(os.path.join(THUMB_DIR, '.pregenerate.lock'), 'w')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another worker is already at it
+                    return
+            start = time.time()
+            made = _THUMBS.pregenerate(THUMB_DEFAULT_WIDTH)
+            if made:
+                logger.info(f"Made {made} thumbnails for downloaded files in {time.time() - start:.1f}s")
+        except Exception as e:
+            logger.error(f"Thumbnail pregeneration failed: {str(e)}")
+        finally:
+            if lock:
+                lock.close()
+    threading.Thread(target=run, name='thumbnails', daemon=True).start()
+
+def create_app():
+    """Finish setting up the app from the configuration above and return it
+
+    Importing the module only reads the configuration; the log writer, the
+    download directories and tool discovery are set up here, once per
+    process. Tool versions are not detected until first needed.
+    """
+    if 'seconds' in _STARTUP:
+        return app
+    _LOGGING.start()
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    tools = discover_tools()
+    _STARTUP['seconds'] = round(time.monotonic() - _STARTUP['began'], 3)
+    logger.info(f"Set up in {_STARTUP['seconds']}s: BASE_DIR {BASE_DIR}, downloads in {DOWNLOAD_DIR}, "
+                f"ffmpeg {tools['ffmpeg_path']}, yt-dlp {YT_DLP_PATH}")
+    if not tools['ffmpeg_exists']:
+        logger.warning(f"ffmpeg was not found on PATH or in {FFMPEG_SEARCH_PATH}")
+    return app
+
+def start_prefetcher():
+    """Run the prefetcher in the background, in one worker only"""
+    def run():
+        lock = None
+        try:
+            if fcntl:
+                lock = open(os.path.join(DOWNLOAD_DIR, '.prefetch.lock'), 'w')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another worker runs it
+                    return
+            logger.info(f"Prefetching in the window {PREFETCH_WINDOW}")
+            _PREFETCHER.run()
+        except Exception as e:
+            logger.error(f"Prefetcher stopped: {str(e)}")
+        finally:
+            if lock:
+                lock.close()
+    threading.Thread(target=run, name='prefetch', daemon=True).start()
+
+def worker_started():
+    """Per-process startup work, run once the server process is ready"""
+    # The log writer thread does not survive gunicorn's fork
+    _LOGGING.start()
+    warm_engine()
+    threading.Thread(target=tool_versions, name='tool-versions', daemon=True).start()
+    if SERVER_WORKERS > 1:
+        flush_metrics()
+    recover_downloads()
+    if THUMB_PREGENERATE:
+        pregenerate_thumbnails()
+    if _PREFETCHER.enabled:
+        start_prefetcher()
+
+def run_production_server():
+    """Serve the app with gunicorn threaded workers; False if gunicorn is missing
+
+    The master process keeps the listening socket: SIGHUP replaces the
+    workers without dropping it, SIGTERM stops gracefully, and each stopping
+    worker drains its download jobs for up to DRAIN_TIMEOUT seconds. The
+    master writes its PID to PID_FILE when one is set.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.warning("gunicorn is not installed, falling back to the Flask development server")
+        return False
+    
+    options = {
+        'bind': f"0.0.0.0:{PORT}",
+        'workers': SERVER_WORKERS,
+        'worker_class': 'gthread',
+        'threads': SERVER_THREADS,
+        'graceful_timeout': DRAIN_TIMEOUT + DRAIN_MARGIN,
+        'pidfile': PID_FILE or None,
+        'post_fork': lambda server, worker: worker_started(),
+        'worker_exit': lambda server, worker: (_PREFETCHER.stop(), _JOBS.shutdown(DRAIN_TIMEOUT),
+                                               _SUPERVISOR.kill_all())
+    }
+    
+    class YoutubedlApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return create_app()
+    
+    logger.info(f"Starting gunicorn on port {PORT} with {SERVER_WORKERS} workers x {SERVER_THREADS} threads")
+    YoutubedlApplication().run()
+    return True
+
 if __name__ == "__main__":
-    # Try to find system-wide ffmpeg
-    system_ffmpeg = shutil.which('ffmpeg')
-    if system_ffmpeg:
-        logger.info(f"Found system ffmpeg at: {system_ffmpeg}")
-        os.environ['PATH'] = os.path.dirname(system_ffmpeg) + os.pathsep + os.environ.get('PATH', '')
-    else:
-        # Add standard paths to environment
-        os.environ['PATH'] = f"{FFMPEG_PATH}:/usr/bin:/usr/local/bin:/var/services/homes/user/.local/bin:" + os.environ.get('PATH', '')
+    create_app()
+    if SERVER == 'gunicorn' and run_production_server():
+        sys.exit(0)
     
-    # Debug info
-    try:
-        logger.info(f"Current directory: {os.getcwd()}")
-        logger.info(f"BASE_DIR: {BASE_DIR}")
-    except Exception as e:
-        logger.error(f"Error listing directory contents: {str(e)}")
-    
-    # Try to kill any process using our port
-    try:
-        import socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
-        result = sock.connect_ex(('0.0.0.0', PORT))
-        if result == 0:  # Port is open, so another instance is running
-            logger.error(f"Port {PORT} is already in use. Attempting to kill the process...")
-            kill_port_process()
-        sock.close()
-    except Exception as e:
-        logger.error(f"Error checking port: {str(e)}")
+    # Development server: optionally kill any process using our port
+    if FREE_PORT:
+        try:
+            import socket
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(2)
+            result = sock.connect_ex(('0.0.0.0', PORT))
+            if result == 0:  # Port is open, so another instance is running
+                logger.error(f"Port {PORT} is already in use. Attempting to kill the process...")
+                kill_port_process()
+            sock.close()
+        except Exception as e:
+            logger.error(f"Error checking port: {str(e)}")
+    
+    worker_started()
+    # Stop on SIGTERM through the finally below, so jobs drain as under gunicorn
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if PID_FILE:
+        with open(PID_FILE, 'w') as f:
+            f.write(f"{os.getpid()}\n")
     
     try:
-        app.run(host='0.0.0.0', port=PORT)
+        app.run(host='0.0.0.0', port=PORT, threaded=True)
     except Exception as e:
-        logger.error(f"Failed to start the server: {str(e)}")
\ No newline at end of file
+        logger.error(f"Failed to start the server: {str(e)}")
+    finally:
+        _PREFETCHER.stop()
+        _JOBS.shutdown(DRAIN_TIMEOUT)
+        if PID_FILE:
+            try:
+                os.remove(PID_FILE)
+            except FileNotFoundError:
+                pass
@@ -11,10 +11,31 @@ APP_DIR="/volume/youtubedl"
 VENV_PATH="$APP_DIR/venv"
 PYTHON_CMD="$VENV_PATH/bin/python3"
 SCRIPT_NAME="youtubedl.py"
-PID_FILE="/var/run/youtubedl.pid"
+# The server writes its own PID here (gunicorn master, or the dev server);
+# the directory is owned by $USER so the server can create and remove it
+PID_DIR="/var/run/youtubedl"
+PID_FILE="$PID_DIR/youtubedl.pid"
 LOG_FILE="/var/log/youtubedl.log"
 PORT=6776
 DOWNLOAD_DIR="$APP_DIR/downloads"
+# Seconds to let in-flight downloads finish on stop (passed as YOUTUBEDL_DRAIN_TIMEOUT);
+# the server is force killed only if it is still running a minute after that
+DRAIN_TIMEOUT=900
+STOP_TIMEOUT=$((DRAIN_TIMEOUT + 60))
+
+# Ask a process to stop gracefully, force killing it only after the stop timeout
+stop_gracefully() {
+    kill -TERM $1 2>/dev/null
+    WAITED=0
+    while ps -p $1 > /dev/null 2>&1 && [ $WAITED -lt $STOP_TIMEOUT ]; do
+        sleep 1
+        WAITED=$((WAITED + 1))
+    done
+    if ps -p $1 > /dev/null 2>&1; then
+        echo "Process $1 still running after ${STOP_TIMEOUT}s, force killing..."
+        kill -9 $1 2>/dev/null
+    fi
+}
 
 # Kill any existing instances using port 6776
 kill_existing() {
@@ -24,8 +45,7 @@ kill_existing() {
     
     if [ -n "$NETSTAT_PID" ]; then
         echo "Found process using port $PORT (PID: $NETSTAT_PID)"
-        kill -9 $NETSTAT_PID 2>/dev/null
-        sleep 2
+        stop_gracefully $NETSTAT_PID
         return 0
     fi
     
@@ -35,8 +55,9 @@ kill_existing() {
     if [ -n "$PS_OUTPUT" ]; then
         PS_PID=$(echo "$PS_OUTPUT" | awk '{print $2}')
         echo "Found Python process that might be our server (PID: $PS_PID)"
-        kill -9 $PS_PID 2>/dev/null
-        sleep 2
+        for P in $PS_PID; do
+            stop_gracefully $P
+        done
         return 0
     fi
     
@@ -59,8 +80,10 @@ case "$1" in
         fi
         
         # Create necessary directories
-        mkdir -p "$DOWNLOAD_DIR"
+        mkdir -p "$DOWNLOAD_DIR" "$PID_DIR"
         chown -R "$USER" "$APP_DIR"
+        chown "$USER" "$PID_DIR"
+        rm -f "$PID_FILE"
         
         # Create log file if it doesn't exist
         touch "$LOG_FILE"
@@ -73,7 +96,7 @@ case "$1" in
             cd "$APP_DIR"
             su - "$USER" -c "python3 -m venv $VENV_PATH"
             su - "$USER" -c "$VENV_PATH/bin/pip install --upgrade pip"
-            su - "$USER" -c "$VENV_PATH/bin/pip install flask"
+            su - "$USER" -c "$VENV_PATH/bin/pip install flask gunicorn"
         fi
         
         # Install yt-dlp
@@ -102,15 +125,18 @@ case "$1" in
         echo "Using Python: $PYTHON_CMD"
         echo "Running script: $APP_DIR/$SCRIPT_NAME"
         
-        # Start the process and capture PID correctly
-        su - "$USER" -c "cd $APP_DIR && $PYTHON_CMD $APP_DIR/$SCRIPT_NAME" >> "$LOG_FILE" 2>&1 &
+        # Start the process; it writes its own PID file once it is serving
+        su - "$USER" -c "cd $APP_DIR && YOUTUBEDL_PID_FILE=$PID_FILE YOUTUBEDL_DRAIN_TIMEOUT=$DRAIN_TIMEOUT $PYTHON_CMD $APP_DIR/$SCRIPT_NAME" >> "$LOG_FILE" 2>&1 &
         
-        # Get the correct PID
-        sleep 2
-        SERVER_PID=$(ps -ef | grep python | grep youtubedl.py | grep -v grep | awk '{print $2}')
+        # Wait for the PID file
+        WAITED=0
+        while [ ! -s "$PID_FILE" ] && [ $WAITED -lt 30 ]; do
+            sleep 1
+            WAITED=$((WAITED + 1))
+        done
+        SERVER_PID=$(cat "$PID_FILE" 2>/dev/null)
         
         if [ -n "$SERVER_PID" ]; then
-            echo $SERVER_PID > "$PID_FILE"
             echo "YouTubeDL service started with PID: $SERVER_PID"
             
             # Verify the service is running
@@ -128,15 +154,8 @@ case "$1" in
     stop)
         if [ -f "$PID_FILE" ]; then
             PID=$(cat "$PID_FILE")
-            echo "Stopping YouTubeDL service (PID: $PID)..."
-            kill $PID 2>/dev/null
-            
-            # Force kill if still running after 5 seconds
-            sleep 5
-            if ps -p $PID > /dev/null 2>&1; then
-                echo "Service still running, force killing..."
-                kill -9 $PID 2>/dev/null
-            fi
+            echo "Stopping YouTubeDL service (PID: $PID), waiting for downloads to finish..."
+            stop_gracefully $PID
             
             rm -f "$PID_FILE"
             echo "YouTubeDL service stopped."
@@ -154,6 +173,18 @@ case "$1" in
         $0 start
         ;;
         
+    reload)
+        # Replace the server workers without closing the listening socket;
+        # old workers finish their downloads before exiting
+        if [ -f "$PID_FILE" ] && ps -p $(cat "$PID_FILE") > /dev/null 2>&1; then
+            echo "Reloading YouTubeDL service (PID: $(cat "$PID_FILE"))..."
+            kill -HUP $(cat "$PID_FILE")
+        else
+            echo "YouTubeDL service is not running."
+            exit 1
+        fi
+        ;;
+        
     status)
         if [ -f "$PID_FILE" ]; then
             PID=$(cat "$PID_FILE")
@@ -271,7 +302,7 @@ case "$1" in
         ;;
         
     *)
-        echo "Usage: $0 {start|stop|restart|status|debug|clean}"
+        echo "Usage: $0 {start|stop|restart|reload|status|debug|clean}"
         exit 1
         ;;
 esac
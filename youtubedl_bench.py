@@ -0,0 +1,1153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for youtubedl.py
+
+Every benchmark runs against local fakes, so no network access is needed:
+    python3 youtubedl_bench.py engine [--requests N]
+    python3 youtubedl_bench.py serve [--size-mb N] [--readers N] [--requests N]
+    python3 youtubedl_bench.py load [--servers dev,gunicorn] [--connections N] [--duration S]
+    python3 youtubedl_bench.py encode [--profiles fast,balanced] [--sizes 1920x1080] [--parallel N]
+    python3 youtubedl_bench.py ingest [--entries N] [--rate R] [--concurrency N] [--fail-rate F]
+    python3 youtubedl_bench.py logging [--records N] [--threads N] [--write-delay S]
+    python3 youtubedl_bench.py supervisor [--limit N] [--flood-mb N]
+    python3 youtubedl_bench.py pipeline [--media dummy|lavfi] [--concurrency N] [--save-baseline F] [--baseline F]
+    python3 youtubedl_bench.py startup [--runs N] [--servers dev,gunicorn] [--budget SECONDS]
+    python3 youtubedl_bench.py admission [--abusers N] [--clients N] [--duration S] [--max-p99 SECONDS]
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import resource
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from werkzeug.serving import make_server
+
+import youtubedl
+
+FAKE_VIDEO_ID = "bench000001"
+
+FAKE_INFO = {
+    'id': FAKE_VIDEO_ID,
+    'title': 'Benchmark Video',
+    'thumbnail': f"https://img.youtube.com/vi/{FAKE_VIDEO_ID}/hqdefault.jpg",
+    'duration': 60,
+    'formats': [
+        {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2',
+         'abr': 128, 'filesize': 1000000, 'url': 'http://127.0.0.1/140'},
+        {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2',
+         'height': 360, 'width': 640, 'fps': 30, 'tbr': 500, 'filesize': 3000000,
+         'url': 'http://127.0.0.1/18'},
+        {'format_id': '136', 'ext': 'mp4', 'vcodec': 'avc1.4d401f', 'acodec': 'none',
+         'height': 720, 'width': 1280, 'fps': 30, 'tbr': 2000, 'filesize': 9000000,
+         'url': 'http://127.0.0.1/136'},
+    ]
+}
+
+# Stand-in for the yt-dlp executable: pays the same interpreter start and
+# extractor registry import, then prints recorded JSON instead of extracting
+FAKE_YT_DLP_SCRIPT = '''#!{python}
+import json, sys
+from yt_dlp.extractor import gen_extractor_classes
+gen_extractor_classes()
+print(json.dumps({info}))
+'''
+
+def make_fake_yt_dlp(directory):
+    """Write the fake yt-dlp executable and return its path"""
+    path = os.path.join(directory, "yt-dlp")
+    with open(path, 'w') as f:
+        f.write(FAKE_YT_DLP_SCRIPT.format(python=sys.executable, info=repr(FAKE_INFO)))
+    os.chmod(path, 0o755)
+    return path
+
+# Lightweight stand-in for load tests: no yt-dlp import, optional extraction delay
+LIGHT_YT_DLP_SCRIPT = '''#!/bin/sh
+sleep {delay}
+cat <<'JSON'
+{info}
+JSON
+'''
+
+def make_light_yt_dlp(directory, delay, name="yt-dlp-light"):
+    """Write a fast fake yt-dlp that prints recorded JSON after delay seconds"""
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(LIGHT_YT_DLP_SCRIPT.format(delay=delay, info=json.dumps(FAKE_INFO)))
+    os.chmod(path, 0o755)
+    return path
+
+def make_fake_ydl_factory():
+    """YoutubeDL factory whose only extractor returns the recorded JSON"""
+    from yt_dlp.extractor.common import InfoExtractor
+    
+    class FakeIE(InfoExtractor):
+        IE_NAME = 'fake'
+        _VALID_URL = r'https?://www\.youtube\.com/watch\?v=(?P<id>[\w-]+)'
+        
+        def _real_extract(self, url):
+            return json.loads(json.dumps(FAKE_INFO))
+    
+    def factory():
+        ydl = youtubedl.yt_dlp.YoutubeDL({
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'noplaylist': True
+        }, auto_init=False)
+        ydl.add_info_extractor(FakeIE())
+        return ydl
+    
+    return factory
+
+def summarize(name, samples):
+    """Print latency statistics (in milliseconds) for one benchmark run"""
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<12} n={len(samples):<5} "
+          f"mean={statistics.mean(samples) * 1000:8.1f} ms  "
+          f"p50={statistics.median(samples) * 1000:8.1f} ms  "
+          f"p99={p99 * 1000:8.1f} ms")
+
+def bench_engine(args):
+    """Compare per-request /api/info overhead of the subprocess and in-process engines"""
+    if youtubedl.load_yt_dlp() is None:
+        print("yt_dlp is not importable; install requirements.txt first")
+        return 1
+    
+    client = youtubedl.create_app().test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        youtubedl.YT_DLP_PATH = make_fake_yt_dlp(tmp)
+        youtubedl._YDL_POOL = youtubedl.YoutubeDLPool(youtubedl.YDL_POOL_SIZE,
+                                                      factory=make_fake_ydl_factory())
+        youtubedl._YDL_POOL.warm()
+        
+        for engine in ('subprocess', 'inprocess'):
+            youtubedl.ENGINE = engine
+            samples = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                response = client.get(f"/api/info?id={FAKE_VIDEO_ID}")
+                samples.append(time.perf_counter() - start)
+                if response.status_code != 200 or not response.get_json().get('available_formats'):
+                    print(f"{engine}: unexpected response {response.status_code}")
+                    return 1
+            summarize(engine, samples)
+    return 0
+
+def bench_serve(args):
+    """Measure concurrent Range-request throughput of cached file serving"""
+    with tempfile.TemporaryDirectory() as tmp:
+        youtubedl.DOWNLOAD_DIR = tmp
+        filename = f"Fixture [{FAKE_VIDEO_ID}]-720p.mp4"
+        path = os.path.join(tmp, filename)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        with open(path, 'rb') as f:
+            fixture = f.read()
+        size = len(fixture)
+        
+        server = make_server('127.0.0.1', 0, youtubedl.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url_path = f"/api/files/{urllib.parse.quote(filename)}"
+        
+        samples = []
+        errors = []
+        transferred = [0]
+        lock = threading.Lock()
+        
+        def reader(seed):
+            rng = random.Random(seed)
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+            for _ in range(args.requests):
+                start = rng.randrange(size)
+                end = min(size - 1, start + rng.randrange(64 * 1024, 4 * 1024 * 1024))
+                began = time.perf_counter()
+                conn.request('GET', url_path, headers={'Range': f"bytes={start}-{end}"})
+                response = conn.getresponse()
+                body = response.read()
+                elapsed = time.perf_counter() - began
+                with lock:
+                    samples.append(elapsed)
+                    transferred[0] += len(body)
+                    if response.status != 206 or body != fixture[start:end + 1]:
+                        errors.append((response.status, start, end))
+            conn.close()
+        
+        began = time.perf_counter()
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - began
+        
+        # Conditional GET: a revalidation with the ETag should be a bodiless 304
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request('GET', url_path)
+        first = conn.getresponse()
+        first.read()
+        conn.request('GET', url_path, headers={'If-None-Match': first.getheader('ETag')})
+        revalidated = conn.getresponse()
+        revalidated.read()
+        conn.close()
+        server.shutdown()
+        
+        summarize('range', samples)
+        print(f"{args.readers} readers, {len(samples)} requests, "
+              f"{transferred[0] / wall / (1024 * 1024):.1f} MB/s, {len(samples) / wall:.1f} req/s")
+        print(f"conditional GET with ETag: HTTP {revalidated.status}")
+        if errors:
+            print(f"{len(errors)} range responses were wrong, first: {errors[0]}")
+            return 1
+        return 0 if revalidated.status == 304 else 1
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return True
+        time.sleep(0.1)
+    return False
+
+def bench_load(args):
+    """Measure /api/info requests per second for each server mode with a stubbed extractor"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "youtubedl.py")
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        fake = make_light_yt_dlp(tmp, args.stub_delay)
+        for server in args.servers.split(','):
+            port = free_port()
+            env = dict(os.environ,
+                       YOUTUBEDL_SERVER=server,
+                       YOUTUBEDL_PORT=str(port),
+                       YOUTUBEDL_SERVER_WORKERS=str(args.workers),
+                       YOUTUBEDL_SERVER_THREADS=str(args.threads),
+                       YOUTUBEDL_YT_DLP_PATH=fake,
+                       YOUTUBEDL_DOWNLOAD_DIR=os.path.join(tmp, server))
+            process = subprocess.Popen([sys.executable, script], env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(port):
+                    print(f"{server}: server did not start")
+                    status = 1
+                    continue
+                
+                samples = []
+                failures = [0]
+                lock = threading.Lock()
+                deadline = time.time() + args.duration
+                
+                def client(seed):
+                    rng = random.Random(seed)
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                    while time.time() < deadline:
+                        # A pool of ids gives a realistic mix of cache hits and misses
+                        video_id = f"load{rng.randrange(args.ids):07d}"
+                        began = time.perf_counter()
+                        try:
+                            conn.request('GET', f"/api/info?id={video_id}")
+                            response = conn.getresponse()
+                            response.read()
+                            ok = response.status == 200
+                        except (OSError, http.client.HTTPException):
+                            conn.close()
+                            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                            ok = False
+                        with lock:
+                            samples.append(time.perf_counter() - began)
+                            if not ok:
+                                failures[0] += 1
+                    conn.close()
+                
+                began = time.perf_counter()
+                threads = [threading.Thread(target=client, args=(i,)) for i in range(args.connections)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                wall = time.perf_counter() - began
+                
+                summarize(server, samples)
+                print(f"{'':<12} {len(samples) / wall:.1f} req/s over {args.connections} connections, "
+                      f"{failures[0]} failures")
+                if failures[0]:
+                    status = 1
+            finally:
+                process.terminate()
+                process.wait(timeout=60)
+    return status
+
+def make_test_clip(path, size, duration, rate=30, video_codec=("mpeg4", "-q:v", "2")):
+    """Generate a test-pattern clip with a tone, by default encoded as MPEG-4 Part 2 so it needs a transcode"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=size={size}:rate={rate}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", *video_codec, "-c:a", "aac", "-shortest", "-y", path
+    ]
+    subprocess.run(cmd, check=True)
+
+def bench_encode(args):
+    """Encode generated test-pattern clips with each profile and report fps and output size"""
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg is not in PATH")
+        return 1
+    
+    # Each parallel encode gets its share of the CPU budget, as in the job queue
+    youtubedl.JOB_TRANSCODE_CONCURRENCY = args.parallel
+    print(f"CPU budget {youtubedl.ENCODE_CPU_BUDGET}, {args.parallel} parallel encodes, "
+          f"{youtubedl.encoder_threads()} threads each")
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes.split(','):
+            source = os.path.join(tmp, f"source-{size}.mkv")
+            make_test_clip(source, size, args.duration)
+            frames = args.duration * 30
+            for profile in args.profiles.split(','):
+                outputs = [os.path.join(tmp, f"{profile}-{size}-{i}.mp4") for i in range(args.parallel)]
+                results = [False] * args.parallel
+                
+                def encode(index):
+                    results[index] = youtubedl.convert_to_mp4(source, outputs[index], args.height,
+                                                              duration=args.duration, profile=profile)
+                
+                began = time.perf_counter()
+                threads = [threading.Thread(target=encode, args=(i,)) for i in range(args.parallel)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                wall = time.perf_counter() - began
+                
+                name = f"{profile} {size}"
+                if not all(results):
+                    print(f"{name:<22} encode failed")
+                    status = 1
+                    continue
+                media = youtubedl.probe_media(outputs[0]) or {}
+                output_size = os.path.getsize(outputs[0])
+                print(f"{name:<22} {frames * args.parallel / wall:7.1f} fps  "
+                      f"{wall:6.2f} s  {youtubedl.format_size(output_size):>10}  "
+                      f"{output_size * 8 / args.duration / 1000:7.0f} kb/s  "
+                      f"-> {media.get('width')}x{media.get('height')}")
+    return status
+
+def make_fake_playlist_extractor(count):
+    """Playlist extractor returning count synthetic YouTube entries"""
+    def extractor(url, max_entries):
+        entries = [{'id': f"ingest{i:05d}", 'title': f"Synthetic entry {i}", 'ie_key': 'Youtube',
+                    'url': f"https://www.youtube.com/watch?v=ingest{i:05d}"} for i in range(count)]
+        return 'Synthetic playlist', entries[:max_entries]
+    return extractor
+
+def bench_ingest(args):
+    """Ingest a synthetic playlist through the job queue with a fake download pipeline"""
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        youtubedl.DOWNLOAD_DIR = tmp
+        youtubedl._DOWNLOAD_CACHE = youtubedl.DownloadCache(tmp, os.path.join(tmp, ".cache_index.sqlite3"))
+        jobs = youtubedl.JobManager(args.workers, args.workers, 1, 3600,
+                                    youtubedl.JobStore(os.path.join(tmp, ".jobs.sqlite3")))
+        
+        # Part of the playlist is already archived
+        for i in range(0, args.entries, max(1, round(1 / args.cached)) if args.cached else args.entries + 1):
+            path = os.path.join(tmp, youtubedl.cache_filename(f"Synthetic entry {i}", f"ingest{i:05d}", args.quality, 'mp4'))
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 1024)
+            youtubedl._DOWNLOAD_CACHE.add(path, f"ingest{i:05d}", args.quality, 'mp4', f"Synthetic entry {i}")
+        
+        starts = []
+        in_flight = [0, 0]
+        failed_once = set()
+        lock = threading.Lock()
+        
+        def fake_pipeline(job, download_slots, transcode_slots):
+            with lock:
+                starts.append(time.perf_counter())
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            try:
+                time.sleep(args.job_delay)
+                # A transient failure on the first attempt exercises the backoff
+                if job.video_id not in failed_once and rng.random() < args.fail_rate:
+                    failed_once.add(job.video_id)
+                    raise youtubedl.DownloadError("Synthetic failure")
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+        
+        youtubedl.OUTPUT_PIPELINES['video'] = fake_pipeline
+        limiter = youtubedl.HostRateLimiter(args.rate, args.burst, args.backoff, args.backoff * 8)
+        manager = youtubedl.IngestManager(limiter, 3600, extractor=make_fake_playlist_extractor(args.entries),
+                                          submit=jobs.submit)
+        youtubedl.INGEST_CONCURRENCY = args.concurrency
+        
+        began = time.perf_counter()
+        ingest = manager.start("https://www.youtube.com/playlist?list=SYNTHETIC", args.quality)
+        while not ingest.is_finished:
+            time.sleep(0.05)
+        wall = time.perf_counter() - began
+        
+        result = ingest.to_dict()
+        retries = sum(max(0, entry['attempts'] - 1) for entry in result['entries'])
+        print(f"{result['total']} entries in {wall:.2f} s: {result['counts']}")
+        print(f"{len(starts)} job starts, {retries} retries, peak {in_flight[1]} in flight "
+              f"(limit {args.concurrency})")
+        if len(starts) > 1:
+            span = starts[-1] - starts[0]
+            print(f"start rate {(len(starts) - 1) / span if span else float('inf'):.2f}/s "
+                  f"(limit {args.rate}/s, burst {args.burst})")
+        return 0 if result['state'] == 'done' and not result['counts'].get('failed') else 1
+
+class SlowDisk(logging.Handler):
+    """Wraps a handler, adding a fixed delay to every write"""
+    
+    def __init__(self, target, delay):
+        super().__init__()
+        self.target = target
+        self.delay = delay
+    
+    def emit(self, record):
+        if self.delay:
+            time.sleep(self.delay)
+        self.target.emit(record)
+
+def bench_logging(args):
+    """Compare the per-call cost of logging on the request path: synchronous file vs queue"""
+    stderr = "\n".join(f"[download] frame {i}: some noisy ffmpeg/yt-dlp output" for i in range(400))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.log")
+        setups = {
+            # What logging.basicConfig(filename=...) used to install
+            'sync-text': lambda: SlowDisk(logging.FileHandler(path), args.write_delay),
+        }
+        
+        def queued():
+            target = youtubedl.SharedRotatingFileHandler(path, maxBytes=args.max_mb * 1024 * 1024,
+                                                         backupCount=2, delay=True)
+            target.setFormatter(youtubedl.JsonLogFormatter())
+            handler = youtubedl.LogQueueHandler(youtubedl.queue.Queue(youtubedl.LOG_QUEUE_SIZE))
+            handler.listener = logging.handlers.QueueListener(handler.queue, SlowDisk(target, args.write_delay))
+            handler.listener.start()
+            return handler
+        setups['queue-json'] = queued
+        
+        for name, make_handler in setups.items():
+            handler = make_handler()
+            bench_logger = logging.getLogger(f"bench.{name}")
+            bench_logger.propagate = False
+            bench_logger.setLevel(logging.INFO)
+            bench_logger.addHandler(handler)
+            samples = [[] for _ in range(args.threads)]
+            
+            def request_thread(index):
+                with youtubedl.log_context(request_id=f"bench{index}"):
+                    for i in range(args.records // args.threads):
+                        # A typical error record carries a child process's output
+                        text = stderr if name == 'sync-text' else youtubedl.stderr_tail(stderr)
+                        start = time.perf_counter()
+                        bench_logger.error(f"yt-dlp error output: {text}", extra={'durations': {'download': 1.5}})
+                        samples[index].append(time.perf_counter() - start)
+            
+            began = time.perf_counter()
+            threads = [threading.Thread(target=request_thread, args=(i,)) for i in range(args.threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - began
+            if hasattr(handler, 'listener'):
+                handler.listener.stop()
+            handler.close()
+            bench_logger.removeHandler(handler)
+            
+            summarize(name, [s for thread_samples in samples for s in thread_samples])
+            size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp) if f.startswith("bench.log"))
+            print(f"{'':<12} {wall:.2f} s for the request threads, {youtubedl.format_size(size)} written"
+                  + (f", {handler.dropped} dropped" if hasattr(handler, 'dropped') else ""))
+            for f in os.listdir(tmp):
+                os.remove(os.path.join(tmp, f))
+    return 0
+
+# Stand-ins for misbehaving tools. The sleeper starts a grandchild (like
+# yt-dlp's own ffmpeg) and records its pid; the flooder writes a large
+# amount of output, partly without newlines
+SLEEPER_SCRIPT = '''#!{python}
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+open(sys.argv[1], "w").write(str(child.pid))
+time.sleep(float(sys.argv[2]))
+'''
+
+FLOODER_SCRIPT = '''#!{python}
+import sys
+block = "x" * 1024 * 1024
+for i in range(int(sys.argv[1])):
+    sys.stdout.write(block if i % 2 else "noise line %d\\n" % i + block + "\\n")
+sys.stdout.write("last line\\n")
+'''
+
+def make_stub_tool(directory, name, script):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(script.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A killed but unreaped grandchild is a zombie, which no longer runs
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except OSError:
+        return True
+
+def bench_supervisor(args):
+    """Check supervisor timeouts, cancellation, output flooding and concurrency limits with stub tools"""
+    failures = 0
+    
+    def check(name, ok, detail):
+        nonlocal failures
+        failures += 0 if ok else 1
+        print(f"{name:<12} {'ok' if ok else 'FAIL'}  {detail}")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        sleeper = make_stub_tool(tmp, "yt-dlp", SLEEPER_SCRIPT)
+        flooder = make_stub_tool(tmp, "ffmpeg", FLOODER_SCRIPT)
+        supervisor = youtubedl.ToolSupervisor({'yt-dlp': args.limit, 'ffmpeg': args.limit},
+                                              {'yt-dlp': 5, 'ffmpeg': 5}, 30)
+        
+        # Timeout: the child and its grandchild are both killed
+        pid_file = os.path.join(tmp, "timeout.pid")
+        start = time.perf_counter()
+        result = supervisor.run([sleeper, pid_file, "600"], timeout=1)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.2)
+        with open(pid_file) as f:
+            grandchild = int(f.read())
+        check("timeout", result.timed_out and elapsed < 2 and not pid_alive(grandchild),
+              f"returned after {elapsed:.2f} s, code {result.returncode}, "
+              f"grandchild {'alive' if pid_alive(grandchild) else 'killed'}")
+        
+        # Cancellation through a cancel scope, as jobs use it
+        pid_file = os.path.join(tmp, "cancel.pid")
+        cancel = threading.Event()
+        threading.Timer(0.5, cancel.set).start()
+        start = time.perf_counter()
+        with youtubedl.cancel_scope(cancel):
+            result = supervisor.run([sleeper, pid_file, "600"], timeout=60)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.2)
+        with open(pid_file) as f:
+            grandchild = int(f.read())
+        check("cancel", result.cancelled and elapsed < 1.5 and not pid_alive(grandchild),
+              f"returned {elapsed - 0.5:.2f} s after cancel, grandchild "
+              f"{'alive' if pid_alive(grandchild) else 'killed'}")
+        
+        # Flooding: output is consumed as it comes, only the tail is kept
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        lines = [0]
+        
+        def on_line(line):
+            lines[0] += 1
+            return True
+        
+        start = time.perf_counter()
+        result = supervisor.run([flooder, str(args.flood_mb)], timeout=120, on_line=on_line)
+        elapsed = time.perf_counter() - start
+        rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+        check("flood", result.returncode == 0 and rss_growth < args.flood_mb / 2,
+              f"{args.flood_mb} MB in {elapsed:.2f} s ({args.flood_mb / elapsed:.0f} MB/s), "
+              f"{lines[0]} line pieces, peak RSS +{rss_growth:.0f} MB")
+        result = supervisor.run([flooder, str(min(args.flood_mb, 16))], timeout=120, tail_lines=5)
+        check("flood tail", len(result.tail) <= 5 * youtubedl.ToolSupervisor.LINE_LIMIT + 5
+              and result.tail.endswith("last line"), f"{len(result.tail)} chars kept")
+        
+        # Concurrency: a burst of calls never runs more than the limit at once.
+        # Each sleeper also leaves a grandchild holding its output open
+        peak = [0]
+        sampling = threading.Event()
+        
+        def sample():
+            while not sampling.is_set():
+                peak[0] = max(peak[0], supervisor.stats()['running']['yt-dlp'])
+                time.sleep(0.01)
+        
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        start = time.perf_counter()
+        threads = [threading.Thread(target=supervisor.run,
+                                    args=([sleeper, os.path.join(tmp, f"burst{i}.pid"), "0.3"], 30))
+                   for i in range(args.limit * 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sampling.set()
+        sampler.join()
+        elapsed = time.perf_counter() - start
+        stats = supervisor.stats()
+        check("burst", peak[0] <= args.limit and stats['running']['yt-dlp'] == 0,
+              f"{len(threads)} calls, peak {peak[0]} running (limit {args.limit}), {elapsed:.2f} s")
+        
+        orphans = []
+        for i in range(len(threads)):
+            with open(os.path.join(tmp, f"burst{i}.pid")) as f:
+                orphans.append(int(f.read()))
+        check("orphans", stats['orphaned'] == len(threads) and not any(pid_alive(pid) for pid in orphans),
+              f"{stats['orphaned']} process groups killed after their child exited")
+        print(f"supervisor counts: {stats['started']} started, {stats['timed_out']} timed out, "
+              f"{stats['cancelled']} cancelled, {stats['orphaned']} orphaned")
+    return 1 if failures else 0
+
+# Fakes for the whole request pipeline. yt-dlp answers -j with the recorded
+# JSON (retitled per video id), prints progress lines while "downloading"
+# and then copies a media file or writes a dummy file of the given size.
+# ffmpeg and ffprobe stand in for the real ones when the media is dummy
+# bytes: ffmpeg prints -progress lines and copies its input to its output
+PIPELINE_YT_DLP_SCRIPT = """#!{python}
+import json, os, shutil, sys, time
+args = sys.argv[1:]
+info = {info}
+url = args[-1]
+video_id = url.split('v=')[-1] if 'v=' in url else info['id']
+if args[0] == '--version':
+    print('2024.01.01-fake')
+    sys.exit(0)
+if args[0] in ('-j', '--dump-json'):
+    time.sleep({info_delay})
+    print(json.dumps(dict(info, id=video_id, title='Benchmark Video ' + video_id)))
+    sys.exit(0)
+out = args[args.index('-o') + 1].replace('%(id)s', video_id)
+if '--skip-download' in args:
+    lang = args[args.index('--sub-langs') + 1]
+    with open(out.replace('%(ext)s', lang + '.vtt'), 'w') as f:
+        f.write('WEBVTT\\n\\n00:00:01.000 --> 00:00:03.000\\nBenchmark\\n')
+    sys.exit(0)
+media = {media!r}
+size = os.path.getsize(media) if media else {dummy_size}
+for step in range(1, {steps} + 1):
+    time.sleep({download_delay} / {steps})
+    print('[progress] %d %d NA %d %d' % (size * step // {steps}, size, size, {steps} - step), flush=True)
+if media:
+    shutil.copy(media, out.replace('%(ext)s', media.rsplit('.', 1)[1]))
+else:
+    with open(out.replace('%(ext)s', 'mp4'), 'wb') as f:
+        f.truncate(size)
+"""
+
+PIPELINE_FFMPEG_SCRIPT = """#!{python}
+import shutil, sys, time
+args = sys.argv[1:]
+if args[0] == '-version':
+    print('ffmpeg version fake')
+    sys.exit(0)
+if '-progress' in args:
+    for step in range(1, {steps} + 1):
+        time.sleep({encode_delay} / {steps})
+        print('out_time_us=%d' % (step * 6000000), flush=True)
+    print('progress=end', flush=True)
+else:
+    time.sleep({encode_delay})
+shutil.copy(args[args.index('-i') + 1], args[-1])
+"""
+
+PIPELINE_FFPROBE_SCRIPT = """#!{python}
+import json
+print(json.dumps({{'streams': [
+    {{'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720}},
+    {{'codec_type': 'audio', 'codec_name': 'aac'}}
+]}}))
+"""
+
+def make_pipeline_fakes(directory, args, media):
+    """Write the fake tools into directory; returns the fake yt-dlp path"""
+    settings = dict(python=sys.executable, info=repr(FAKE_INFO), media=media, dummy_size=args.size_mb * 1024 * 1024,
+                    steps=10, info_delay=args.info_delay, download_delay=args.download_delay,
+                    encode_delay=args.encode_delay)
+    scripts = {'yt-dlp': PIPELINE_YT_DLP_SCRIPT}
+    if not media:
+        scripts.update({'ffmpeg': PIPELINE_FFMPEG_SCRIPT, 'ffprobe': PIPELINE_FFPROBE_SCRIPT})
+    for name, script in scripts.items():
+        # make_stub_tool formats the script again, so the filled-in braces are escaped back
+        make_stub_tool(directory, name, script.format(**settings).replace('{', '{{').replace('}', '}}'))
+    return os.path.join(directory, 'yt-dlp')
+
+def subprocess_counts():
+    """Finished yt-dlp/ffmpeg/ffprobe runs so far, by tool"""
+    counts = {}
+    for key, value in youtubedl._METRICS.snapshot()['counters'].get('youtubedl_subprocess_exits_total', {}).items():
+        tool = json.loads(key)['tool']
+        counts[tool] = counts.get(tool, 0) + int(value)
+    return counts
+
+def run_scenario(name, paths, concurrency, expect=200):
+    """Request paths from concurrency client threads; returns the scenario's numbers"""
+    samples = []
+    errors = []
+    pending = list(reversed(paths))
+    lock = threading.Lock()
+    before = subprocess_counts()
+    
+    def client():
+        test_client = youtubedl.app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+            began = time.perf_counter()
+            response = test_client.get(path)
+            response.get_data()
+            elapsed = time.perf_counter() - began
+            with lock:
+                samples.append(elapsed)
+                if response.status_code != expect:
+                    errors.append((path, response.status_code))
+    
+    began = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - began
+    
+    after = subprocess_counts()
+    samples.sort()
+    result = {
+        'requests': len(samples),
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'p50_ms': round(statistics.median(samples) * 1000, 2),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+        'throughput': round(len(samples) / wall, 2),
+        'subprocesses': {tool: after[tool] - before.get(tool, 0) for tool in after if after[tool] != before.get(tool, 0)},
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+    if errors:
+        print(f"{name}: {len(errors)} unexpected responses, first: {errors[0]}", file=sys.stderr)
+    return result
+
+def run_pipeline_scenarios(args):
+    """Child side of the pipeline benchmark: the app was imported with the fake tools configured"""
+    ids = [f"bench{i:06d}" for i in range(args.videos)]
+    concurrency = args.concurrency
+    scenarios = {}
+    scenarios['info_cold'] = run_scenario('info_cold', [f"/api/info?id={i}" for i in ids], concurrency)
+    scenarios['info_cached'] = run_scenario('info_cached', [f"/api/info?id={i}" for i in ids] * 4, concurrency)
+    scenarios['download_cold'] = run_scenario(
+        'download_cold', [f"/api/download?id={i}&quality=720p" for i in ids], concurrency)
+    scenarios['download_cached'] = run_scenario(
+        'download_cached', [f"/api/download?id={i}&quality=720p" for i in ids] * 2, concurrency)
+    # Every client asks for the same new video at once: one pipeline run should serve them all
+    scenarios['download_shared'] = run_scenario(
+        'download_shared', ["/api/download?id=benchshared&quality=480p"] * concurrency, concurrency)
+    scenarios['audio_cold'] = run_scenario(
+        'audio_cold', [f"/api/download?id={i}&quality=audio.m4a" for i in ids[:max(1, len(ids) // 4)]],
+        concurrency)
+    scenarios['list_downloads'] = run_scenario(
+        'list_downloads', [f"/api/list-downloads?page={1 + n % 3}&per_page=10" for n in range(args.videos * 4)],
+        concurrency)
+    return {
+        'config': {key: getattr(args, key) for key in
+                   ('media', 'videos', 'concurrency', 'size_mb', 'info_delay', 'download_delay', 'encode_delay')},
+        'scenarios': scenarios,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def compare_with_baseline(baseline, current, tolerance):
+    """Print changes against a saved run; returns the number of regressions"""
+    regressions = 0
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            print(f"{name:<16} not in baseline")
+            continue
+        # Every check gets a small absolute allowance so scheduler noise in sub-millisecond
+        # scenarios is not a regression; throughput is compared as the scenario's wall time
+        checks = [
+            ('p50_ms', now['p50_ms'] > before['p50_ms'] * (1 + tolerance) + 10),
+            ('p99_ms', now['p99_ms'] > before['p99_ms'] * (1 + tolerance) + 25),
+            ('throughput', now['requests'] / now['throughput'] >
+             before['requests'] / before['throughput'] * (1 + tolerance) + 0.05)
+        ]
+        if now['errors'] or before['errors']:
+            checks.append(('errors', now['errors'] > before['errors']))
+        for metric, regressed in checks:
+            change = (now[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0
+            print(f"{name:<16} {metric:<11} {before[metric]:>10} -> {now[metric]:<10} "
+                  f"{change:+6.1f}%{'  REGRESSION' if regressed else ''}")
+            regressions += regressed
+        # The fakes are deterministic, so any extra process is a regression
+        for tool in sorted(set(now['subprocesses']) | set(before['subprocesses'])):
+            was, count = before['subprocesses'].get(tool, 0), now['subprocesses'].get(tool, 0)
+            if was != count:
+                print(f"{name:<16} {tool + ' runs':<11} {was:>10} -> {count:<10}"
+                      f"{'  REGRESSION' if count > was else ''}")
+                regressions += count > was
+    rss_limit = baseline['peak_rss_mb'] * (1 + tolerance)
+    print(f"{'peak RSS':<28} {baseline['peak_rss_mb']:>10} -> {current['peak_rss_mb']:<10}"
+          f"{'  REGRESSION' if current['peak_rss_mb'] > rss_limit else ''}")
+    regressions += current['peak_rss_mb'] > rss_limit
+    return regressions
+
+def bench_pipeline(args):
+    """Drive /api/info, /api/download and /api/list-downloads against fake tools, with a baseline to compare"""
+    result_file = os.environ.get('YOUTUBEDL_BENCH_RESULT')
+    if result_file:
+        youtubedl.create_app()
+        with open(result_file, 'w') as f:
+            json.dump(run_pipeline_scenarios(args), f)
+        return 0
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        media = ''
+        if args.media == 'lavfi':
+            if not shutil.which("ffmpeg"):
+                print("ffmpeg is not in PATH")
+                return 1
+            media = os.path.join(tmp, "source.mp4")
+            make_test_clip(media, "1280x720", args.clip_seconds,
+                           video_codec=("libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"))
+        bin_dir = os.path.join(tmp, "bin")
+        os.makedirs(bin_dir)
+        fake_yt_dlp = make_pipeline_fakes(bin_dir, args, media)
+        
+        # The app reads its configuration at import, so it runs in a fresh process
+        result_file = os.path.join(tmp, "result.json")
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   YOUTUBEDL_YT_DLP_PATH=fake_yt_dlp,
+                   YOUTUBEDL_ENGINE='subprocess',
+                   YOUTUBEDL_DOWNLOAD_DIR=os.path.join(tmp, "downloads"),
+                   YOUTUBEDL_LOG_FILE=os.path.join(tmp, "youtubedl.log"),
+                   YOUTUBEDL_THUMB_PREGENERATE='0',
+                   # All test clients are one address; admission control has its own benchmark
+                   YOUTUBEDL_ADMISSION_MAX_IN_FLIGHT='0',
+                   YOUTUBEDL_BENCH_RESULT=result_file)
+        began = time.perf_counter()
+        child = subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env)
+        if child.returncode != 0 or not os.path.exists(result_file):
+            print(f"benchmark process failed with code {child.returncode}")
+            return 1
+        with open(result_file) as f:
+            result = json.load(f)
+    
+    print(f"{args.videos} videos, {args.concurrency} clients, {args.media} media, "
+          f"{time.perf_counter() - began:.1f} s")
+    for name, numbers in result['scenarios'].items():
+        processes = ' '.join(f"{tool}={count}" for tool, count in sorted(numbers['subprocesses'].items()))
+        print(f"{name:<16} n={numbers['requests']:<4} p50={numbers['p50_ms']:8.1f} ms  "
+              f"p99={numbers['p99_ms']:8.1f} ms  {numbers['throughput']:8.1f} req/s  "
+              f"errors={numbers['errors']}  processes: {processes or 'none'}")
+    print(f"peak RSS {result['peak_rss_mb']} MB")
+    
+    status = 1 if any(numbers['errors'] for numbers in result['scenarios'].values()) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != result['config']:
+            print(f"warning: baseline was recorded with {baseline['config']}")
+        print(f"\ncompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        regressions = compare_with_baseline(baseline, result, args.tolerance)
+        print(f"{regressions} regressions")
+        status = status or (1 if regressions else 0)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"saved baseline to {args.save_baseline}")
+    return status
+
+# Runs in a fresh interpreter: the phases of getting the app ready to answer
+STARTUP_PROBE = """
+import json, sys, time
+began = time.perf_counter()
+sys.path.insert(0, {base_dir!r})
+import youtubedl
+imported = time.perf_counter()
+app = youtubedl.create_app()
+created = time.perf_counter()
+status = app.test_client().get('/api/list-downloads').status_code
+answered = time.perf_counter()
+print(json.dumps({{'import': imported - began, 'create_app': created - imported,
+                  'request': answered - created, 'status': status}}))
+"""
+
+def time_first_response(script, env, port, timeout=60):
+    """Seconds from starting the server script until it answers GET / (None if it never does)"""
+    began = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - began < timeout and process.poll() is None:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/')
+                if conn.getresponse().status == 200:
+                    return time.perf_counter() - began
+            except OSError:
+                time.sleep(0.01)
+            finally:
+                conn.close()
+        return None
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def bench_startup(args):
+    """Measure cold start: import, create_app and first request, then process start to first response per server"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   YOUTUBEDL_DOWNLOAD_DIR=os.path.join(tmp, "downloads"),
+                   YOUTUBEDL_LOG_FILE=os.path.join(tmp, "youtubedl.log"),
+                   YOUTUBEDL_THUMB_PREGENERATE='0',
+                   YOUTUBEDL_RECOVER_JOBS='0')
+        phases = {}
+        for _ in range(args.runs):
+            began = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", STARTUP_PROBE.format(base_dir=base_dir)],
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            if result.pop('status') != 200:
+                print("first request failed")
+                status = 1
+            result['process'] = time.perf_counter() - began
+            for phase, seconds in result.items():
+                phases.setdefault(phase, []).append(seconds)
+        for phase, samples in phases.items():
+            summarize(phase, samples)
+        
+        for server in args.servers.split(','):
+            samples = []
+            for _ in range(args.runs):
+                port = free_port()
+                elapsed = time_first_response(os.path.join(base_dir, "youtubedl.py"),
+                                              dict(env, YOUTUBEDL_SERVER=server, YOUTUBEDL_PORT=str(port)), port)
+                if elapsed is None:
+                    print(f"{server}: server did not answer")
+                    status = 1
+                    break
+                samples.append(elapsed)
+            if not samples:
+                continue
+            summarize(f"{server} ready", samples)
+            if args.budget and statistics.median(samples) > args.budget:
+                print(f"{server}: median start to first response is over the {args.budget}s budget")
+                status = 1
+    return status
+
+def bench_admission(args):
+    """Measure /api/info latency of well-behaved clients while one client floods the server, with admission control off and on"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "youtubedl.py")
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        # Named like the real tool so the supervisor's yt-dlp limit applies to it
+        fake = make_light_yt_dlp(tmp, args.stub_delay, name="yt-dlp")
+        for mode in ('off', 'on'):
+            port = free_port()
+            env = dict(os.environ,
+                       YOUTUBEDL_SERVER=args.server,
+                       YOUTUBEDL_PORT=str(port),
+                       YOUTUBEDL_YT_DLP_PATH=fake,
+                       YOUTUBEDL_DOWNLOAD_DIR=os.path.join(tmp, mode),
+                       YOUTUBEDL_LOG_FILE=os.path.join(tmp, f"{mode}.log"),
+                       YOUTUBEDL_THUMB_PREGENERATE='0',
+                       YOUTUBEDL_ADMISSION_CLIENT_HEADER='X-Forwarded-For',
+                       YOUTUBEDL_ADMISSION_MAX_IN_FLIGHT='0' if mode == 'off' else str(args.max_in_flight))
+            process = subprocess.Popen([sys.executable, script], env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(port):
+                    print(f"admission {mode}: server did not start")
+                    status = 1
+                    continue
+                
+                results = {'abuser': [], 'client': []}
+                lock = threading.Lock()
+                deadline = time.time() + args.duration
+                
+                def run(kind, index, address, pause):
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                    n = 0
+                    while time.time() < deadline:
+                        n += 1
+                        # Fresh (11-character) ids so every request needs a yt-dlp run
+                        path = f"/api/info?id={kind[0]}{index:03d}{n:07d}"
+                        began = time.perf_counter()
+                        try:
+                            conn.request('GET', path, headers={'X-Forwarded-For': address})
+                            response = conn.getresponse()
+                            response.read()
+                            code = response.status
+                        except (OSError, http.client.HTTPException):
+                            conn.close()
+                            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                            code = 0
+                        with lock:
+                            results[kind].append((code, time.perf_counter() - began))
+                        time.sleep(pause)
+                    conn.close()
+                
+                # The abusive client retries at once; the others pause between requests
+                threads = [threading.Thread(target=run, args=('abuser', i, '10.0.0.1', 0.001))
+                           for i in range(args.abusers)]
+                threads += [threading.Thread(target=run, args=('client', i, f"10.0.1.{i + 1}", args.think))
+                            for i in range(args.clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                
+                print(f"admission {mode}: {args.abusers} abusive connections, {args.clients} clients, "
+                      f"{args.duration} s, yt-dlp takes {args.stub_delay} s")
+                for kind, samples in results.items():
+                    codes = {}
+                    for code, _ in samples:
+                        codes[code] = codes.get(code, 0) + 1
+                    ok = [elapsed for code, elapsed in samples if code == 200]
+                    refused = [elapsed for code, elapsed in samples if code in (429, 503)]
+                    if ok:
+                        summarize(f"{kind} 200", ok)
+                    if refused:
+                        summarize(f"{kind} 429/503", refused)
+                    print(f"{'':<12} responses: {dict(sorted(codes.items()))}")
+                    if kind == 'client' and mode == 'on' and args.max_p99 and ok:
+                        p99 = sorted(ok)[min(len(ok) - 1, int(len(ok) * 0.99))]
+                        if p99 > args.max_p99:
+                            print(f"{'':<12} client p99 {p99:.2f} s is over {args.max_p99} s")
+                            status = 1
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request('GET', '/debug')
+                print(f"{'':<12} admission: {json.loads(conn.getresponse().read())['admission']}")
+                conn.close()
+            finally:
+                process.terminate()
+                process.wait(timeout=60)
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for youtubedl.py")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    
+    engine = subparsers.add_parser('engine', help=bench_engine.__doc__)
+    engine.add_argument('--requests', type=int, default=20)
+    engine.set_defaults(func=bench_engine)
+    
+    serve = subparsers.add_parser('serve', help=bench_serve.__doc__)
+    serve.add_argument('--size-mb', type=int, default=64)
+    serve.add_argument('--readers', type=int, default=8)
+    serve.add_argument('--requests', type=int, default=25)
+    serve.set_defaults(func=bench_serve)
+    
+    load = subparsers.add_parser('load', help=bench_load.__doc__)
+    load.add_argument('--servers', default='dev,gunicorn')
+    load.add_argument('--workers', type=int, default=2)
+    load.add_argument('--threads', type=int, default=16)
+    load.add_argument('--connections', type=int, default=16)
+    load.add_argument('--duration', type=float, default=10)
+    load.add_argument('--ids', type=int, default=200)
+    load.add_argument('--stub-delay', type=float, default=0.05)
+    load.set_defaults(func=bench_load)
+    
+    encode = subparsers.add_parser('encode', help=bench_encode.__doc__)
+    encode.add_argument('--profiles', default=','.join(youtubedl.ENCODE_PROFILES))
+    encode.add_argument('--sizes', default='1920x1080,1440x1080')
+    encode.add_argument('--height', default='720')
+    encode.add_argument('--duration', type=int, default=10)
+    encode.add_argument('--parallel', type=int, default=1)
+    encode.set_defaults(func=bench_encode)
+    
+    ingest = subparsers.add_parser('ingest', help=bench_ingest.__doc__)
+    ingest.add_argument('--entries', type=int, default=40)
+    ingest.add_argument('--cached', type=float, default=0.25)
+    ingest.add_argument('--quality', default='720p')
+    ingest.add_argument('--concurrency', type=int, default=4)
+    ingest.add_argument('--workers', type=int, default=4)
+    ingest.add_argument('--rate', type=float, default=10)
+    ingest.add_argument('--burst', type=int, default=2)
+    ingest.add_argument('--backoff', type=float, default=0.2)
+    ingest.add_argument('--fail-rate', type=float, default=0.1)
+    ingest.add_argument('--job-delay', type=float, default=0.1)
+    ingest.add_argument('--seed', type=int, default=1)
+    ingest.set_defaults(func=bench_ingest)
+    
+    log = subparsers.add_parser('logging', help=bench_logging.__doc__)
+    log.add_argument('--records', type=int, default=4000)
+    log.add_argument('--threads', type=int, default=8)
+    log.add_argument('--write-delay', type=float, default=0.0)
+    log.add_argument('--max-mb', type=int, default=20)
+    log.set_defaults(func=bench_logging)
+    
+    supervisor = subparsers.add_parser('supervisor', help=bench_supervisor.__doc__)
+    supervisor.add_argument('--limit', type=int, default=2)
+    supervisor.add_argument('--flood-mb', type=int, default=200)
+    supervisor.set_defaults(func=bench_supervisor)
+    
+    pipeline = subparsers.add_parser('pipeline', help=bench_pipeline.__doc__)
+    pipeline.add_argument('--media', choices=('dummy', 'lavfi'), default='dummy')
+    pipeline.add_argument('--videos', type=int, default=16)
+    pipeline.add_argument('--concurrency', type=int, default=8)
+    pipeline.add_argument('--size-mb', type=int, default=8)
+    pipeline.add_argument('--clip-seconds', type=int, default=10)
+    pipeline.add_argument('--info-delay', type=float, default=0.05)
+    pipeline.add_argument('--download-delay', type=float, default=0.2)
+    pipeline.add_argument('--encode-delay', type=float, default=0.05)
+    pipeline.add_argument('--save-baseline')
+    pipeline.add_argument('--baseline')
+    pipeline.add_argument('--tolerance', type=float, default=0.25)
+    pipeline.set_defaults(func=bench_pipeline)
+    
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--servers', default='dev,gunicorn')
+    startup.add_argument('--budget', type=float, default=0,
+                         help="fail when a server's median start to first response exceeds this many seconds")
+    startup.set_defaults(func=bench_startup)
+    
+    admission = subparsers.add_parser('admission', help=bench_admission.__doc__)
+    admission.add_argument('--abusers', type=int, default=32)
+    admission.add_argument('--clients', type=int, default=4)
+    admission.add_argument('--think', type=float, default=0.5)
+    admission.add_argument('--duration', type=float, default=10)
+    admission.add_argument('--stub-delay', type=float, default=0.5)
+    admission.add_argument('--max-in-flight', type=int, default=8)
+    admission.add_argument('--server', default='gunicorn')
+    admission.add_argument('--max-p99', type=float, default=0,
+                           help="fail when the clients' p99 with admission control exceeds this many seconds")
+    admission.set_defaults(func=bench_admission)
+    
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())